@@ -0,0 +1,175 @@
+import heapq
+import re
+import sys
+import unicodedata
+from typing import Optional
+from uuid import UUID
+
+from loguru import logger
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import Book
+
+# Keys are cut to this many characters: nobody types longer prefixes, and it bounds the depth of the trie
+MAX_KEY_LENGTH = 32
+TOP_K = 10
+
+Term = tuple[str, str]  # (kind, text)
+
+
+def normalize(text: str) -> str:
+    """Casefold, strip accents and collapse whitespace, so "Émile  Zola" is typed as "emile zola"."""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return " ".join(stripped.split())
+
+
+def _keys(text: str) -> set[str]:
+    """Index a text under every word start, so "the hobbit" is found by both "the h" and "hob"."""
+    normalized = normalize(text)
+    return {normalized[match.start() :][:MAX_KEY_LENGTH] for match in re.finditer(r"\S+", normalized)}
+
+
+class _Node:
+    __slots__ = ("children", "terms", "top")
+
+    def __init__(self) -> None:
+        self.children: dict[str, _Node] = {}
+        # Terms whose key ends here; most nodes are only on the way to one, so the set is created lazily
+        self.terms: Optional[set[Term]] = None
+        # Best TOP_K terms of the whole subtree as (-weight, kind, text), so every lookup is a single walk
+        self.top: list[tuple[int, str, str]] = []
+
+
+class AutocompleteIndex:
+    """In-process prefix index of book titles and authors.
+
+    Every node keeps the top-k terms of its subtree, ranked by the number of books carrying them, so
+    a lookup costs the length of the prefix regardless of the size of the catalog.
+    """
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.root = _Node()
+        self.node_count = 1
+        self.weights: dict[Term, int] = {}
+        self.books: dict[UUID, tuple[Term, ...]] = {}
+
+    def _path(self, key: str, create: bool = False) -> Optional[list[_Node]]:
+        node, path = self.root, [self.root]
+        for char in key:
+            child = node.children.get(char)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[char] = _Node()
+                self.node_count += 1
+            node = child
+            path.append(node)
+        return path
+
+    def _refresh(self, node: _Node) -> None:
+        # A term is indexed under each of its word starts, so several children can list the same one
+        candidates = {term: -self.weights[term] for term in node.terms or ()}
+        for child in node.children.values():
+            for weight, kind, text in child.top:
+                candidates[kind, text] = min(weight, candidates.get((kind, text), 0))
+        node.top = heapq.nsmallest(TOP_K, ((weight, kind, text) for (kind, text), weight in candidates.items()))
+
+    def _change(self, term: Term, delta: int) -> None:
+        weight = self.weights.get(term, 0) + delta
+        if weight > 0:
+            self.weights[term] = weight
+        else:
+            self.weights.pop(term, None)
+        for key in _keys(term[1]):
+            path = self._path(key, create=weight > 0)
+            if path is None:
+                continue
+            if weight > 0:
+                self._add_term(path[-1], term)
+            elif path[-1].terms:
+                path[-1].terms.discard(term)
+            # Prune the tail of the branch once it no longer leads to any term
+            while len(path) > 1 and not path[-1].terms and not path[-1].children:
+                path.pop()
+                del path[-1].children[key[len(path) - 1]]
+                self.node_count -= 1
+            for node in reversed(path):
+                self._refresh(node)
+
+    @staticmethod
+    def _add_term(node: _Node, term: Term) -> None:
+        if node.terms is None:
+            node.terms = set()
+        node.terms.add(term)
+
+    @staticmethod
+    def _terms(title: str, author: str) -> tuple[Term, ...]:
+        return (("title", title), ("author", author))
+
+    def add_book(self, book_uid: UUID, title: str, author: str) -> None:
+        """Index a new book."""
+        self.remove_book(book_uid)
+        terms = self._terms(title, author)
+        self.books[book_uid] = terms
+        for term in terms:
+            self._change(term, 1)
+
+    def update_book(self, book_uid: UUID, title: str, author: str) -> None:
+        """Re-index a book whose title or author may have changed."""
+        if self.books.get(book_uid) != self._terms(title, author):
+            self.add_book(book_uid, title, author)
+
+    def remove_book(self, book_uid: UUID) -> None:
+        """Drop a deleted book from the index."""
+        for term in self.books.pop(book_uid, ()):
+            self._change(term, -1)
+
+    def suggest(self, prefix: str, limit: int = TOP_K) -> list[dict]:
+        """Get the most common titles and authors starting with the prefix at a word boundary."""
+        key = normalize(prefix)[:MAX_KEY_LENGTH]
+        path = self._path(key) if key else None
+        if path is None:
+            return []
+        return [{"text": text, "kind": kind} for _, kind, text in path[-1].top[:limit]]
+
+    async def load(self, session: AsyncSession) -> None:
+        """Build the whole index from the database, computing every top-k list in one bottom-up pass."""
+        self.reset()
+        result = await session.stream(select(Book.uid, Book.title, Book.author).execution_options(yield_per=1000))
+        async for book_uid, title, author in result:
+            terms = self._terms(title, author)
+            self.books[book_uid] = terms
+            for term in terms:
+                self.weights[term] = self.weights.get(term, 0) + 1
+        for term in self.weights:
+            for key in _keys(term[1]):
+                self._add_term(self._path(key, create=True)[-1], term)
+
+        stack = [(self.root, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if children_done:
+                self._refresh(node)
+            else:
+                stack.append((node, True))
+                stack.extend((child, False) for child in node.children.values())
+        logger.info(f"Loaded autocomplete index: {self.stats()}")
+
+    def stats(self) -> dict:
+        """Size of the index, including an estimate of its memory footprint in bytes."""
+        memory = sys.getsizeof(self.weights) + sys.getsizeof(self.books)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            memory += sys.getsizeof(node) + sys.getsizeof(node.children) + sys.getsizeof(node.top)
+            memory += sys.getsizeof(node.terms) if node.terms is not None else 0
+            stack.extend(node.children.values())
+        return {"books": len(self.books), "terms": len(self.weights), "nodes": self.node_count, "memory_bytes": memory}
+
+
+autocomplete_index = AutocompleteIndex()
@@ -0,0 +1,158 @@
+import asyncio
+import os
+import shutil
+from abc import ABC, abstractmethod
+from collections.abc import AsyncIterator
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Annotated, Optional
+from uuid import UUID
+
+import anyio
+from fastapi import Depends
+from loguru import logger
+from PIL import Image, ImageOps
+
+from app.config import Config
+from app.errors import CoverTooLarge, UnsupportedCoverFormat
+
+# Accepted upload types with the magic bytes of their files, as `(offset, bytes)` parts that must all match;
+# RIFF is a container shared with WAV and AVI, so WebP also needs its form type at offset 8
+COVER_SIGNATURES = {
+    "image/jpeg": ((0, b"\xff\xd8\xff"),),
+    "image/png": ((0, b"\x89PNG\r\n\x1a\n"),),
+    "image/webp": ((0, b"RIFF"), (8, b"WEBP")),
+}
+SIGNATURE_LENGTH = max(offset + len(magic) for parts in COVER_SIGNATURES.values() for offset, magic in parts)
+
+
+def matches_signature(head: bytes, content_type: str) -> bool:
+    """Whether the first bytes of a file are those of its declared type."""
+    return all(head[offset : offset + len(magic)] == magic for offset, magic in COVER_SIGNATURES[content_type])
+
+
+def original_key(book_uid: UUID) -> str:
+    return f"{book_uid}/original"
+
+
+def thumbnail_key(book_uid: UUID, size: int) -> str:
+    return f"{book_uid}/{size}.jpg"
+
+
+class CoverStorage(ABC):
+    """Where cover images are kept.
+
+    Covers are served with `FileResponse`, which needs a local path, so remote backends are expected
+    to be mounted or cached on the local filesystem.
+    """
+
+    @abstractmethod
+    async def save(self, key: str, chunks: AsyncIterator[bytes], content_type: str) -> int:
+        """Write a stream to the key, replacing what was there only once it was received in full."""
+
+    @abstractmethod
+    def path(self, key: str) -> Path:
+        """Local path of the file of a key, which may not exist."""
+
+    @abstractmethod
+    async def delete(self, book_uid: UUID, keep_original: bool = False) -> None:
+        """Remove the cover of a book and its thumbnails."""
+
+
+class LocalCoverStorage(CoverStorage):
+    """Covers stored in a directory of the local disk, one subdirectory per book."""
+
+    def __init__(self, root: str | Path) -> None:
+        self.root = Path(root)
+
+    def path(self, key: str) -> Path:
+        return self.root / key
+
+    async def save(self, key: str, chunks: AsyncIterator[bytes], content_type: str) -> int:
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = path.with_name(f"{path.name}.upload")
+        size = 0
+        # The first bytes are held back until the signature can be checked, whatever the chunk sizes
+        head = b""
+        try:
+            async with await anyio.open_file(temporary_path, "wb") as file:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > Config.COVER_MAX_BYTES:
+                        raise CoverTooLarge()
+                    if head is not None:
+                        head += chunk
+                        if len(head) < SIGNATURE_LENGTH:
+                            continue
+                        if not matches_signature(head, content_type):
+                            raise UnsupportedCoverFormat()
+                        chunk, head = head, None
+                    await file.write(chunk)
+                if head is not None:
+                    # The whole file is shorter than the longest signature
+                    if not head or not matches_signature(head, content_type):
+                        raise UnsupportedCoverFormat()
+                    await file.write(head)
+            os.replace(temporary_path, path)
+        finally:
+            temporary_path.unlink(missing_ok=True)
+        return size
+
+    async def delete(self, book_uid: UUID, keep_original: bool = False) -> None:
+        directory = self.root / str(book_uid)
+        if not keep_original:
+            await asyncio.to_thread(shutil.rmtree, directory, ignore_errors=True)
+            return
+        await asyncio.to_thread(self._unlink_thumbnails, book_uid)
+
+    def _unlink_thumbnails(self, book_uid: UUID) -> None:
+        for size in Config.COVER_THUMBNAIL_SIZES:
+            self.path(thumbnail_key(book_uid, size)).unlink(missing_ok=True)
+
+
+def get_cover_storage() -> CoverStorage:
+    return LocalCoverStorage(Config.COVER_STORAGE_DIR)
+
+
+CoverStorageDep = Annotated[CoverStorage, Depends(get_cover_storage)]
+
+
+def _make_thumbnails(source: str, targets: list[tuple[int, str]]) -> None:
+    """Resize an image to JPEG thumbnails fitting in squares of the given sizes; runs in a worker process."""
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        for size, target in targets:
+            thumbnail = image.copy()
+            thumbnail.thumbnail((size, size))
+            temporary_path = f"{target}.tmp"
+            thumbnail.save(temporary_path, "JPEG", quality=85, optimize=True)
+            os.replace(temporary_path, target)
+
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def get_thumbnail_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=Config.COVER_THUMBNAIL_WORKERS)
+    return _executor
+
+
+def shutdown_thumbnail_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
+
+
+async def generate_thumbnails(book_uid: UUID, storage: CoverStorage) -> None:
+    """Build every thumbnail of a cover in the process pool, so resizing never blocks the event loop."""
+    source = storage.path(original_key(book_uid))
+    targets = [(size, str(storage.path(thumbnail_key(book_uid, size)))) for size in Config.COVER_THUMBNAIL_SIZES]
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(get_thumbnail_executor(), _make_thumbnails, str(source), targets)
+    except Exception:
+        logger.exception(f"Failed to generate the thumbnails of the cover of book {book_uid}")
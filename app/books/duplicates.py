@@ -0,0 +1,167 @@
+import os
+import re
+import zipfile
+import zlib
+from typing import Optional
+from uuid import UUID
+
+import numpy as np
+from loguru import logger
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import Config
+from app.db.models import Book
+
+from .autocomplete import normalize
+
+SHINGLE_SIZE = 3
+NUM_PERM = 128
+# 32 bands of 4 rows: pairs above a Jaccard similarity of about 0.45 are almost always candidates
+BANDS = 32
+ROWS = NUM_PERM // BANDS
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+# Fixed seed, so signatures saved by one process are valid in the next one
+_rng = np.random.default_rng(20250101)
+_A = _rng.integers(1, MERSENNE_PRIME, NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, MERSENNE_PRIME, NUM_PERM, dtype=np.uint64)
+
+
+def _shingles(title: str, author: str) -> set[str]:
+    """Character trigrams of the title and author without case, accents or punctuation."""
+    text = " ".join(re.sub(r"[\W_]+", " ", normalize(f"{title} {author}")).split())
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i : i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def signature(title: str, author: str) -> np.ndarray:
+    """MinHash signature of the shingles of a book."""
+    hashes = np.array([zlib.crc32(shingle.encode()) for shingle in _shingles(title, author)], dtype=np.uint64)
+    # The products wrap around 2**64 like in the reference implementation, which keeps them cheap
+    with np.errstate(over="ignore"):
+        permuted = (np.outer(hashes, _A) + _B) % MERSENNE_PRIME & MAX_HASH
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+class DuplicateIndex:
+    """In-process MinHash LSH index of book titles and authors.
+
+    A book is only compared with the books sharing at least one band of its signature, so a check
+    costs a few dictionary lookups whatever the size of the catalog.
+    """
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.signatures: dict[UUID, np.ndarray] = {}
+        self.buckets: dict[tuple[int, bytes], set[UUID]] = {}
+
+    @staticmethod
+    def _bands(sig: np.ndarray) -> list[tuple[int, bytes]]:
+        return [(band, sig[band * ROWS : (band + 1) * ROWS].tobytes()) for band in range(BANDS)]
+
+    def _insert(self, book_uid: UUID, sig: np.ndarray) -> None:
+        self.signatures[book_uid] = sig
+        for key in self._bands(sig):
+            self.buckets.setdefault(key, set()).add(book_uid)
+
+    def add_book(self, book_uid: UUID, title: str, author: str) -> None:
+        """Index a new book."""
+        self.remove_book(book_uid)
+        self._insert(book_uid, signature(title, author))
+
+    def update_book(self, book_uid: UUID, title: str, author: str) -> None:
+        """Re-index a book whose title or author may have changed."""
+        self.add_book(book_uid, title, author)
+
+    def remove_book(self, book_uid: UUID) -> None:
+        """Drop a deleted book from the index."""
+        sig = self.signatures.pop(book_uid, None)
+        if sig is None:
+            return
+        for key in self._bands(sig):
+            bucket = self.buckets[key]
+            bucket.discard(book_uid)
+            if not bucket:
+                del self.buckets[key]
+
+    def _matches(self, sig: np.ndarray, exclude: Optional[UUID]) -> list[tuple[UUID, float]]:
+        candidates = set().union(*(self.buckets.get(key, ()) for key in self._bands(sig)))
+        candidates.discard(exclude)
+        matches = []
+        for book_uid in candidates:
+            score = float(np.count_nonzero(self.signatures[book_uid] == sig)) / NUM_PERM
+            if score >= Config.DUPLICATE_THRESHOLD:
+                matches.append((book_uid, score))
+        return sorted(matches, key=lambda match: match[1], reverse=True)
+
+    def find(self, title: str, author: str) -> list[tuple[UUID, float]]:
+        """Get the indexed books that are probable duplicates of a title and author, best match first."""
+        return self._matches(signature(title, author), None)
+
+    def find_duplicates_of(self, book_uid: UUID) -> list[tuple[UUID, float]]:
+        """Get the probable duplicates of an indexed book, best match first."""
+        sig = self.signatures.get(book_uid)
+        return [] if sig is None else self._matches(sig, book_uid)
+
+    @staticmethod
+    async def _fingerprint(session: AsyncSession) -> str:
+        # Any insert, update or delete of a book changes the count or the latest update time
+        result = await session.execute(select(func.count(), func.max(Book.updated_at)).select_from(Book))
+        count, last_update = result.one()
+        return f"{NUM_PERM}:{BANDS}:{count}:{last_update}"
+
+    def save(self, path: str, fingerprint: str) -> None:
+        """Write the signatures to disk, tagged with the state of the books table they describe."""
+        uids = np.array([book_uid.bytes for book_uid in self.signatures], dtype="S16")
+        signatures = np.array(list(self.signatures.values()), dtype=np.uint32).reshape(-1, NUM_PERM)
+        # Worker processes shutting down together each write a file of their own before the atomic rename
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary_path, "wb") as file:
+                np.savez(file, uids=uids, signatures=signatures, fingerprint=np.array(fingerprint))
+            os.replace(temporary_path, path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def _read(self, path: str, fingerprint: str) -> bool:
+        try:
+            with np.load(path) as data:
+                if str(data["fingerprint"]) != fingerprint:
+                    return False
+                self.reset()
+                for uid, sig in zip(data["uids"], data["signatures"]):
+                    self._insert(UUID(bytes=bytes(uid).ljust(16, b"\0")), sig)
+            return True
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile, zlib.error):
+            # A missing, truncated or corrupt file is rebuilt from the database
+            logger.warning(f"Could not read the duplicate index from {path}")
+            return False
+
+    async def load(self, session: AsyncSession) -> None:
+        """Load the index from DUPLICATE_INDEX_PATH, or rebuild it from the database when the file is stale."""
+        fingerprint = await self._fingerprint(session)
+        path = Config.DUPLICATE_INDEX_PATH
+        if path and self._read(path, fingerprint):
+            logger.info(f"Loaded duplicate index of {len(self.signatures)} books from {path}")
+            return
+        self.reset()
+        result = await session.stream(select(Book.uid, Book.title, Book.author).execution_options(yield_per=1000))
+        async for book_uid, title, author in result:
+            self._insert(book_uid, signature(title, author))
+        logger.info(f"Built duplicate index of {len(self.signatures)} books")
+        if path:
+            self.save(path, fingerprint)
+
+    async def dump(self, session: AsyncSession) -> None:
+        """Save the index to DUPLICATE_INDEX_PATH, so the next start does not have to rebuild it."""
+        if Config.DUPLICATE_INDEX_PATH:
+            self.save(Config.DUPLICATE_INDEX_PATH, await self._fingerprint(session))
+
+
+duplicate_index = DuplicateIndex()
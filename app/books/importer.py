@@ -0,0 +1,92 @@
+import codecs
+import csv
+import json
+from collections.abc import AsyncIterator
+from typing import Any
+
+from app.errors import InvalidImportFile, UnsupportedImportFormat
+
+MAX_LINE_LENGTH = 1024 * 1024
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Decode a UTF-8 byte stream into lines, keeping the line endings.
+
+    Only the current line is ever buffered, so memory use does not depend on the size of the upload.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    async for chunk in chunks:
+        try:
+            buffer += decoder.decode(chunk)
+        except UnicodeDecodeError:
+            raise InvalidImportFile()
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line + "\n"
+        if len(buffer) > MAX_LINE_LENGTH:
+            raise InvalidImportFile()
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer
+
+
+async def iter_ndjson_records(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, Any]]:
+    """Yield `(line number, record)` for every non blank line of an NDJSON stream.
+
+    Lines which are not valid JSON are yielded as a `ValueError` so the caller can report them.
+    """
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError as e:
+            yield line_number, e
+
+
+async def iter_csv_records(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, Any]]:
+    """Yield `(line number, record)` for every row of a CSV stream with a header row.
+
+    Quoted fields may span several lines: a record is complete once it holds a balanced number of quotes.
+    """
+    header = None
+    record, record_line = "", 0
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if not record:
+            record_line = line_number
+        record += line
+        if record.count('"') % 2:
+            if len(record) > MAX_LINE_LENGTH:
+                raise InvalidImportFile()
+            continue
+        if record.strip():
+            values = next(csv.reader([record]))
+            if header is None:
+                header = [name.strip() for name in values]
+            elif len(values) != len(header):
+                yield record_line, ValueError(f"Expected {len(header)} columns, got {len(values)}")
+            else:
+                yield record_line, dict(zip(header, values))
+        record = ""
+    if record.strip():
+        yield record_line, ValueError("Unterminated quoted field")
+    if header is None:
+        raise InvalidImportFile()
+
+
+def iter_import_records(content_type: str, lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, Any]]:
+    """Parse the lines of an upload as CSV or NDJSON according to its content type, parameters ignored.
+
+    A plain function rather than a generator, so an unsupported type is rejected before the body is read.
+    """
+    content_type = content_type.split(";")[0].strip().lower()
+    if content_type == "text/csv":
+        return iter_csv_records(lines)
+    if content_type in ("application/x-ndjson", "application/jsonl"):
+        return iter_ndjson_records(lines)
+    raise UnsupportedImportFormat()
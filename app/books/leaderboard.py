@@ -0,0 +1,254 @@
+import time
+from bisect import bisect_left, insort
+from collections import Counter
+from collections.abc import Iterable
+from datetime import datetime, timezone
+from typing import Optional
+from uuid import UUID
+
+from loguru import logger
+from redis import ConnectionError
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import Config
+from app.db.models import Book, Review
+from app.db.redis_client import get_redis_client
+
+TOP_KEY = "leaderboard:top"
+TRENDING_KEY = "leaderboard:trending"
+TRENDING_BUCKET_KEY = "leaderboard:trending:{bucket}"
+BUCKET_SECONDS = 3600
+
+
+def bayesian_rating(review_count: int, rating_sum: int) -> float:
+    """Average rating shrunk towards the prior, so a single 5-star review does not top the chart."""
+    prior_weight = Config.TOP_BOOKS_PRIOR_WEIGHT
+    return (Config.TOP_BOOKS_PRIOR_RATING * prior_weight + rating_sum) / (prior_weight + review_count)
+
+
+def _bucket(moment: Optional[datetime] = None) -> int:
+    """Hourly bucket of a moment; naive datetimes from the database are UTC."""
+    if moment is None:
+        return int(time.time()) // BUCKET_SECONDS
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp()) // BUCKET_SECONDS
+
+
+class Ranking:
+    """Scores of books with a list kept sorted on every write, the in-memory counterpart of a sorted set.
+
+    A write is a binary search plus a shift of the list, and reading the best `limit` entries is a slice.
+    """
+
+    def __init__(self, scores: Optional[dict[UUID, float]] = None) -> None:
+        self.scores: dict[UUID, float] = dict(scores or {})
+        self.order: list[tuple[float, UUID]] = sorted((-score, uid) for uid, score in self.scores.items())
+
+    def set(self, uid: UUID, score: float) -> None:
+        self.remove(uid)
+        self.scores[uid] = score
+        insort(self.order, (-score, uid))
+
+    def add(self, uid: UUID, amount: float) -> None:
+        """Add to the score of a book, dropping it once it falls to zero."""
+        score = self.scores.get(uid, 0) + amount
+        if score > 0:
+            self.set(uid, score)
+        else:
+            self.remove(uid)
+
+    def remove(self, uid: UUID) -> None:
+        score = self.scores.pop(uid, None)
+        if score is not None:
+            del self.order[bisect_left(self.order, (-score, uid))]
+
+    def best(self, limit: int) -> list[tuple[UUID, float]]:
+        return [(uid, -score) for score, uid in self.order[:limit]]
+
+
+class Leaderboard:
+    """Top rated and trending books, kept in Redis sorted sets or in process memory when Redis is unavailable.
+
+    In memory, the hourly buckets of review counts are summed into a running total as they are written,
+    and taken back out of it as they leave the window, so no read has to scan every rated book.
+    """
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.top = Ranking()
+        self.trending: dict[int, Counter[UUID]] = {}
+        self.trending_totals = Ranking()
+
+    def _window(self) -> range:
+        current = _bucket()
+        return range(current - Config.TRENDING_WINDOW_HOURS + 1, current + 1)
+
+    def _prune(self) -> None:
+        oldest = self._window().start
+        for bucket in [bucket for bucket in self.trending if bucket < oldest]:
+            for book_uid, count in self.trending.pop(bucket).items():
+                self.trending_totals.add(book_uid, -count)
+
+    async def update_rating(self, book_uid: UUID, review_count: int, rating_sum: int) -> None:
+        """Re-score a book from its current review aggregates."""
+        redis_client = get_redis_client()
+        if redis_client:
+            try:
+                if review_count:
+                    await redis_client.zadd(TOP_KEY, {str(book_uid): bayesian_rating(review_count, rating_sum)})
+                else:
+                    await redis_client.zrem(TOP_KEY, str(book_uid))
+                return
+            except ConnectionError:
+                logger.error("Redis error while updating top books")
+        if review_count:
+            self.top.set(book_uid, bayesian_rating(review_count, rating_sum))
+        else:
+            self.top.remove(book_uid)
+
+    async def update_ratings(self, aggregates: Iterable[tuple[UUID, int, int]]) -> None:
+        """Re-score many books at once from their `(uid, review_count, rating_sum)`."""
+        aggregates = list(aggregates)
+        redis_client = get_redis_client()
+        if redis_client:
+            try:
+                async with redis_client.pipeline() as pipe:
+                    for book_uid, review_count, rating_sum in aggregates:
+                        if review_count:
+                            pipe.zadd(TOP_KEY, {str(book_uid): bayesian_rating(review_count, rating_sum)})
+                        else:
+                            pipe.zrem(TOP_KEY, str(book_uid))
+                    await pipe.execute()
+                return
+            except ConnectionError:
+                logger.error("Redis error while updating top books")
+        for book_uid, review_count, rating_sum in aggregates:
+            if review_count:
+                self.top.set(book_uid, bayesian_rating(review_count, rating_sum))
+            else:
+                self.top.remove(book_uid)
+
+    async def _add_review(self, book_uid: UUID, bucket: int, amount: int) -> None:
+        if bucket not in self._window():
+            return
+        redis_client = get_redis_client()
+        if redis_client:
+            try:
+                key = TRENDING_BUCKET_KEY.format(bucket=bucket)
+                async with redis_client.pipeline() as pipe:
+                    pipe.zincrby(key, amount, str(book_uid))
+                    pipe.zremrangebyscore(key, "-inf", 0)
+                    pipe.expire(key, (Config.TRENDING_WINDOW_HOURS + 1) * BUCKET_SECONDS)
+                    await pipe.execute()
+                return
+            except ConnectionError:
+                logger.error("Redis error while updating trending books")
+        counts = self.trending.setdefault(bucket, Counter())
+        # A deletion only takes back what the bucket counted, which keeps the total in step with the buckets
+        amount = max(amount, -counts[book_uid])
+        counts[book_uid] += amount
+        if counts[book_uid] <= 0:
+            del counts[book_uid]
+        self.trending_totals.add(book_uid, amount)
+        self._prune()
+
+    async def record_review(self, book_uid: UUID) -> None:
+        """Count a new review towards the trending window."""
+        await self._add_review(book_uid, _bucket(), 1)
+
+    async def discard_review(self, book_uid: UUID, created_at: datetime) -> None:
+        """Take a deleted review back out of the trending window."""
+        await self._add_review(book_uid, _bucket(created_at), -1)
+
+    async def remove_book(self, book_uid: UUID) -> None:
+        """Drop a deleted book from both leaderboards."""
+        redis_client = get_redis_client()
+        if redis_client:
+            try:
+                keys = [TOP_KEY, TRENDING_KEY] + [TRENDING_BUCKET_KEY.format(bucket=b) for b in self._window()]
+                async with redis_client.pipeline() as pipe:
+                    for key in keys:
+                        pipe.zrem(key, str(book_uid))
+                    await pipe.execute()
+                return
+            except ConnectionError:
+                logger.error("Redis error while removing a book from the leaderboards")
+        self.top.remove(book_uid)
+        self.trending_totals.remove(book_uid)
+        for counts in self.trending.values():
+            counts.pop(book_uid, None)
+
+    async def get_top(self, limit: int) -> list[tuple[UUID, float]]:
+        """Get the highest scored books with their Bayesian rating."""
+        redis_client = get_redis_client()
+        if redis_client:
+            try:
+                entries = await redis_client.zrevrange(TOP_KEY, 0, limit - 1, withscores=True)
+                return [(UUID(member.decode()), score) for member, score in entries]
+            except ConnectionError:
+                logger.error("Redis error while reading top books")
+        return self.top.best(limit)
+
+    async def get_trending(self, limit: int) -> list[tuple[UUID, float]]:
+        """Get the books with the most reviews over the trending window."""
+        redis_client = get_redis_client()
+        if redis_client:
+            try:
+                if not await redis_client.exists(TRENDING_KEY):
+                    keys = [TRENDING_BUCKET_KEY.format(bucket=bucket) for bucket in self._window()]
+                    async with redis_client.pipeline() as pipe:
+                        pipe.zunionstore(TRENDING_KEY, keys)
+                        pipe.expire(TRENDING_KEY, Config.TRENDING_CACHE_SECONDS)
+                        await pipe.execute()
+                entries = await redis_client.zrevrange(TRENDING_KEY, 0, limit - 1, withscores=True)
+                return [(UUID(member.decode()), score) for member, score in entries]
+            except ConnectionError:
+                logger.error("Redis error while reading trending books")
+        self._prune()
+        return self.trending_totals.best(limit)
+
+    async def rebuild(self, session: AsyncSession) -> None:
+        """Rebuild both leaderboards from the database."""
+        result = await session.execute(
+            select(Book.uid, Book.review_count, Book.rating_sum).where(Book.review_count > 0)
+        )
+        top = {uid: bayesian_rating(review_count, rating_sum) for uid, review_count, rating_sum in result}
+
+        window = self._window()
+        since = datetime.fromtimestamp(window.start * BUCKET_SECONDS, timezone.utc).replace(tzinfo=None)
+        result = await session.execute(
+            select(Review.book_uid, Review.created_at).where(Review.book_uid.is_not(None), Review.created_at >= since)
+        )
+        trending: dict[int, Counter[UUID]] = {}
+        for book_uid, created_at in result:
+            bucket = _bucket(created_at)
+            if bucket in window:
+                trending.setdefault(bucket, Counter())[book_uid] += 1
+
+        redis_client = get_redis_client()
+        if redis_client:
+            try:
+                async with redis_client.pipeline() as pipe:
+                    pipe.delete(TOP_KEY, TRENDING_KEY, *(TRENDING_BUCKET_KEY.format(bucket=b) for b in window))
+                    if top:
+                        pipe.zadd(TOP_KEY, {str(uid): score for uid, score in top.items()})
+                    for bucket, counts in trending.items():
+                        key = TRENDING_BUCKET_KEY.format(bucket=bucket)
+                        pipe.zadd(key, {str(uid): count for uid, count in counts.items()})
+                        pipe.expire(key, (Config.TRENDING_WINDOW_HOURS + 1) * BUCKET_SECONDS)
+                    await pipe.execute()
+                logger.info(f"Rebuilt leaderboards in Redis ({len(top)} rated books)")
+                return
+            except ConnectionError:
+                logger.error("Redis error while rebuilding the leaderboards")
+        self.top = Ranking(top)
+        self.trending = trending
+        self.trending_totals = Ranking(sum(trending.values(), Counter()))
+        logger.info(f"Rebuilt in-memory leaderboards ({len(top)} rated books)")
+
+
+leaderboard = Leaderboard()
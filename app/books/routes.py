@@ -1,12 +1,42 @@
+import os
+from typing import Annotated, Any, Optional
 from uuid import UUID
 
-from fastapi import APIRouter, status
+import anyio
+from fastapi import APIRouter, BackgroundTasks, Body, Query, Request, Response, status
+from fastapi.responses import FileResponse, StreamingResponse
+from pydantic import ValidationError
 
-from app.auth.dependencies import CurrentUserDep
+from app.auth.dependencies import AdminRoleCheckerDep, CurrentUserDep
+from app.config import Config
 from app.db.main import SessionDep
+from app.errors import CoverNotFound
+from app.etag import etag_matches, make_etag, not_modified, page_etag
+from app.fieldsets import FieldsQuery, parse_fields
+from app.pagination import DEFAULT_PAGE_SIZE, CountQuery, CursorQuery, LimitQuery, Page
 
-from .schemas import BookCreate, BookDetail, BookPublic, BookUpdate
-from .service import BookService
+from .autocomplete import TOP_K, autocomplete_index
+from .covers import COVER_SIGNATURES, CoverStorageDep, generate_thumbnails
+from .importer import iter_import_records, iter_lines
+from .schemas import (
+    AutocompleteStats,
+    AutocompleteSuggestion,
+    BookBatchGet,
+    BookBatchResult,
+    BookBulkResult,
+    BookCreate,
+    BookDetail,
+    BookFacets,
+    BookFilterParams,
+    BookImportResult,
+    BookLeaderboardEntry,
+    BookListParams,
+    BookPublic,
+    BookPublicFields,
+    BookRatings,
+    BookUpdate,
+)
+from .service import DUPLICATE_ERROR, BookService
 
 book_router = APIRouter()
 book_service = BookService()
@@ -17,26 +47,218 @@ async def create_book(book_data: BookCreate, user: CurrentUserDep, session: Sess
     return await book_service.create_book(book_data, user.uid, session)
 
 
-@book_router.get("/", response_model=list[BookPublic])
-async def get_all_books(session: SessionDep):
-    return await book_service.get_all_books(session)
+@book_router.post("/bulk", response_model=BookBulkResult, status_code=status.HTTP_201_CREATED)
+async def create_books_bulk(
+    items: Annotated[list[dict[str, Any]], Body(min_length=1, max_length=Config.BOOK_BULK_MAX_ITEMS)],
+    user: CurrentUserDep,
+    session: SessionDep,
+):
+    valid_items, valid_indices, errors = [], [], []
+    for index, item in enumerate(items):
+        try:
+            valid_items.append(BookCreate.model_validate(item))
+            valid_indices.append(index)
+        except ValidationError as e:
+            errors.append({"index": index, "errors": e.errors(include_url=False, include_context=False)})
+    created, rejected = await book_service.create_books(valid_items, user.uid, session)
+    errors.extend({"index": valid_indices[position], "errors": [DUPLICATE_ERROR]} for position in rejected)
+    return {"created": created, "errors": sorted(errors, key=lambda error: error["index"])}
+
+
+@book_router.post(
+    "/import",
+    response_model=BookImportResult,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "text/csv": {"schema": {"type": "string"}},
+                "application/x-ndjson": {"schema": {"type": "string"}},
+            },
+        }
+    },
+)
+async def import_books(request: Request, user: CurrentUserDep, session: SessionDep):
+    """Stream a CSV (with a header row) or NDJSON file of books into the catalog."""
+    records = iter_import_records(request.headers.get("content-type", ""), iter_lines(request.stream()))
+    return await book_service.import_books(records, user.uid, session)
+
+
+@book_router.post("/batch-get", response_model=BookBatchResult, response_model_exclude_unset=True)
+async def get_books_batch(batch: BookBatchGet, session: SessionDep):
+    return await book_service.get_books_batch(batch.ids, batch.include_ratings, session)
+
+
+@book_router.get("/", response_model=Page[BookPublicFields], response_model_exclude_unset=True)
+async def get_all_books(
+    params: Annotated[BookListParams, Query()], request: Request, response: Response, session: SessionDep
+):
+    fields = parse_fields(params.fields, BookPublic)
+    page = await book_service.get_all_books(params, fields, session)
+    total = None
+    if params.count is not None:
+        total = await book_service.count_books(params, params.count, session)
+    # The total is part of the representation, so a change of it alone also changes the ETag
+    etag = page_etag(page, request.url.query, total)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    if total is not None:
+        response.headers["X-Total-Count"] = str(total)
+    return page
+
+
+@book_router.get("/autocomplete", response_model=list[AutocompleteSuggestion])
+async def autocomplete_books(
+    prefix: Annotated[str, Query(min_length=1, max_length=100)],
+    limit: Annotated[int, Query(ge=1, le=TOP_K)] = TOP_K,
+):
+    return autocomplete_index.suggest(prefix, limit)
+
+
+@book_router.get("/autocomplete/stats", response_model=AutocompleteStats, dependencies=[AdminRoleCheckerDep])
+async def autocomplete_stats():
+    return autocomplete_index.stats()
+
+
+@book_router.get("/facets", response_model=BookFacets)
+async def get_book_facets(filters: Annotated[BookFilterParams, Query()], session: SessionDep):
+    return await book_service.get_book_facets(filters, session)
+
+
+@book_router.get("/export", response_class=StreamingResponse)
+async def export_books(session: SessionDep):
+    """Export the whole catalog as NDJSON, one `BookPublic` object per line."""
+    # The export opens its own snapshot session on the same engine: the request scoped session is
+    # closed before the body is streamed.
+    return StreamingResponse(book_service.export_books(session.bind), media_type="application/x-ndjson")
+
+
+@book_router.get("/top", response_model=list[BookLeaderboardEntry])
+async def get_top_books(session: SessionDep, limit: LimitQuery = DEFAULT_PAGE_SIZE):
+    return await book_service.get_top_books(limit, session)
+
+
+@book_router.get("/trending", response_model=list[BookLeaderboardEntry])
+async def get_trending_books(session: SessionDep, limit: LimitQuery = DEFAULT_PAGE_SIZE):
+    return await book_service.get_trending_books(limit, session)
+
+
+@book_router.get("/search", response_model=Page[BookPublic])
+async def search_books(
+    q: Annotated[str, Query(min_length=1, max_length=200)],
+    session: SessionDep,
+    cursor: CursorQuery = None,
+    limit: LimitQuery = DEFAULT_PAGE_SIZE,
+):
+    return await book_service.search_books(q, cursor, limit, session)
 
 
 @book_router.get("/{book_uid}", response_model=BookDetail)
-async def get_book_detail(book_uid: UUID, session: SessionDep):
+async def get_book_detail(book_uid: UUID, request: Request, response: Response, session: SessionDep):
+    etag = make_etag(*await book_service.get_book_fingerprint(book_uid, session))
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
     return await book_service.get_book_detail(book_uid, session)
 
 
+@book_router.get("/{book_uid}/ratings", response_model=BookRatings)
+async def get_book_ratings(book_uid: UUID, session: SessionDep):
+    """Number of reviews of the book for each rating from 0 to 5 stars."""
+    return await book_service.get_book_ratings(book_uid, session)
+
+
+@book_router.get("/{book_uid}/similar", response_model=list[BookLeaderboardEntry])
+async def get_similar_books(
+    book_uid: UUID, session: SessionDep, limit: Annotated[int, Query(ge=1, le=Config.SIMILAR_BOOKS_K)] = 10
+):
+    """Books with the most similar tags, from neighbor lists precomputed by a batch job."""
+    return await book_service.get_similar_books(book_uid, limit, session)
+
+
+@book_router.get(
+    "/{book_uid}/duplicates", response_model=list[BookLeaderboardEntry], dependencies=[AdminRoleCheckerDep]
+)
+async def get_book_duplicates(book_uid: UUID, session: SessionDep):
+    """Probable duplicates of a book by MinHash estimate of title and author similarity, for moderators."""
+    return await book_service.get_book_duplicates(book_uid, session)
+
+
 @book_router.put("/{book_uid}", response_model=BookPublic)
 async def update_book(book_uid: UUID, book_update_data: BookUpdate, user: CurrentUserDep, session: SessionDep):
     return await book_service.update_book(book_uid, book_update_data, user, session)
 
 
 @book_router.delete("/{book_uid}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_book(book_uid: UUID, user: CurrentUserDep, session: SessionDep):
-    return await book_service.delete_book(book_uid, user, session)
+async def delete_book(book_uid: UUID, user: CurrentUserDep, session: SessionDep, storage: CoverStorageDep):
+    await book_service.delete_book(book_uid, user, session)
+    await storage.delete(book_uid)
+
+
+@book_router.put(
+    "/{book_uid}/cover",
+    response_model=BookPublic,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                content_type: {"schema": {"type": "string", "format": "binary"}} for content_type in COVER_SIGNATURES
+            },
+        }
+    },
+)
+async def upload_book_cover(
+    book_uid: UUID,
+    request: Request,
+    user: CurrentUserDep,
+    session: SessionDep,
+    storage: CoverStorageDep,
+    bg_tasks: BackgroundTasks,
+):
+    """Stream a JPEG, PNG or WebP cover to storage; thumbnails are generated after the response."""
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    book = await book_service.set_book_cover(book_uid, content_type, request.stream(), user, storage, session)
+    bg_tasks.add_task(generate_thumbnails, book_uid, storage)
+    return book
+
+
+@book_router.get("/{book_uid}/cover", response_class=FileResponse)
+async def get_book_cover(
+    book_uid: UUID, request: Request, session: SessionDep, storage: CoverStorageDep, size: Optional[int] = None
+):
+    """Serve the cover, or the thumbnail of one of COVER_THUMBNAIL_SIZES, with Range and ETag support."""
+    key, media_type = await book_service.get_book_cover(book_uid, size, session)
+    path = storage.path(key)
+    try:
+        stat_result = await anyio.to_thread.run_sync(os.stat, path)
+    except FileNotFoundError:
+        raise CoverNotFound()
+    response = FileResponse(path, media_type=media_type, stat_result=stat_result)
+    if etag_matches(request, response.headers["etag"]):
+        return not_modified(response.headers["etag"])
+    return response
 
 
-@book_router.get("/user/{user_uid}/", response_model=list[BookPublic])
-async def get_user_book_submissions(user_uid: UUID, session: SessionDep):
-    return await book_service.get_user_books(user_uid, session)
+@book_router.get("/user/{user_uid}/", response_model=Page[BookPublicFields], response_model_exclude_unset=True)
+async def get_user_book_submissions(
+    user_uid: UUID,
+    request: Request,
+    response: Response,
+    session: SessionDep,
+    cursor: CursorQuery = None,
+    limit: LimitQuery = DEFAULT_PAGE_SIZE,
+    fields: FieldsQuery = None,
+    count: CountQuery = None,
+):
+    page = await book_service.get_user_books(user_uid, cursor, limit, parse_fields(fields, BookPublic), session)
+    total = None
+    if count is not None:
+        total = await book_service.count_user_books(user_uid, count, session)
+    etag = page_etag(page, request.url.query, total)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    if total is not None:
+        response.headers["X-Total-Count"] = str(total)
+    return page
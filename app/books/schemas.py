@@ -1,9 +1,12 @@
 from datetime import date, datetime
-from typing import Annotated, Optional
+from typing import Annotated, Any, Literal, Optional
 from uuid import UUID
 
 from pydantic import BaseModel, Field, field_validator
 
+from app.config import Config
+from app.fieldsets import FieldsParams, partial_model
+from app.pagination import CountParams, PageParams
 from app.reviews.schemas import ReviewPublic
 from app.tags.schemas import TagPublic
 
@@ -19,10 +22,35 @@ class BookPublic(BaseModel):
     created_at: datetime
     updated_at: datetime
     user_uid: Optional[UUID] = None
+    review_count: int = 0
+    avg_rating: Optional[float] = None
+    version: int = 1
+    duplicate_of: Optional[UUID] = None
+    cover_content_type: Optional[str] = None
+
+
+BookPublicFields = partial_model(BookPublic)
+
+
+class BookLeaderboardEntry(BaseModel):
+    book: BookPublic
+    score: float
+
+
+class RatingCount(BaseModel):
+    rating: int
+    count: int
+
+
+class BookRatings(BaseModel):
+    review_count: int
+    avg_rating: Optional[float] = None
+    histogram: list[RatingCount]
 
 
 class BookDetail(BookPublic):
     reviews: list[ReviewPublic]
+    reviews_next_cursor: Optional[str] = None
     tags: list[TagPublic]
 
 
@@ -42,9 +70,100 @@ class BookCreate(BaseModel):
         return v
 
 
+class BookBatchGet(BaseModel):
+    ids: Annotated[list[UUID], Field(min_length=1, max_length=Config.BOOK_BATCH_MAX_IDS)]
+    include_ratings: bool = False
+
+
+class BookBatchResult(BaseModel):
+    items: list[BookPublicFields]
+    missing: list[UUID]
+
+
+class BookBulkItemError(BaseModel):
+    index: int
+    errors: list[dict[str, Any]]
+
+
+class BookBulkResult(BaseModel):
+    created: list[BookPublic]
+    errors: list[BookBulkItemError]
+
+
+class BookImportLineError(BaseModel):
+    line: int
+    errors: list[dict[str, Any]]
+
+
+class BookImportResult(BaseModel):
+    processed: int
+    created: int
+    failed: int
+    errors: list[BookImportLineError]
+
+
 class BookUpdate(BaseModel):
     title: Optional[Annotated[str, Field(min_length=1, max_length=200)]] = None
     author: Optional[Annotated[str, Field(min_length=1, max_length=100)]] = None
     publisher: Optional[Annotated[str, Field(min_length=1, max_length=100)]] = None
     page_count: Optional[Annotated[int, Field(gt=0)]] = None
     language: Optional[Annotated[str, Field(min_length=2, max_length=10)]] = None
+    version: Optional[int] = None
+
+
+class BookFilterParams(BaseModel):
+    language: Optional[Annotated[str, Field(min_length=2, max_length=10)]] = None
+    author: Optional[Annotated[str, Field(min_length=1, max_length=100)]] = None
+    publisher: Optional[Annotated[str, Field(min_length=1, max_length=100)]] = None
+    published_from: Optional[date] = None
+    published_to: Optional[date] = None
+    min_pages: Optional[Annotated[int, Field(gt=0)]] = None
+    max_pages: Optional[Annotated[int, Field(gt=0)]] = None
+    ids: Annotated[Optional[list[UUID]], Field(min_length=1, max_length=Config.BOOK_BATCH_MAX_IDS)] = None
+
+    @field_validator("ids", mode="before")
+    @classmethod
+    def split_ids(cls, v: Any) -> Any:
+        """Accept both repeated `ids` parameters and a comma separated list."""
+        if isinstance(v, str):
+            v = [v]
+        if isinstance(v, list):
+            return [uid.strip() for item in v for uid in item.split(",") if uid.strip()]
+        return v
+
+
+class AutocompleteSuggestion(BaseModel):
+    text: str
+    kind: Literal["title", "author"]
+
+
+class AutocompleteStats(BaseModel):
+    books: int
+    terms: int
+    nodes: int
+    memory_bytes: int
+
+
+class FacetCount(BaseModel):
+    value: str
+    count: int
+
+
+class BookFacets(BaseModel):
+    language: list[FacetCount]
+    publisher: list[FacetCount]
+    tag: list[FacetCount]
+    decade: list[FacetCount]
+
+
+class BookListParams(BookFilterParams, PageParams, CountParams, FieldsParams):
+    sort: Literal[
+        "created_at",
+        "-created_at",
+        "title",
+        "-title",
+        "published_date",
+        "-published_date",
+        "page_count",
+        "-page_count",
+    ] = "-created_at"
@@ -1,36 +1,303 @@
-from collections.abc import Sequence
-from typing import Optional
-from uuid import UUID
+import re
+from collections.abc import AsyncIterator, Sequence
+from typing import Any, Optional
+from uuid import UUID, uuid4
 
-from sqlalchemy import desc, select
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import joinedload
+from loguru import logger
+from pydantic import ValidationError
+from sqlalchemy import (
+    ColumnElement,
+    FromClause,
+    Integer,
+    Select,
+    String,
+    cast,
+    column,
+    delete,
+    extract,
+    func,
+    insert,
+    literal,
+    literal_column,
+    select,
+    table,
+    text,
+    union_all,
+    update,
+)
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 
-from app.db.models import Book, Role, User
-from app.errors import BookNotFound, InsufficientPermission
+from app.cache import cache_get, cache_set, invalidate
+from app.config import Config
+from app.db.main import snapshot_session
+from app.db.models import (
+    Book,
+    BookRatingCount,
+    BookSimilarity,
+    BookTag,
+    ModerationStatus,
+    Review,
+    Tag,
+    User,
+)
+from app.errors import (
+    BookNotFound,
+    CoverNotFound,
+    DuplicateBook,
+    UnsupportedCoverFormat,
+)
+from app.fieldsets import select_fields
+from app.ownership import OwnedRowsMixin
+from app.pagination import DEFAULT_PAGE_SIZE, CountMode, count_rows, paginate, paginate_ranked
 
-from .schemas import BookCreate, BookUpdate
+from .autocomplete import autocomplete_index
+from .covers import COVER_SIGNATURES, CoverStorage, original_key, thumbnail_key
+from .duplicates import DuplicateIndex, duplicate_index
+from .leaderboard import leaderboard
+from .schemas import BookCreate, BookFilterParams, BookListParams, BookPublic, BookUpdate
 
+books_fts = table("books_fts", column("rowid"))
 
-class BookService:
-    async def _check_permission(self, book: Book, user: User) -> None:
-        """Raise if the user is not the owner and not admin."""
-        if book.user_uid != user.uid and user.role != Role.ADMIN:
-            raise InsufficientPermission()
+EXPORT_BATCH_SIZE = 1000
+RATING_FIELDS = ("review_count", "avg_rating")
+DUPLICATE_ERROR = {"type": "duplicate", "msg": "A book with a very similar title and author already exists"}
+FACETS = ("language", "publisher", "tag", "decade")
+
+
+class BookService(OwnedRowsMixin):
+    model = Book
+    not_found = BookNotFound
+
+    @staticmethod
+    def _find_duplicate(book_data: BookCreate, pending: Optional[DuplicateIndex] = None) -> Optional[UUID]:
+        """Apply DUPLICATE_POLICY to a new book: raise when rejecting, or return the book it duplicates.
+
+        `pending` holds the books accepted earlier in the same batch, which are not indexed yet.
+        """
+        if Config.DUPLICATE_POLICY == "off":
+            return None
+        matches = duplicate_index.find(book_data.title, book_data.author)
+        if not matches and pending is not None:
+            matches = pending.find(book_data.title, book_data.author)
+        if not matches:
+            return None
+        if Config.DUPLICATE_POLICY == "reject":
+            raise DuplicateBook()
+        return matches[0][0]
+
+    @staticmethod
+    def _index_book(book_uid: UUID, title: str, author: str) -> None:
+        autocomplete_index.add_book(book_uid, title, author)
+        duplicate_index.add_book(book_uid, title, author)
 
     async def create_book(self, book_data: BookCreate, user_uid: Optional[UUID], session: AsyncSession) -> Book:
         """Create a new book."""
+        duplicate_of = self._find_duplicate(book_data)
         book_data_dict = book_data.model_dump()
-        new_book = Book(**book_data_dict, user_uid=user_uid)
+        new_book = Book(**book_data_dict, user_uid=user_uid, duplicate_of=duplicate_of)
         session.add(new_book)
         await session.commit()
+        await invalidate("books")
+        self._index_book(new_book.uid, new_book.title, new_book.author)
         return new_book
 
-    async def get_all_books(self, session: AsyncSession) -> Sequence[Book]:
-        """Get all books ordered by creation date."""
-        statement = select(Book).order_by(desc(Book.created_at))
-        result = await session.execute(statement)
-        return result.scalars().all()
+    async def create_books(
+        self, books_data: Sequence[BookCreate], user_uid: Optional[UUID], session: AsyncSession
+    ) -> tuple[Sequence[Book], list[int]]:
+        """Create many books with a single multi-row INSERT ... RETURNING in one transaction.
+
+        Returns the created books and the positions of the items rejected as duplicates.
+        """
+        rows, rejected = [], []
+        pending = DuplicateIndex()
+        for position, book_data in enumerate(books_data):
+            try:
+                duplicate_of = self._find_duplicate(book_data, pending)
+            except DuplicateBook:
+                rejected.append(position)
+                continue
+            row = {**book_data.model_dump(), "uid": uuid4(), "user_uid": user_uid, "duplicate_of": duplicate_of}
+            pending.add_book(row["uid"], row["title"], row["author"])
+            rows.append(row)
+        if not rows:
+            return [], rejected
+        statement = insert(Book).returning(Book, sort_by_parameter_order=True)
+        result = await session.scalars(statement, rows)
+        new_books = result.all()
+        await session.commit()
+        await invalidate("books")
+        for book in new_books:
+            self._index_book(book.uid, book.title, book.author)
+        return new_books, rejected
+
+    async def import_books(
+        self, records: AsyncIterator[tuple[int, Any]], user_uid: Optional[UUID], session: AsyncSession
+    ) -> dict:
+        """Validate and insert a stream of `(line number, record)` pairs in fixed-size chunks.
+
+        Each chunk is inserted with one executemany and committed on its own, so memory use is bounded
+        by the chunk size and the rows already imported survive a failure later in the file.
+        """
+        processed = created = failed = 0
+        errors: list[dict] = []
+        chunk: list[dict] = []
+        pending = DuplicateIndex()
+
+        async def flush() -> None:
+            nonlocal created
+            if chunk:
+                await session.execute(insert(Book), chunk)
+                await session.commit()
+                await invalidate("books")
+                for row in chunk:
+                    self._index_book(row["uid"], row["title"], row["author"])
+                created += len(chunk)
+                chunk.clear()
+                pending.reset()
+                logger.info(f"Book import progress: {processed} records processed, {created} books created")
+
+        async for line, record in records:
+            processed += 1
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                book_data = BookCreate.model_validate(record)
+                duplicate_of = self._find_duplicate(book_data, pending)
+            except ValidationError as e:
+                failed += 1
+                if len(errors) < Config.BOOK_IMPORT_MAX_ERRORS:
+                    errors.append({"line": line, "errors": e.errors(include_url=False, include_context=False)})
+                continue
+            except ValueError as e:
+                failed += 1
+                if len(errors) < Config.BOOK_IMPORT_MAX_ERRORS:
+                    errors.append({"line": line, "errors": [{"type": "parse_error", "msg": str(e)}]})
+                continue
+            except DuplicateBook:
+                failed += 1
+                if len(errors) < Config.BOOK_IMPORT_MAX_ERRORS:
+                    errors.append({"line": line, "errors": [DUPLICATE_ERROR]})
+                continue
+            row = {**book_data.model_dump(), "uid": uuid4(), "user_uid": user_uid, "duplicate_of": duplicate_of}
+            pending.add_book(row["uid"], row["title"], row["author"])
+            chunk.append(row)
+            if len(chunk) >= Config.BOOK_IMPORT_CHUNK_SIZE:
+                await flush()
+        await flush()
+        return {"processed": processed, "created": created, "failed": failed, "errors": errors}
+
+    @staticmethod
+    def _apply_filters(statement: Select, filters: BookFilterParams) -> Select:
+        """Restrict a books query to the given filters."""
+        if filters.language is not None:
+            statement = statement.where(Book.language == filters.language)
+        if filters.author is not None:
+            statement = statement.where(Book.author == filters.author)
+        if filters.publisher is not None:
+            statement = statement.where(Book.publisher == filters.publisher)
+        if filters.published_from is not None:
+            statement = statement.where(Book.published_date >= filters.published_from)
+        if filters.published_to is not None:
+            statement = statement.where(Book.published_date <= filters.published_to)
+        if filters.min_pages is not None:
+            statement = statement.where(Book.page_count >= filters.min_pages)
+        if filters.max_pages is not None:
+            statement = statement.where(Book.page_count <= filters.max_pages)
+        if filters.ids is not None:
+            statement = statement.where(Book.uid.in_(filters.ids))
+        return statement
+
+    async def get_all_books(self, params: BookListParams, fields: Optional[list[str]], session: AsyncSession) -> dict:
+        """Get a page of books matching the filters, in the requested order."""
+        statement = self._apply_filters(select_fields(Book, fields), params)
+        return await paginate(session, statement, Book, params.cursor, params.limit, sort=params.sort, fields=fields)
+
+    async def count_books(self, filters: BookFilterParams, mode: CountMode, session: AsyncSession) -> int:
+        """Count the books matching the filters."""
+        return await count_rows(session, self._apply_filters(select(Book.uid), filters), mode, "books")
+
+    async def get_book_facets(self, filters: BookFilterParams, session: AsyncSession) -> dict:
+        """Count the books matching the filters per language, publisher, tag and decade.
+
+        Every facet is a grouped count over the same filtered books, combined with UNION ALL so that
+        all of them come back in one round trip. Results are cached until the next book or tag write.
+        """
+        key = "facets:" + filters.model_dump_json()
+        facets = await cache_get("books", key)
+        if facets is not None:
+            return facets
+
+        books = self._apply_filters(select(Book.uid, Book.language, Book.publisher, Book.published_date), filters).cte()
+        decades = select((cast(extract("year", books.c.published_date), Integer) // 10 * 10).label("decade")).subquery()
+
+        def top_values(facet: str, value: ColumnElement, from_clause: FromClause) -> Select:
+            # Each facet is cut to its most common values in the database rather than after fetching every
+            # distinct publisher or tag; the parts of a UNION ALL can only be ordered and limited as subqueries
+            ranked = (
+                select(literal(facet).label("facet"), value.label("value"), func.count().label("count"))
+                .select_from(from_clause)
+                .group_by(value)
+                .order_by(func.count().desc(), value)
+                .limit(Config.FACETS_MAX_VALUES)
+                .subquery()
+            )
+            return select(ranked)
+
+        tagged_books = books.join(BookTag, BookTag.book_uid == books.c.uid).join(Tag, Tag.uid == BookTag.tag_uid)
+        statement = union_all(
+            top_values("language", books.c.language, books),
+            top_values("publisher", books.c.publisher, books),
+            top_values("tag", Tag.name, tagged_books),
+            top_values("decade", cast(decades.c.decade, String), decades),
+        )
+        facets = {facet: [] for facet in FACETS}
+        for facet, value, count in await session.execute(statement):
+            facets[facet].append({"value": f"{value}s" if facet == "decade" else value, "count": count})
+        for values in facets.values():
+            values.sort(key=lambda item: (-item["count"], item["value"]))
+        await cache_set("books", key, facets)
+        return facets
+
+    async def search_books(self, query: str, cursor: Optional[str], limit: int, session: AsyncSession) -> dict:
+        """Full-text search on title, author and publisher, best matches first."""
+        if session.bind.dialect.name == "postgresql":
+            ts_query = func.websearch_to_tsquery("simple", query)
+            search_vector = literal_column("books.search_vector")
+            statement = (
+                select(Book)
+                .where(search_vector.op("@@")(ts_query))
+                .order_by(func.ts_rank_cd(search_vector, ts_query).desc(), Book.uid)
+            )
+        else:
+            # Quote every term so user input can't inject FTS5 query syntax; the last term is a prefix
+            # so that partially typed words still match.
+            terms = re.findall(r"\w+", query)
+            if not terms:
+                return {"items": [], "next_cursor": None}
+            match = " ".join(f'"{term}"' for term in terms) + "*"
+            statement = (
+                select(Book)
+                .join(books_fts, books_fts.c.rowid == literal_column("books.rowid"))
+                .where(text("books_fts MATCH :match").bindparams(match=match))
+                .order_by(text("bm25(books_fts, 10.0, 5.0, 1.0)"), Book.uid)
+            )
+        return await paginate_ranked(session, statement, cursor, limit)
+
+    async def export_books(self, bind: AsyncEngine) -> AsyncIterator[str]:
+        """Stream every book as NDJSON from a single consistent snapshot.
+
+        Rows are fetched through a server-side cursor in batches of `EXPORT_BATCH_SIZE`, so memory use
+        stays constant no matter how large the table is.
+        """
+        async with snapshot_session(bind) as session:
+            statement = select(Book).order_by(Book.uid).execution_options(yield_per=EXPORT_BATCH_SIZE)
+            result = await session.stream_scalars(statement)
+            async for books in result.partitions():
+                yield "".join(
+                    BookPublic.model_validate(book, from_attributes=True).model_dump_json() + "\n" for book in books
+                )
 
     async def get_book(self, book_uid: UUID, session: AsyncSession) -> Book:
         """Get a specific book by its UID."""
@@ -40,14 +307,56 @@ class BookService:
         return book
 
     async def get_book_detail(self, book_uid: UUID, session: AsyncSession) -> Book:
-        """Get a specific book with details by its UID."""
-        statement = select(Book).where(Book.uid == book_uid).options(joinedload(Book.reviews), joinedload(Book.tags))
+        """Get a specific book with its tags and the first page of its reviews.
+
+        Reviews are paged with their own keyset query instead of being joined, so popular books
+        do not multiply rows by their tags; `reviews_next_cursor` continues on `/reviews/book/{book_uid}`.
+        """
+        statement = select(Book).where(Book.uid == book_uid).options(selectinload(Book.tags))
         result = await session.execute(statement)
-        book = result.unique().scalar_one_or_none()
+        book = result.scalar_one_or_none()
         if book is None:
             raise BookNotFound()
+        reviews = await paginate(
+            session, select(Review).where(Review.book_uid == book_uid), Review, None, DEFAULT_PAGE_SIZE
+        )
+        set_committed_value(book, "reviews", reviews["items"])
+        book.reviews_next_cursor = reviews["next_cursor"]
         return book
 
+    async def get_book_fingerprint(self, book_uid: UUID, session: AsyncSession) -> tuple:
+        """Get the values that change whenever the detail representation of a book changes.
+
+        This is a single aggregate query over the indexed foreign keys, much cheaper than loading
+        the book with all of its reviews and tags.
+        """
+        book_tags = select(Tag).join(BookTag, BookTag.tag_uid == Tag.uid).where(BookTag.book_uid == Book.uid)
+        book_reviews = select(Review).where(Review.book_uid == Book.uid)
+        statement = select(
+            Book.updated_at,
+            Book.version,
+            Book.review_count,
+            Book.rating_sum,
+            book_reviews.with_only_columns(func.count(Review.uid)).scalar_subquery(),
+            book_reviews.with_only_columns(func.max(Review.updated_at)).scalar_subquery(),
+            # Every review edit bumps its version, which catches edits within the second of `updated_at`
+            book_reviews.with_only_columns(func.sum(Review.version)).scalar_subquery(),
+            # Timestamps have whole second precision; the status counts catch moderation within the same second
+            book_reviews.with_only_columns(
+                func.count(Review.uid).filter(Review.moderation_status == ModerationStatus.APPROVED)
+            ).scalar_subquery(),
+            book_reviews.with_only_columns(
+                func.count(Review.uid).filter(Review.moderation_status == ModerationStatus.REJECTED)
+            ).scalar_subquery(),
+            book_tags.with_only_columns(func.count(Tag.uid)).scalar_subquery(),
+            book_tags.with_only_columns(func.max(Tag.created_at)).scalar_subquery(),
+        ).where(Book.uid == book_uid)
+        result = await session.execute(statement)
+        fingerprint = result.one_or_none()
+        if fingerprint is None:
+            raise BookNotFound()
+        return tuple(fingerprint)
+
     async def get_book_with_tags(self, book_uid: UUID, session: AsyncSession) -> Book:
         """Get a specific book with details by its UID."""
         statement = select(Book).where(Book.uid == book_uid).options(joinedload(Book.tags))
@@ -58,25 +367,147 @@ class BookService:
         return book
 
     async def update_book(self, book_uid: UUID, update_data: BookUpdate, user: User, session: AsyncSession) -> Book:
-        """Update an existing book."""
-        db_book = await self.get_book(book_uid, session)
-        await self._check_permission(db_book, user)
+        """Update an existing book with a single UPDATE ... RETURNING, checking the version when one is given."""
         update_data_dict = update_data.model_dump(exclude_none=True)
-        for key, value in update_data_dict.items():
-            setattr(db_book, key, value)
+        version = update_data_dict.pop("version", None)
+        statement = (
+            update(Book)
+            .where(Book.uid == book_uid, self._owned_by(user))
+            .values(**update_data_dict, version=Book.version + 1)
+            .returning(Book)
+        )
+        if version is not None:
+            statement = statement.where(Book.version == version)
+        db_book = (await session.execute(statement)).scalar_one_or_none()
+        if db_book is None:
+            await self._raise_write_error(book_uid, user, session)
         await session.commit()
-        await session.refresh(db_book)
+        await invalidate("books")
+        autocomplete_index.update_book(db_book.uid, db_book.title, db_book.author)
+        duplicate_index.update_book(db_book.uid, db_book.title, db_book.author)
         return db_book
 
     async def delete_book(self, book_uid: UUID, user: User, session: AsyncSession) -> None:
-        """Delete a book."""
+        """Delete a book with a single DELETE ... RETURNING; its reviews are kept and its tags unlinked."""
+        statement = delete(Book).where(Book.uid == book_uid, self._owned_by(user)).returning(Book.uid)
+        if (await session.execute(statement)).scalar_one_or_none() is None:
+            await self._raise_write_error(book_uid, user, session)
+        await session.commit()
+        await invalidate("books", "reviews")
+        autocomplete_index.remove_book(book_uid)
+        duplicate_index.remove_book(book_uid)
+        await leaderboard.remove_book(book_uid)
+
+    async def set_book_cover(
+        self,
+        book_uid: UUID,
+        content_type: str,
+        chunks: AsyncIterator[bytes],
+        user: User,
+        storage: CoverStorage,
+        session: AsyncSession,
+    ) -> Book:
+        """Stream a new cover of a book to storage; its thumbnails are dropped until they are regenerated."""
+        if content_type not in COVER_SIGNATURES:
+            raise UnsupportedCoverFormat()
         db_book = await self.get_book(book_uid, session)
         await self._check_permission(db_book, user)
-        await session.delete(db_book)
+        await storage.save(original_key(book_uid), chunks, content_type)
+        await storage.delete(book_uid, keep_original=True)
+        statement = (
+            update(Book)
+            .where(Book.uid == book_uid)
+            .values(cover_content_type=content_type, version=Book.version + 1)
+            .returning(Book)
+        )
+        db_book = (await session.execute(statement)).scalar_one()
         await session.commit()
+        await invalidate("books")
+        return db_book
 
-    async def get_user_books(self, user_uid: UUID, session: AsyncSession) -> Sequence[Book]:
-        """Get all books submitted by a specific user."""
-        statement = select(Book).where(Book.user_uid == user_uid).order_by(desc(Book.created_at))
+    async def get_book_cover(self, book_uid: UUID, size: Optional[int], session: AsyncSession) -> tuple[str, str]:
+        """Get the storage key and media type of the cover of a book, or of one of its thumbnails."""
+        db_book = await self.get_book(book_uid, session)
+        if db_book.cover_content_type is None:
+            raise CoverNotFound()
+        if size is None:
+            return original_key(book_uid), db_book.cover_content_type
+        if size not in Config.COVER_THUMBNAIL_SIZES:
+            raise CoverNotFound()
+        return thumbnail_key(book_uid, size), "image/jpeg"
+
+    async def get_books_by_uids(self, book_uids: Sequence[UUID], session: AsyncSession) -> list[Book]:
+        """Get books by their UIDs in the given order, skipping the ones that no longer exist."""
+        if not book_uids:
+            return []
+        result = await session.execute(select(Book).where(Book.uid.in_(book_uids)))
+        books = {book.uid: book for book in result.scalars()}
+        return [books[book_uid] for book_uid in book_uids if book_uid in books]
+
+    async def get_books_batch(self, book_uids: list[UUID], include_ratings: bool, session: AsyncSession) -> dict:
+        """Get many books with one query, in the requested order, reporting the UIDs that do not exist."""
+        book_uids = list(dict.fromkeys(book_uids))
+        fields = list(BookPublic.model_fields)
+        if not include_ratings:
+            fields = [name for name in fields if name not in RATING_FIELDS]
+        result = await session.execute(select_fields(Book, fields).where(Book.uid.in_(book_uids)))
+        books = {book["uid"]: book for book in result.mappings()}
+        return {
+            "items": [books[book_uid] for book_uid in book_uids if book_uid in books],
+            "missing": [book_uid for book_uid in book_uids if book_uid not in books],
+        }
+
+    async def get_top_books(self, limit: int, session: AsyncSession) -> list[dict]:
+        """Get the top rated books by Bayesian average rating."""
+        return await self._leaderboard_entries(await leaderboard.get_top(limit), session)
+
+    async def get_trending_books(self, limit: int, session: AsyncSession) -> list[dict]:
+        """Get the books with the most reviews over the trending window."""
+        return await self._leaderboard_entries(await leaderboard.get_trending(limit), session)
+
+    async def get_book_ratings(self, book_uid: UUID, session: AsyncSession) -> dict:
+        """Get the 0 to 5 star distribution of the reviews of a book from its histogram counters."""
+        book = await self.get_book(book_uid, session)
+        result = await session.execute(
+            select(BookRatingCount.rating, BookRatingCount.count).where(BookRatingCount.book_uid == book_uid)
+        )
+        counts = dict(result.all())
+        return {
+            "review_count": book.review_count,
+            "avg_rating": book.avg_rating,
+            "histogram": [{"rating": rating, "count": counts.get(rating, 0)} for rating in range(6)],
+        }
+
+    async def get_similar_books(self, book_uid: UUID, limit: int, session: AsyncSession) -> list[dict]:
+        """Get the precomputed neighbors of a book by tag similarity, most similar first."""
+        await self.get_book(book_uid, session)
+        statement = (
+            select(Book, BookSimilarity.score)
+            .join(BookSimilarity, BookSimilarity.similar_book_uid == Book.uid)
+            .where(BookSimilarity.book_uid == book_uid)
+            .order_by(BookSimilarity.score.desc(), Book.uid)
+            .limit(limit)
+        )
         result = await session.execute(statement)
-        return result.scalars().all()
+        return [{"book": book, "score": score} for book, score in result]
+
+    async def get_book_duplicates(self, book_uid: UUID, session: AsyncSession) -> list[dict]:
+        """Get the probable duplicates of a book, with their estimated similarity, best match first."""
+        await self.get_book(book_uid, session)
+        return await self._leaderboard_entries(duplicate_index.find_duplicates_of(book_uid), session)
+
+    async def _leaderboard_entries(self, ranking: list[tuple[UUID, float]], session: AsyncSession) -> list[dict]:
+        scores = dict(ranking)
+        books = await self.get_books_by_uids(list(scores), session)
+        return [{"book": book, "score": scores[book.uid]} for book in books]
+
+    async def get_user_books(
+        self, user_uid: UUID, cursor: Optional[str], limit: int, fields: Optional[list[str]], session: AsyncSession
+    ) -> dict:
+        """Get a page of books submitted by a specific user."""
+        statement = select_fields(Book, fields).where(Book.user_uid == user_uid)
+        return await paginate(session, statement, Book, cursor, limit, fields=fields)
+
+    async def count_user_books(self, user_uid: UUID, mode: CountMode, session: AsyncSession) -> int:
+        """Count the books submitted by a specific user."""
+        return await count_rows(session, select(Book.uid).where(Book.user_uid == user_uid), mode, "books")
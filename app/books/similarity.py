@@ -0,0 +1,287 @@
+import asyncio
+import heapq
+import os
+from collections.abc import Collection, Iterable
+from typing import Optional
+from uuid import UUID
+
+import numpy as np
+from loguru import logger
+from redis import ConnectionError
+from scipy import sparse
+from sqlalchemy import delete, func, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from app.config import Config
+from app.db.main import dialect_insert
+from app.db.models import BookSimilarity, BookTag
+from app.db.redis_client import get_redis_client
+
+# Rows of the book x book product computed at once, which bounds the memory of a rebuild
+BLOCK_SIZE = 1024
+INSERT_CHUNK_SIZE = 1000
+REBUILD_LOCK_KEY = "lock:rebuild-similarities"
+
+Neighbors = dict[UUID, list[tuple[UUID, float]]]
+
+
+class TagStatistics:
+    """Number of tagged books and of books carrying each tag, the inputs of the IDF weights.
+
+    Cached by the process so an incremental refresh does not have to scan `book_tags`; the full rebuild
+    recounts them, and a refresh recounts the tags of the book it is about.
+    """
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.loaded = False
+        self.book_count = 0
+        self.document_frequencies: dict[UUID, int] = {}
+
+    def set_from_pairs(self, pairs: Iterable[tuple[UUID, UUID]]) -> None:
+        books: dict[UUID, set[UUID]] = {}
+        for book_uid, tag_uid in pairs:
+            books.setdefault(tag_uid, set()).add(book_uid)
+        self.document_frequencies = {tag_uid: len(book_uids) for tag_uid, book_uids in books.items()}
+        self.book_count = len(set().union(*books.values()))
+        self.loaded = True
+
+    async def load(self, session: AsyncSession) -> None:
+        """Count the books of every tag, once per process; these are scans of the tag index only."""
+        if self.loaded:
+            return
+        result = await session.execute(
+            select(BookTag.tag_uid, func.count(func.distinct(BookTag.book_uid))).group_by(BookTag.tag_uid)
+        )
+        self.document_frequencies = dict(result.tuples().all())
+        self.book_count = await session.scalar(select(func.count(func.distinct(BookTag.book_uid)))) or 0
+        self.loaded = True
+
+    def idf(self, tag_uids: Iterable[UUID]) -> np.ndarray:
+        frequencies = np.array([self.document_frequencies.get(tag_uid, 1) for tag_uid in tag_uids], dtype=np.float64)
+        return np.log((1 + self.book_count) / (1 + frequencies)) + 1
+
+
+tag_statistics = TagStatistics()
+
+
+class TagMatrix:
+    """Sparse book x tag matrix with IDF weighted, L2 normalized rows.
+
+    The dot product of two rows is then the cosine similarity of the tag sets of the two books, with
+    rare tags counting for more than tags carried by half of the catalog.
+    """
+
+    def __init__(self, pairs: Iterable[tuple[UUID, UUID]], statistics: Optional[TagStatistics] = None) -> None:
+        self.rows: dict[UUID, int] = {}
+        tag_columns: dict[UUID, int] = {}
+        row_indices, column_indices = [], []
+        for book_uid, tag_uid in pairs:
+            row_indices.append(self.rows.setdefault(book_uid, len(self.rows)))
+            column_indices.append(tag_columns.setdefault(tag_uid, len(tag_columns)))
+        self.book_uids: list[UUID] = list(self.rows)
+
+        shape = (len(self.rows), len(tag_columns))
+        matrix = sparse.csr_matrix(
+            (np.ones(len(row_indices), dtype=np.float32), (row_indices, column_indices)), shape=shape
+        )
+        matrix.data[:] = 1  # a tag listed twice still counts once
+        if statistics is None:
+            # The pairs are the whole table, so they give the frequencies themselves
+            document_frequency = np.bincount(matrix.indices, minlength=shape[1])
+            idf = np.log((1 + shape[0]) / (1 + document_frequency)) + 1
+        else:
+            idf = statistics.idf(tag_columns)
+        matrix = matrix @ sparse.diags(idf.astype(np.float32))
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        self.matrix: sparse.csr_matrix = sparse.csr_matrix(sparse.diags(1 / norms) @ matrix)
+
+    def neighbors(self, book_uids: Collection[UUID], k: int) -> Neighbors:
+        """Top k most similar books of each of the books, best first."""
+        targets = [self.rows[book_uid] for book_uid in book_uids if book_uid in self.rows]
+        result: Neighbors = {}
+        transposed = self.matrix.T.tocsr()
+        for start in range(0, len(targets), BLOCK_SIZE):
+            block = targets[start : start + BLOCK_SIZE]
+            # The product stays sparse: a row only holds the books sharing a tag with its book
+            products = self.matrix[block] @ transposed
+            products.sort_indices()  # ties rank by column, whatever order the product stored them in
+            for index, row in enumerate(block):
+                columns, scores = self._row(products, index, row)
+                result[self.book_uids[row]] = self._top(columns, scores, k)
+        return result
+
+    def similarities(self, book_uid: UUID) -> dict[UUID, float]:
+        """Similarity of the book with every other book of the matrix it shares a tag with."""
+        if book_uid not in self.rows:
+            return {}
+        row = self.rows[book_uid]
+        products = self.matrix[row] @ self.matrix.T.tocsr()
+        products.sort_indices()
+        columns, scores = self._row(products, 0, row)
+        return {self.book_uids[column]: float(score) for column, score in zip(columns, scores)}
+
+    @staticmethod
+    def _row(products: sparse.csr_matrix, index: int, row: int) -> tuple[np.ndarray, np.ndarray]:
+        """Columns and scores of the stored entries of a row of a product, without the book itself."""
+        start, end = products.indptr[index], products.indptr[index + 1]
+        columns, scores = products.indices[start:end], products.data[start:end]
+        keep = (columns != row) & (scores > 0)
+        return columns[keep], scores[keep]
+
+    def _top(self, columns: np.ndarray, scores: np.ndarray, k: int) -> list[tuple[UUID, float]]:
+        if k < len(scores):
+            indices = np.argpartition(-scores, k)[:k]
+        else:
+            indices = np.arange(len(scores))
+        indices = indices[np.argsort(-scores[indices], kind="stable")]
+        return [(self.book_uids[columns[index]], float(scores[index])) for index in indices]
+
+
+def _top(scores: dict[UUID, float], k: int) -> list[tuple[UUID, float]]:
+    return heapq.nlargest(k, scores.items(), key=lambda entry: entry[1])
+
+
+def _compute_all(pairs: list[tuple[UUID, UUID]], k: int) -> Neighbors:
+    matrix = TagMatrix(pairs)
+    return matrix.neighbors(matrix.book_uids, k)
+
+
+def _compute_similarities(
+    pairs: list[tuple[UUID, UUID]], book_uid: UUID, statistics: TagStatistics
+) -> dict[UUID, float]:
+    return TagMatrix(pairs, statistics).similarities(book_uid)
+
+
+async def _load_pairs(session: AsyncSession) -> list[tuple[UUID, UUID]]:
+    result = await session.execute(select(BookTag.book_uid, BookTag.tag_uid))
+    return [tuple(row) for row in result]
+
+
+async def _upsert_neighbors(rows: list[dict], session: AsyncSession) -> None:
+    """Write neighbor rows, overwriting the scores of the ones a concurrent refresh already wrote."""
+    for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+        statement = dialect_insert(session)(BookSimilarity).values(rows[start : start + INSERT_CHUNK_SIZE])
+        statement = statement.on_conflict_do_update(
+            index_elements=[BookSimilarity.book_uid, BookSimilarity.similar_book_uid],
+            set_={"score": statement.excluded.score},
+        )
+        await session.execute(statement)
+
+
+async def rebuild_similarities(session: AsyncSession) -> None:
+    """Recompute the neighbor list of every tagged book from scratch."""
+    pairs = await _load_pairs(session)
+    # The matrix products are CPU bound, so they run off the event loop
+    neighbors = await asyncio.to_thread(_compute_all, pairs, Config.SIMILAR_BOOKS_K)
+    await session.execute(delete(BookSimilarity))
+    rows = [
+        {"book_uid": book_uid, "similar_book_uid": similar_book_uid, "score": score}
+        for book_uid, entries in neighbors.items()
+        for similar_book_uid, score in entries
+    ]
+    await _upsert_neighbors(rows, session)
+    await session.commit()
+    tag_statistics.set_from_pairs(pairs)
+    logger.info(f"Rebuilt similar books of {len(neighbors)} tagged books")
+
+
+async def refresh_book_similarities(book_uid: UUID, session: AsyncSession) -> None:
+    """Update the neighbor lists a change to the tags of one book can affect.
+
+    Only the tags of the books sharing a tag with it are loaded. The book gets a new neighbor list, and
+    the lists of the books currently listing it and of its SIMILARITY_INCREMENTAL_LIMIT closest books
+    have its entry replaced; their other entries, and the tag weights of the rest of the catalog, are
+    left as they are until the next full rebuild.
+    """
+    await tag_statistics.load(session)
+    book_tags = select(BookTag.tag_uid).where(BookTag.book_uid == book_uid)
+    co_tagged = select(BookTag.book_uid).where(BookTag.tag_uid.in_(book_tags))
+    result = await session.execute(select(BookTag.book_uid, BookTag.tag_uid).where(BookTag.book_uid.in_(co_tagged)))
+    pairs = [tuple(row) for row in result]
+    # Every book carrying one of the tags of the book is in the pairs, so their frequencies are exact
+    tag_books: dict[UUID, set[UUID]] = {}
+    for pair_book_uid, tag_uid in pairs:
+        tag_books.setdefault(tag_uid, set()).add(pair_book_uid)
+    own_tags = {tag_uid for pair_book_uid, tag_uid in pairs if pair_book_uid == book_uid}
+    tag_statistics.document_frequencies.update({tag_uid: len(tag_books[tag_uid]) for tag_uid in own_tags})
+
+    similarities = await asyncio.to_thread(_compute_similarities, pairs, book_uid, tag_statistics)
+    result = await session.execute(select(BookSimilarity.book_uid).where(BookSimilarity.similar_book_uid == book_uid))
+    targets = set(result.scalars()) | {uid for uid, _ in _top(similarities, Config.SIMILARITY_INCREMENTAL_LIMIT)}
+    targets.add(book_uid)
+    result = await session.execute(
+        select(BookSimilarity.book_uid, BookSimilarity.similar_book_uid, BookSimilarity.score).where(
+            BookSimilarity.book_uid.in_(targets)
+        )
+    )
+    current: Neighbors = {}
+    for target, similar_book_uid, score in result:
+        current.setdefault(target, []).append((similar_book_uid, score))
+
+    k = Config.SIMILAR_BOOKS_K
+    stale, rows = [], []
+    for target in targets:
+        if target == book_uid:
+            entries = dict(_top(similarities, k))
+        else:
+            entries = {uid: score for uid, score in current.get(target, []) if uid != book_uid}
+            if similarities.get(target, 0) > 0:
+                entries[book_uid] = similarities[target]
+            entries = dict(_top(entries, k))
+        stale.extend((target, uid) for uid, _ in current.get(target, []) if uid not in entries)
+        rows.extend(
+            {"book_uid": target, "similar_book_uid": uid, "score": score}
+            for uid, score in entries.items()
+            if target == book_uid or uid == book_uid
+        )
+    if stale:
+        await session.execute(
+            delete(BookSimilarity).where(tuple_(BookSimilarity.book_uid, BookSimilarity.similar_book_uid).in_(stale))
+        )
+    await _upsert_neighbors(rows, session)
+    await session.commit()
+
+
+async def refresh_book_similarities_in_background(book_uid: UUID, bind: AsyncEngine) -> None:
+    """Refresh after the response is sent, in a session of its own as the request session is closed by then."""
+    try:
+        async with AsyncSession(bind) as session:
+            await refresh_book_similarities(book_uid, session)
+    except Exception:
+        logger.exception(f"Failed to refresh the similar books of book {book_uid}")
+
+
+async def _claim_rebuild() -> bool:
+    """Whether this process runs the rebuild of the current interval.
+
+    Every worker process runs the periodic task, so with Redis they race for a key that outlives the
+    other workers' wakeups of the interval, and only the winner rebuilds; a lone process always does.
+    """
+    redis_client = get_redis_client()
+    if redis_client:
+        try:
+            expiry = max(Config.SIMILARITY_REBUILD_INTERVAL_SECONDS // 2, 1)
+            return bool(await redis_client.set(REBUILD_LOCK_KEY, os.getpid(), nx=True, ex=expiry))
+        except ConnectionError:
+            logger.error("Redis error while claiming the similar books rebuild")
+    return True
+
+
+async def rebuild_similarities_periodically(bind: AsyncEngine) -> None:
+    """Rebuild every SIMILARITY_REBUILD_INTERVAL_SECONDS, until cancelled.
+
+    The first rebuild waits for a whole interval, so a deploy does not start one in every worker.
+    """
+    while True:
+        await asyncio.sleep(Config.SIMILARITY_REBUILD_INTERVAL_SECONDS)
+        if not await _claim_rebuild():
+            continue
+        try:
+            async with AsyncSession(bind) as session:
+                await rebuild_similarities(session)
+        except Exception:
+            logger.exception("Failed to rebuild similar books")
@@ -0,0 +1,85 @@
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+from loguru import logger
+from redis import ConnectionError
+
+from app.config import Config
+from app.db.redis_client import get_redis_client
+
+# In-memory fallback: (namespace, generation, key) -> (expiry, value), least recently used first. Like the
+# Redis keys, entries of an invalidated namespace are orphaned by bumping its generation and age out on their
+# own. It is local to the process: with several workers and no Redis, a write only invalidates the worker that
+# made it, and the others serve their entries until CACHE_TTL_SECONDS expires them.
+CACHE_MOCK: OrderedDict[tuple[str, int, str], tuple[float, Any]] = OrderedDict()
+CACHE_MOCK_GENERATIONS: dict[str, int] = {}
+
+
+def _generation_key(namespace: str) -> str:
+    return f"cache:{namespace}:generation"
+
+
+async def cache_get(namespace: str, key: str) -> Optional[Any]:
+    """Get a cached value, or None when it is missing or its namespace was invalidated."""
+    redis_client = get_redis_client()
+    if redis_client:
+        try:
+            generation = await redis_client.get(_generation_key(namespace)) or b"0"
+            value = await redis_client.get(f"cache:{namespace}:{generation.decode()}:{key}")
+            return None if value is None else json.loads(value)
+        except ConnectionError:
+            logger.error("Redis error while reading the cache")
+    mock_key = (namespace, CACHE_MOCK_GENERATIONS.get(namespace, 0), key)
+    entry = CACHE_MOCK.get(mock_key)
+    if entry is None:
+        return None
+    expires_at, value = entry
+    if expires_at <= time.monotonic():
+        del CACHE_MOCK[mock_key]
+        return None
+    CACHE_MOCK.move_to_end(mock_key)
+    return value
+
+
+async def cache_set(namespace: str, key: str, value: Any) -> None:
+    """Cache a JSON serializable value until its namespace is invalidated or it expires."""
+    redis_client = get_redis_client()
+    if redis_client:
+        try:
+            generation = await redis_client.get(_generation_key(namespace)) or b"0"
+            await redis_client.set(
+                f"cache:{namespace}:{generation.decode()}:{key}", json.dumps(value), ex=Config.CACHE_TTL_SECONDS
+            )
+            return
+        except ConnectionError:
+            logger.error("Redis error while writing the cache")
+    mock_key = (namespace, CACHE_MOCK_GENERATIONS.get(namespace, 0), key)
+    CACHE_MOCK[mock_key] = (time.monotonic() + Config.CACHE_TTL_SECONDS, value)
+    CACHE_MOCK.move_to_end(mock_key)
+    while len(CACHE_MOCK) > Config.CACHE_MOCK_MAX_ENTRIES:
+        CACHE_MOCK.popitem(last=False)
+
+
+async def invalidate(*namespaces: str) -> None:
+    """Drop every cached value of the namespaces, after a write that changes them."""
+    redis_client = get_redis_client()
+    if redis_client:
+        try:
+            # Bumping the generation orphans the old keys, which then expire on their own
+            async with redis_client.pipeline() as pipe:
+                for namespace in namespaces:
+                    pipe.incr(_generation_key(namespace))
+                await pipe.execute()
+            return
+        except ConnectionError:
+            logger.error("Redis error while invalidating the cache")
+    for namespace in namespaces:
+        CACHE_MOCK_GENERATIONS[namespace] = CACHE_MOCK_GENERATIONS.get(namespace, 0) + 1
+
+
+def reset_cache_mock() -> None:
+    CACHE_MOCK.clear()
+    CACHE_MOCK_GENERATIONS.clear()
+    logger.info("In-memory cache has been reset")
@@ -1,9 +1,15 @@
+from uuid import UUID
+
 from asgiref.sync import async_to_sync
 from celery import Celery
 from fastapi import BackgroundTasks
+from sqlalchemy.ext.asyncio import AsyncEngine
 
 from app import email_service
+from app.books import similarity
 from app.config import Config
+from app.db.main import async_session
+from app.reviews import moderation
 
 celery_app = Celery()
 
@@ -22,6 +28,39 @@ def send_password_reset_email(user_email: str):
     print("Password reset email sent!")
 
 
+async def _refresh_book_similarities(book_uid: UUID):
+    async with async_session() as session:
+        await similarity.refresh_book_similarities(book_uid, session)
+
+
+async def _rebuild_book_similarities():
+    async with async_session() as session:
+        await similarity.rebuild_similarities(session)
+
+
+@celery_app.task()
+def refresh_book_similarities(book_uid: str):
+    async_to_sync(_refresh_book_similarities)(UUID(book_uid))
+    print("Similar books refreshed")
+
+
+@celery_app.task()
+def rebuild_book_similarities():
+    async_to_sync(_rebuild_book_similarities)()
+    print("Similar books rebuilt")
+
+
+async def _moderate_reviews():
+    async with async_session() as session:
+        await moderation.moderate_reviews(session)
+
+
+@celery_app.task()
+def moderate_reviews():
+    async_to_sync(_moderate_reviews)()
+    print("Pending reviews moderated")
+
+
 class EmailTaskService:
     def __init__(self, background_tasks: BackgroundTasks):
         self.background_tasks = background_tasks
@@ -37,3 +76,23 @@ class EmailTaskService:
             send_password_reset_email.delay(user_email)
         else:
             self.background_tasks.add_task(email_service.send_password_reset_email, user_email)
+
+
+class SimilarityTaskService:
+    def __init__(self, background_tasks: BackgroundTasks):
+        self.background_tasks = background_tasks
+
+    async def refresh_book(self, book_uid: UUID, bind: AsyncEngine):
+        if Config.USE_CELERY:
+            refresh_book_similarities.delay(str(book_uid))
+        else:
+            self.background_tasks.add_task(similarity.refresh_book_similarities_in_background, book_uid, bind)
+
+
+class ModerationTaskService:
+    async def queue_reviews(self):
+        """Have the pending reviews moderated soon, after a write added to the queue."""
+        if Config.USE_CELERY:
+            moderate_reviews.delay()
+        else:
+            moderation.moderation_worker.notify()
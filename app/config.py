@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -21,6 +23,46 @@ class Settings(BaseSettings):
     USE_REDIS: bool
     USE_CELERY: bool
     USE_SQLAlCHEMY_MONITOR: bool
+    BOOK_BULK_MAX_ITEMS: int = 1000
+    BOOK_IMPORT_CHUNK_SIZE: int = 1000
+    BOOK_IMPORT_MAX_ERRORS: int = 1000
+    BOOK_BATCH_MAX_IDS: int = 500
+    CACHE_TTL_SECONDS: int = 300
+    CACHE_MOCK_MAX_ENTRIES: int = 10000
+    FACETS_MAX_VALUES: int = 50
+    TOP_BOOKS_PRIOR_RATING: float = 3.0
+    TOP_BOOKS_PRIOR_WEIGHT: int = 5
+    TRENDING_WINDOW_HOURS: int = 24
+    TRENDING_CACHE_SECONDS: int = 60
+    SIMILAR_BOOKS_K: int = 20
+    SIMILARITY_REBUILD_INTERVAL_SECONDS: int = 3600
+    SIMILARITY_INCREMENTAL_LIMIT: int = 200
+    DUPLICATE_POLICY: Literal["off", "flag", "reject"] = "flag"
+    DUPLICATE_THRESHOLD: float = 0.7
+    DUPLICATE_INDEX_PATH: str = "duplicate_index.npz"
+    COVER_STORAGE_DIR: str = "media/covers"
+    COVER_MAX_BYTES: int = 5 * 1024 * 1024
+    COVER_THUMBNAIL_SIZES: list[int] = [64, 256, 512]
+    COVER_THUMBNAIL_WORKERS: int = 2
+    REVIEW_IMPORT_CHUNK_SIZE: int = 1000
+    REVIEW_IMPORT_MAX_ERRORS: int = 1000
+    MODERATION_SCORER: str = "app.reviews.moderation.TermScorer"
+    MODERATION_BLOCKED_TERMS: dict[str, float] = {
+        "<url>": 0.5,
+        "casino": 1.0,
+        "viagra": 2.0,
+        "porn": 2.0,
+        "loan": 0.5,
+        "crypto": 0.5,
+        "bitcoin": 0.5,
+        "promo": 0.5,
+        "discount": 0.5,
+    }
+    MODERATION_REJECT_THRESHOLD: float = 0.75
+    MODERATION_BATCH_SIZE: int = 500
+    MODERATION_POLL_SECONDS: int = 60
+    FEED_MAX_LENGTH: int = 500
+    FEED_PULL_THRESHOLD: int = 1000
 
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
@@ -31,3 +73,14 @@ Config = Settings()  # type: ignore
 broker_url = Config.REDIS_URL
 result_backend = Config.REDIS_URL
 broker_connection_retry_on_startup = True
+beat_schedule = {}
+if Config.SIMILARITY_REBUILD_INTERVAL_SECONDS > 0:
+    beat_schedule["rebuild-book-similarities"] = {
+        "task": "app.celery_tasks.rebuild_book_similarities",
+        "schedule": Config.SIMILARITY_REBUILD_INTERVAL_SECONDS,
+    }
+if Config.MODERATION_POLL_SECONDS > 0:
+    beat_schedule["moderate-reviews"] = {
+        "task": "app.celery_tasks.moderate_reviews",
+        "schedule": Config.MODERATION_POLL_SECONDS,
+    }
@@ -1,8 +1,13 @@
-from collections.abc import AsyncGenerator
+import sqlite3
+from collections.abc import AsyncGenerator, Callable
+from contextlib import asynccontextmanager
 from typing import Annotated
 
 from fastapi import Depends
 from loguru import logger
+from sqlalchemy import Engine, event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.sqlite.aiosqlite import AsyncAdapt_aiosqlite_connection
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 
 from app.config import Config
@@ -12,6 +17,15 @@ engine: AsyncEngine = create_async_engine(url=Config.DATABASE_URL)
 async_session: async_sessionmaker[AsyncSession] = async_sessionmaker(engine, expire_on_commit=False)
 
 
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record) -> None:
+    """SQLite only enforces foreign keys, and their ON DELETE actions, when asked to on every connection."""
+    if isinstance(dbapi_connection, (sqlite3.Connection, AsyncAdapt_aiosqlite_connection)):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
     async with async_session() as session:
         yield session
@@ -20,6 +34,25 @@ async def get_session() -> AsyncGenerator[AsyncSession, None]:
 SessionDep = Annotated[AsyncSession, Depends(get_session)]
 
 
+def dialect_insert(session: AsyncSession) -> Callable:
+    """The INSERT construct of the dialect of the session, which supports ON CONFLICT clauses."""
+    return postgresql.insert if session.bind.dialect.name == "postgresql" else sqlite.insert
+
+
+@asynccontextmanager
+async def snapshot_session(bind: AsyncEngine) -> AsyncGenerator[AsyncSession, None]:
+    """Open a read-only session in which every query sees the same snapshot of the database.
+
+    Used by long running reads, such as streamed exports, that outlive the request scoped session.
+    """
+    async with AsyncSession(bind) as session:
+        if bind.dialect.name == "postgresql":
+            await session.connection(
+                execution_options={"isolation_level": "REPEATABLE READ", "postgresql_readonly": True}
+            )
+        yield session
+
+
 async def init_db() -> None:
     logger.info("Creating tables if not exist...")
     async with engine.begin() as conn:
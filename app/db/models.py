@@ -3,8 +3,23 @@ from enum import StrEnum
 from typing import Optional
 from uuid import UUID, uuid4
 
-from sqlalchemy import ForeignKey, SmallInteger, String, func
+from sqlalchemy import (
+    DDL,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    SmallInteger,
+    String,
+    UniqueConstraint,
+    case,
+    cast,
+    event,
+    func,
+)
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.ext.asyncio import AsyncAttrs
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -13,8 +28,18 @@ class Role(StrEnum):
     ADMIN = "admin"
 
 
+class ModerationStatus(StrEnum):
+    PENDING = "pending"
+    APPROVED = "approved"
+    REJECTED = "rejected"
+
+
 class Base(AsyncAttrs, DeclarativeBase):
-    pass
+    type_annotation_map = {
+        # SQLite's CURRENT_TIMESTAMP has no fractional seconds. Bind datetimes in the same format so
+        # that comparisons against server generated timestamps (e.g. keyset cursors) stay consistent.
+        datetime: DateTime().with_variant(sqlite.DATETIME(truncate_microseconds=True), "sqlite"),
+    }
 
 
 class User(Base):
@@ -30,6 +55,7 @@ class User(Base):
     is_active: Mapped[bool] = mapped_column(default=True)
     created_at: Mapped[datetime] = mapped_column(server_default=func.now())
     updated_at: Mapped[datetime] = mapped_column(server_default=func.now(), onupdate=func.now())
+    version: Mapped[int] = mapped_column(default=1, server_default="1")
 
     books: Mapped[list["Book"]] = relationship(back_populates="user")
     reviews: Mapped[list["Review"]] = relationship(back_populates="user")
@@ -50,11 +76,44 @@ class Book(Base):
     created_at: Mapped[datetime] = mapped_column(server_default=func.now())
     updated_at: Mapped[datetime] = mapped_column(server_default=func.now(), onupdate=func.now())
     user_uid: Mapped[Optional[UUID]] = mapped_column(ForeignKey("users.uid"), nullable=True)
+    # Denormalized review aggregates, maintained incrementally by the review service
+    review_count: Mapped[int] = mapped_column(default=0, server_default="0")
+    rating_sum: Mapped[int] = mapped_column(default=0, server_default="0")
+    version: Mapped[int] = mapped_column(default=1, server_default="1")
+    # Set when DUPLICATE_POLICY is "flag" and the book looked like an existing one on creation
+    duplicate_of: Mapped[Optional[UUID]] = mapped_column(ForeignKey("books.uid", ondelete="SET NULL"), nullable=True)
+    cover_content_type: Mapped[Optional[str]] = mapped_column(String(32), nullable=True)
 
     user: Mapped[Optional[User]] = relationship(back_populates="books")
-    reviews: Mapped[list["Review"]] = relationship(back_populates="book")
+    reviews: Mapped[list["Review"]] = relationship(back_populates="book", passive_deletes=True)
     tags: Mapped[list["Tag"]] = relationship(secondary="book_tags", back_populates="books")
 
+    __table_args__ = (
+        Index("ix_books_created_at_uid", "created_at", "uid"),
+        Index("ix_books_user_uid_created_at_uid", "user_uid", "created_at", "uid"),
+        # Equality filters of the book listing, served in the default (newest first) order
+        Index("ix_books_language_created_at_uid", "language", "created_at", "uid"),
+        Index("ix_books_author_created_at_uid", "author", "created_at", "uid"),
+        Index("ix_books_publisher_created_at_uid", "publisher", "created_at", "uid"),
+        # Range filters and the other whitelisted sort orders
+        Index("ix_books_published_date_uid", "published_date", "uid"),
+        Index("ix_books_page_count_uid", "page_count", "uid"),
+        Index("ix_books_title_uid", "title", "uid"),
+        # The popular books whose reviews activity feeds pull rather than receive
+        Index("ix_books_review_count", "review_count"),
+    )
+
+    @hybrid_property
+    def avg_rating(self) -> Optional[float]:
+        if not self.review_count:
+            return None
+        return self.rating_sum / self.review_count
+
+    @avg_rating.inplace.expression
+    @classmethod
+    def _avg_rating_expression(cls):
+        return case((cls.review_count > 0, cast(cls.rating_sum, Float) / cls.review_count), else_=None)
+
     def __repr__(self):
         return f"<Book {self.title}>"
 
@@ -76,6 +135,22 @@ class BookTag(Base):
     book_uid: Mapped[UUID] = mapped_column(ForeignKey("books.uid", ondelete="CASCADE"), primary_key=True)
     tag_uid: Mapped[UUID] = mapped_column(ForeignKey("tags.uid", ondelete="CASCADE"), primary_key=True)
 
+    __table_args__ = (Index("ix_book_tags_tag_uid", "tag_uid"),)
+
+
+class BookSimilarity(Base):
+    """Precomputed nearest neighbors of a book by tag similarity, rebuilt by a batch job."""
+
+    __tablename__ = "book_similarities"
+    book_uid: Mapped[UUID] = mapped_column(ForeignKey("books.uid", ondelete="CASCADE"), primary_key=True)
+    similar_book_uid: Mapped[UUID] = mapped_column(ForeignKey("books.uid", ondelete="CASCADE"), primary_key=True)
+    score: Mapped[float]
+
+    __table_args__ = (
+        Index("ix_book_similarities_book_uid_score", "book_uid", "score"),
+        Index("ix_book_similarities_similar_book_uid", "similar_book_uid"),
+    )
+
 
 class Review(Base):
     __tablename__ = "reviews"
@@ -85,10 +160,103 @@ class Review(Base):
     created_at: Mapped[datetime] = mapped_column(server_default=func.now())
     updated_at: Mapped[datetime] = mapped_column(server_default=func.now(), onupdate=func.now())
     user_uid: Mapped[Optional[UUID]] = mapped_column(ForeignKey("users.uid"), nullable=True)
-    book_uid: Mapped[Optional[UUID]] = mapped_column(ForeignKey("books.uid"), nullable=True)
+    book_uid: Mapped[Optional[UUID]] = mapped_column(ForeignKey("books.uid", ondelete="SET NULL"), nullable=True)
+    version: Mapped[int] = mapped_column(default=1, server_default="1")
+    moderation_status: Mapped[ModerationStatus] = mapped_column(
+        String(16), default=ModerationStatus.PENDING, server_default=ModerationStatus.PENDING
+    )
 
     user: Mapped[Optional[User]] = relationship(back_populates="reviews")
     book: Mapped[Optional[Book]] = relationship(back_populates="reviews")
 
+    # Keyset pages of the review listing, newest first, per book, per user and over all reviews; rating
+    # filters are applied to the rows of these range scans
+    __table_args__ = (
+        Index("ix_reviews_book_uid_created_at_uid", "book_uid", "created_at", "uid"),
+        Index("ix_reviews_user_uid_created_at_uid", "user_uid", "created_at", "uid"),
+        Index("ix_reviews_created_at_uid", "created_at", "uid"),
+        # One review per user and book, the conflict target of the review upsert. Reviews of deleted
+        # books have no book and never conflict, as NULLs are distinct.
+        UniqueConstraint("user_uid", "book_uid", name="uq_reviews_user_uid_book_uid"),
+        # The moderation queue: pending reviews, oldest first
+        Index("ix_reviews_moderation_status_created_at", "moderation_status", "created_at"),
+    )
+
     def __repr__(self):
         return f"<Review for book {self.book_uid} by user {self.user_uid}>"
+
+
+class BookRatingCount(Base):
+    """Number of reviews of a book with a given rating, maintained with upserts in the review transactions."""
+
+    __tablename__ = "book_rating_counts"
+    book_uid: Mapped[UUID] = mapped_column(ForeignKey("books.uid", ondelete="CASCADE"), primary_key=True)
+    rating: Mapped[int] = mapped_column(SmallInteger(), primary_key=True)
+    count: Mapped[int] = mapped_column(default=0, server_default="0")
+
+
+# Full-text search over title, author and publisher. These objects live outside the ORM mapping because
+# they are dialect specific: Postgres gets a generated tsvector column with a GIN index, SQLite gets an
+# external content FTS5 table kept in sync by triggers (run "INSERT INTO books_fts(books_fts) VALUES('rebuild')"
+# after a VACUUM, which may renumber the rowids it points to).
+for statement in (
+    """
+    ALTER TABLE books ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(author, '')), 'B') ||
+        setweight(to_tsvector('simple', coalesce(publisher, '')), 'C')
+    ) STORED
+    """,
+    "CREATE INDEX ix_books_search_vector ON books USING GIN (search_vector)",
+):
+    event.listen(Book.__table__, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+
+for statement in (
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+        title, author, publisher, content='books', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS books_fts_ai AFTER INSERT ON books BEGIN
+        INSERT INTO books_fts(rowid, title, author, publisher) VALUES (new.rowid, new.title, new.author, new.publisher);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS books_fts_ad AFTER DELETE ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, title, author, publisher)
+        VALUES ('delete', old.rowid, old.title, old.author, old.publisher);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS books_fts_au AFTER UPDATE OF title, author, publisher ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, title, author, publisher)
+        VALUES ('delete', old.rowid, old.title, old.author, old.publisher);
+        INSERT INTO books_fts(rowid, title, author, publisher) VALUES (new.rowid, new.title, new.author, new.publisher);
+    END
+    """,
+):
+    event.listen(Book.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+event.listen(Book.__table__, "before_drop", DDL("DROP TABLE IF EXISTS books_fts").execute_if(dialect="sqlite"))
+
+# Row counters for cheap estimated totals on SQLite, which has no statistics like Postgres' pg_class.reltuples.
+# Each counted table keeps its row in "row_counts" up to date with insert and delete triggers.
+for counted_table in (Book.__table__, Review.__table__):
+    name = counted_table.name
+    for statement in (
+        "CREATE TABLE IF NOT EXISTS row_counts (table_name VARCHAR(64) PRIMARY KEY, row_count INTEGER NOT NULL)",
+        f"INSERT OR REPLACE INTO row_counts (table_name, row_count) SELECT '{name}', count(*) FROM {name}",
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {name}_count_ai AFTER INSERT ON {name} BEGIN
+            UPDATE row_counts SET row_count = row_count + 1 WHERE table_name = '{name}';
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {name}_count_ad AFTER DELETE ON {name} BEGIN
+            UPDATE row_counts SET row_count = row_count - 1 WHERE table_name = '{name}';
+        END
+        """,
+    ):
+        event.listen(counted_table, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+    event.listen(counted_table, "before_drop", DDL("DROP TABLE IF EXISTS row_counts").execute_if(dialect="sqlite"))
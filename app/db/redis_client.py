@@ -19,6 +19,11 @@ async def init_redis():
         token_blocklist = None
 
 
+def get_redis_client() -> redis.Redis | None:
+    """Get the shared Redis client, or None when Redis is disabled or unreachable."""
+    return token_blocklist
+
+
 async def add_jti_to_blocklist(jti: str) -> None:
     if token_blocklist:
         try:
@@ -62,6 +62,42 @@ class UserNotFound(BooklyException):
     """User Not found"""
 
 
+class InvalidCursor(BooklyException):
+    """User has provided a malformed pagination cursor"""
+
+
+class InvalidFields(BooklyException):
+    """User has requested fields that are not part of the resource"""
+
+
+class InvalidImportFile(BooklyException):
+    """User has uploaded an import file that cannot be parsed"""
+
+
+class UnsupportedImportFormat(BooklyException):
+    """User has uploaded an import file in a format that is not supported"""
+
+
+class VersionConflict(BooklyException):
+    """User has tried to update a resource that was changed since they read it"""
+
+
+class CoverNotFound(BooklyException):
+    """User has requested a cover, or a size of it, that does not exist"""
+
+
+class UnsupportedCoverFormat(BooklyException):
+    """User has uploaded a cover that is not a JPEG, PNG or WebP image"""
+
+
+class CoverTooLarge(BooklyException):
+    """User has uploaded a cover larger than COVER_MAX_BYTES"""
+
+
+class DuplicateBook(BooklyException):
+    """User has tried to create a book that looks like one already in the catalog"""
+
+
 class AccountNotVerified(Exception):
     """Account not yet verified"""
 
@@ -108,6 +144,51 @@ def register_all_errors(app: FastAPI):
         ),
     )
 
+    app.add_exception_handler(
+        InvalidCursor,
+        create_exception_handler(
+            content={
+                "detail": "Invalid pagination cursor",
+                "error_code": "invalid_cursor",
+            },
+            status_code=status.HTTP_400_BAD_REQUEST,
+        ),
+    )
+
+    app.add_exception_handler(
+        InvalidFields,
+        create_exception_handler(
+            content={
+                "detail": "Invalid fields requested",
+                "error_code": "invalid_fields",
+            },
+            status_code=status.HTTP_400_BAD_REQUEST,
+        ),
+    )
+
+    app.add_exception_handler(
+        InvalidImportFile,
+        create_exception_handler(
+            content={
+                "detail": "Import file could not be parsed",
+                "error_code": "invalid_import_file",
+            },
+            status_code=status.HTTP_400_BAD_REQUEST,
+        ),
+    )
+
+    app.add_exception_handler(
+        UnsupportedImportFormat,
+        create_exception_handler(
+            content={
+                "detail": "Unsupported import format",
+                "error_code": "unsupported_import_format",
+                "resolution": "Upload the file as text/csv or application/x-ndjson",
+            },
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+        ),
+    )
+
     app.add_exception_handler(
         InvalidCredentials,
         create_exception_handler(
@@ -284,6 +365,63 @@ def register_all_errors(app: FastAPI):
         ),
     )
 
+    app.add_exception_handler(
+        VersionConflict,
+        create_exception_handler(
+            content={
+                "detail": "The resource was modified by another request",
+                "error_code": "version_conflict",
+                "resolution": "Fetch the latest version and retry the update",
+            },
+            status_code=status.HTTP_409_CONFLICT,
+        ),
+    )
+
+    app.add_exception_handler(
+        CoverNotFound,
+        create_exception_handler(
+            content={
+                "detail": "Cover not found",
+                "error_code": "cover_not_found",
+            },
+            status_code=status.HTTP_404_NOT_FOUND,
+        ),
+    )
+
+    app.add_exception_handler(
+        UnsupportedCoverFormat,
+        create_exception_handler(
+            content={
+                "detail": "Unsupported cover format",
+                "error_code": "unsupported_cover_format",
+                "resolution": "Upload the image as image/jpeg, image/png or image/webp",
+            },
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+        ),
+    )
+
+    app.add_exception_handler(
+        CoverTooLarge,
+        create_exception_handler(
+            content={
+                "detail": "Cover image is too large",
+                "error_code": "cover_too_large",
+            },
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        ),
+    )
+
+    app.add_exception_handler(
+        DuplicateBook,
+        create_exception_handler(
+            content={
+                "detail": "A book with a very similar title and author already exists",
+                "error_code": "duplicate_book",
+            },
+            status_code=status.HTTP_409_CONFLICT,
+        ),
+    )
+
     @app.exception_handler(500)
     async def internal_server_error(request, exc):
         return JSONResponse(
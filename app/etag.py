@@ -0,0 +1,38 @@
+import hashlib
+from typing import Any
+
+from fastapi import Request, Response, status
+
+
+def make_etag(*parts: Any) -> str:
+    """Build a strong ETag from the values that determine a representation."""
+    digest = hashlib.blake2b("\x1f".join(map(str, parts)).encode(), digest_size=16).hexdigest()
+    return f'"{digest}"'
+
+
+def page_etag(page: dict, *parts: Any) -> str:
+    """Build an ETag for a page of a list endpoint.
+
+    The fingerprint is taken from the raw column values of the items, which is much cheaper than
+    serializing them, so a matching `If-None-Match` can be answered without building the body.
+    """
+    fingerprint = []
+    for item in page["items"]:
+        if isinstance(item, dict):
+            fingerprint.extend(item.values())
+        else:
+            fingerprint.extend(getattr(item, column.key) for column in item.__table__.columns)
+    return make_etag(*parts, page["next_cursor"], *fingerprint)
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether the request's `If-None-Match` header matches the current ETag."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    candidates = [candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
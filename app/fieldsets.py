@@ -0,0 +1,44 @@
+from typing import Annotated, Any, Optional
+
+from fastapi import Query
+from pydantic import BaseModel, create_model
+from sqlalchemy import Select, select
+
+from app.errors import InvalidFields
+
+FieldsQuery = Annotated[
+    Optional[str], Query(description="Comma-separated list of fields to return, e.g. `uid,title,author`")
+]
+
+
+class FieldsParams(BaseModel):
+    """Sparse fieldset query parameter, for list endpoints that take their query parameters as a model."""
+
+    fields: Optional[str] = None
+
+
+def parse_fields(fields: Optional[str], schema: type[BaseModel]) -> Optional[list[str]]:
+    """Validate a comma-separated field list against the fields of the response schema."""
+    if fields is None:
+        return None
+    names = list(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+    if not names or any(name not in schema.model_fields for name in names):
+        raise InvalidFields()
+    return names
+
+
+def partial_model(schema: type[BaseModel]) -> type[BaseModel]:
+    """Build a copy of a response schema where every field is optional.
+
+    Used as the response model of endpoints supporting sparse fieldsets, together with
+    `response_model_exclude_unset=True` so that fields which were not selected are left out.
+    """
+    fields: dict[str, Any] = {name: (Optional[info.annotation], None) for name, info in schema.model_fields.items()}
+    return create_model(f"{schema.__name__}Fields", **fields)
+
+
+def select_fields(model: Any, fields: Optional[list[str]]) -> Select:
+    """Select whole entities, or only the requested columns when a fieldset is given."""
+    if fields is None:
+        return select(model)
+    return select(*(getattr(model, name).label(name) for name in fields))
@@ -0,0 +1,34 @@
+import argparse
+import asyncio
+from collections.abc import AsyncIterator
+
+import anyio
+
+from app.books.importer import iter_import_records, iter_lines
+from app.db.main import async_session
+from app.reviews.service import ReviewService
+
+READ_SIZE = 64 * 1024
+
+
+async def read_chunks(path: str) -> AsyncIterator[bytes]:
+    async with await anyio.open_file(path, "rb") as file:
+        while chunk := await file.read(READ_SIZE):
+            yield chunk
+
+
+async def main(path: str) -> None:
+    print(f"Importing reviews from {path}...")
+    content_type = "text/csv" if path.endswith(".csv") else "application/x-ndjson"
+    records = iter_import_records(content_type, iter_lines(read_chunks(path)))
+    async with async_session() as session:
+        report = await ReviewService().import_reviews(records, session)
+    for error in report["errors"]:
+        print(f"Line {error['line']}: {error['errors']}")
+    print(f"Processed {report['processed']} records: {report['created']} created, {report['failed']} failed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import legacy reviews from a CSV (with a header row) or NDJSON file")
+    parser.add_argument("path")
+    asyncio.run(main(parser.parse_args().path))
@@ -1,10 +1,17 @@
+import asyncio
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 from loguru import logger
 
+from app.books.autocomplete import autocomplete_index
+from app.books.covers import shutdown_thumbnail_executor
+from app.books.duplicates import duplicate_index
+from app.books.leaderboard import leaderboard
+from app.books.similarity import rebuild_similarities_periodically
 from app.config import Config
-from app.db.main import init_db
+from app.db.main import async_session, engine, init_db
+from app.reviews.moderation import moderation_worker
 
 if Config.USE_REDIS:
     from app.db.redis_client import init_redis
@@ -16,5 +23,22 @@ async def lifespan(app: FastAPI):
     await init_db()
     if Config.USE_REDIS:
         await init_redis()
+    async with async_session() as session:
+        await leaderboard.rebuild(session)
+        await autocomplete_index.load(session)
+        await duplicate_index.load(session)
+    # With Celery the rebuild is scheduled by celery beat instead
+    rebuild_task = None
+    if not Config.USE_CELERY and Config.SIMILARITY_REBUILD_INTERVAL_SECONDS > 0:
+        rebuild_task = asyncio.create_task(rebuild_similarities_periodically(engine))
+    # With Celery reviews are moderated by tasks queued on write and by celery beat
+    moderation_task = None if Config.USE_CELERY else asyncio.create_task(moderation_worker.run(engine))
     yield
+    if rebuild_task is not None:
+        rebuild_task.cancel()
+    if moderation_task is not None:
+        moderation_task.cancel()
+    async with async_session() as session:
+        await duplicate_index.dump(session)
+    shutdown_thumbnail_executor()
     logger.info("Running lifespan after the application shutdown!")
@@ -52,6 +52,7 @@ def register_middleware(app: FastAPI):
         allow_origins=["*"],
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["ETag", "X-Total-Count"],
         allow_credentials=True,
     )
 
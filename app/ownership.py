@@ -0,0 +1,36 @@
+from typing import ClassVar, NoReturn
+from uuid import UUID
+
+from sqlalchemy import ColumnElement, true
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import Base, Role, User
+from app.errors import BooklyException, InsufficientPermission, VersionConflict
+
+
+class OwnedRowsMixin:
+    """Permission checks of a service whose rows belong to the user in their `user_uid` column.
+
+    Writes are scoped with `_owned_by` in their WHERE clause, so a single statement both checks and
+    applies them; when it matches no row, `_raise_write_error` finds out why.
+    """
+
+    model: ClassVar[type[Base]]
+    not_found: ClassVar[type[BooklyException]]
+
+    async def _check_permission(self, row: Base, user: User) -> None:
+        """Raise if the user is not the owner and not admin."""
+        if row.user_uid != user.uid and user.role != Role.ADMIN:
+            raise InsufficientPermission()
+
+    def _owned_by(self, user: User) -> ColumnElement[bool]:
+        """Restrict a write to the rows the user may change."""
+        return true() if user.role == Role.ADMIN else self.model.user_uid == user.uid
+
+    async def _raise_write_error(self, uid: UUID, user: User, session: AsyncSession) -> NoReturn:
+        """Explain why a scoped write matched no row; only runs on the failure path."""
+        row = await session.get(self.model, uid)
+        if row is None:
+            raise self.not_found()
+        await self._check_permission(row, user)
+        raise VersionConflict()
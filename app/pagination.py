@@ -0,0 +1,190 @@
+import base64
+import binascii
+import hashlib
+import json
+from datetime import date, datetime
+from typing import Annotated, Any, Generic, Literal, Optional, TypeVar
+from uuid import UUID
+
+from fastapi import Query
+from pydantic import BaseModel, Field
+from sqlalchemy import Select, func, select, text, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import InstrumentedAttribute
+
+from app.cache import cache_get, cache_set
+from app.errors import InvalidCursor
+
+T = TypeVar("T")
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+LimitQuery = Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE, description="Maximum number of items to return")]
+CursorQuery = Annotated[
+    Optional[str], Query(description="Opaque cursor returned as `next_cursor` by the previous page")
+]
+
+CountMode = Literal["exact", "estimated"]
+CountQuery = Annotated[
+    Optional[CountMode],
+    Query(description="Return the total number of matching items in `X-Total-Count`, exactly or as an estimate"),
+]
+
+
+class PageParams(BaseModel):
+    """Pagination query parameters, for list endpoints that take their query parameters as a model."""
+
+    cursor: Optional[str] = None
+    limit: Annotated[int, Field(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE
+
+
+class CountParams(BaseModel):
+    """Total count query parameter, for list endpoints that take their query parameters as a model."""
+
+    count: Optional[CountMode] = None
+
+
+class Page(BaseModel, Generic[T]):
+    items: list[T]
+    next_cursor: Optional[str] = None
+
+
+def encode_cursor(*values: Any) -> str:
+    """Encode the sort key of the last row of a page into an opaque cursor."""
+    payload = json.dumps([str(value) for value in values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int) -> list[str]:
+    """Decode a cursor created by `encode_cursor`, raising `InvalidCursor` if it has been tampered with."""
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(payload)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor()
+    if not isinstance(values, list) or len(values) != size or not all(isinstance(v, str) for v in values):
+        raise InvalidCursor()
+    return values
+
+
+def _coerce(column: InstrumentedAttribute, value: str) -> Any:
+    python_type = column.type.python_type
+    try:
+        if python_type is datetime:
+            return datetime.fromisoformat(value)
+        if python_type is date:
+            return date.fromisoformat(value)
+        if python_type is UUID:
+            return UUID(value)
+        return python_type(value)
+    except ValueError:
+        raise InvalidCursor()
+
+
+async def paginate(
+    session: AsyncSession,
+    statement: Select,
+    model: Any,
+    cursor: Optional[str],
+    limit: int,
+    sort: str = "-created_at",
+    fields: Optional[list[str]] = None,
+) -> dict:
+    """Run a keyset-paginated query ordered by `sort` and then `uid`.
+
+    `sort` is a column name, prefixed with `-` for descending order. Rows are compared against the
+    cursor with a row-value comparison so that every page is a range scan over the matching composite
+    index instead of an OFFSET over the whole table.
+
+    When `fields` is given the statement selects plain columns and the items are returned as dicts
+    holding only those fields.
+    """
+    descending = sort.startswith("-")
+    sort_key = sort.lstrip("-")
+    key_columns = (getattr(model, sort_key), model.uid)
+    if cursor is not None:
+        cursor_sort, *values = decode_cursor(cursor, len(key_columns) + 1)
+        if cursor_sort != sort:
+            raise InvalidCursor()
+        bounds = tuple(_coerce(column, value) for column, value in zip(key_columns, values))
+        if descending:
+            statement = statement.where(tuple_(*key_columns) < bounds)
+        else:
+            statement = statement.where(tuple_(*key_columns) > bounds)
+    if fields is not None:
+        statement = statement.add_columns(*(column for column in key_columns if column.key not in fields))
+    order_by = [column.desc() if descending else column.asc() for column in key_columns]
+    statement = statement.order_by(*order_by).limit(limit + 1)
+
+    result = await session.execute(statement)
+    rows = list(result.scalars().all() if fields is None else result.mappings().all())
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        key_values = (getattr(last, column.key) if fields is None else last[column.key] for column in key_columns)
+        next_cursor = encode_cursor(sort, *key_values)
+    items = rows if fields is None else [{name: row[name] for name in fields} for row in rows]
+    return {"items": items, "next_cursor": next_cursor}
+
+
+async def paginate_ranked(session: AsyncSession, statement: Select, cursor: Optional[str], limit: int) -> dict:
+    """Paginate a relevance ranked query.
+
+    Relevance scores have no stable tie-breaking key to seek on, so the cursor carries the offset of the
+    next page. Ranked results are only ever browsed a few pages deep, which keeps the OFFSET cheap.
+    """
+    offset = 0
+    if cursor is not None:
+        (value,) = decode_cursor(cursor, 1)
+        if not value.isdigit():
+            raise InvalidCursor()
+        offset = int(value)
+
+    result = await session.execute(statement.offset(offset).limit(limit + 1))
+    items = list(result.scalars().all())
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(offset + limit)
+    return {"items": items, "next_cursor": next_cursor}
+
+
+async def estimate_rows(session: AsyncSession, table_name: str) -> Optional[int]:
+    """Estimate the number of rows of a table without scanning it, or None when no estimate is available.
+
+    Postgres keeps an estimate in its planner statistics; SQLite reads the counters maintained by triggers.
+    """
+    dialect = session.bind.dialect.name
+    if dialect == "postgresql":
+        statement = text("SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:name AS regclass)")
+    elif dialect == "sqlite":
+        statement = text("SELECT row_count FROM row_counts WHERE table_name = :name")
+    else:
+        return None
+    estimate = (await session.execute(statement, {"name": table_name})).scalar_one_or_none()
+    # reltuples is -1 until the table has been vacuumed or analyzed for the first time
+    return estimate if estimate is not None and estimate >= 0 else None
+
+
+async def count_rows(session: AsyncSession, statement: Select, mode: CountMode, table_name: str) -> int:
+    """Count the rows matched by a list query.
+
+    Unfiltered queries in `estimated` mode use `estimate_rows`. Everything else is counted exactly and
+    cached under the table's namespace, which writes to that table invalidate.
+    """
+    if mode == "estimated" and statement.whereclause is None:
+        estimate = await estimate_rows(session, table_name)
+        if estimate is not None:
+            return estimate
+
+    compiled = statement.compile(session.bind)
+    fingerprint = json.dumps([str(compiled), sorted(compiled.params.items())], default=str)
+    key = "count:" + hashlib.blake2b(fingerprint.encode(), digest_size=16).hexdigest()
+    total = await cache_get(table_name, key)
+    if total is None:
+        count_statement = select(func.count()).select_from(statement.order_by(None).subquery())
+        total = (await session.execute(count_statement)).scalar_one()
+        await cache_set(table_name, key, total)
+    return total
@@ -5,6 +5,7 @@ from uuid import uuid4
 from app.auth.utils import hash_password
 from app.db.main import async_session
 from app.db.models import Book, BookTag, Review, Role, Tag, User
+from app.reviews.service import ReviewService
 
 
 async def main() -> None:
@@ -303,6 +304,7 @@ async def main() -> None:
 
         session.add_all(reviews)
         await session.commit()
+        await ReviewService().rebuild_book_ratings(session)
         print("Successfully Done!")
 
 
@@ -0,0 +1,15 @@
+import asyncio
+
+from app.db.main import async_session
+from app.reviews.service import ReviewService
+
+
+async def main() -> None:
+    print("Rebuilding book ratings...")
+    async with async_session() as session:
+        await ReviewService().rebuild_book_ratings(session)
+    print("Successfully Done!")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
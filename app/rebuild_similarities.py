@@ -0,0 +1,15 @@
+import asyncio
+
+from app.books.similarity import rebuild_similarities
+from app.db.main import async_session
+
+
+async def main() -> None:
+    print("Rebuilding similar books...")
+    async with async_session() as session:
+        await rebuild_similarities(session)
+    print("Successfully Done!")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,153 @@
+import asyncio
+import re
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from importlib import import_module
+from typing import Optional
+
+import numpy as np
+from loguru import logger
+from sqlalchemy import bindparam, func, select, update
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from app.books.autocomplete import normalize
+from app.config import Config
+from app.db.models import ModerationStatus, Review
+
+URL_TOKEN = "<url>"
+_TOKEN_PATTERN = re.compile(r"https?://\S+|www\.\S+|\w+")
+
+
+class ModerationScorer(ABC):
+    """Scores review texts from 0 (clean) to 1 (spam or abuse).
+
+    A whole batch is scored at once, so implementations can vectorize the work or send a single request
+    to an external classifier.
+    """
+
+    @abstractmethod
+    def score(self, texts: list[str]) -> np.ndarray:
+        """Score every text of the batch, in order."""
+
+
+class TermScorer(ModerationScorer):
+    """Weighted single word blocklist, with every link counted as the `<url>` term.
+
+    The tokens of the whole batch are matched against the sorted terms with one `searchsorted`, and the
+    weights of the matches are summed per review with one `bincount`.
+    """
+
+    def __init__(self, terms: Optional[dict[str, float]] = None) -> None:
+        terms = Config.MODERATION_BLOCKED_TERMS if terms is None else terms
+        normalized = {URL_TOKEN if term == URL_TOKEN else normalize(term): weight for term, weight in terms.items()}
+        self.terms = np.array(sorted(normalized), dtype=str)
+        self.weights = np.array([normalized[term] for term in self.terms], dtype=np.float64)
+
+    @staticmethod
+    def _tokens(text: str) -> list[str]:
+        tokens = _TOKEN_PATTERN.findall(normalize(text))
+        return [URL_TOKEN if token.startswith(("http", "www.")) else token for token in tokens]
+
+    def score(self, texts: list[str]) -> np.ndarray:
+        if not len(self.terms):
+            return np.zeros(len(texts))
+        tokenized = [self._tokens(text) for text in texts]
+        tokens = np.array([token for text_tokens in tokenized for token in text_tokens], dtype=str)
+        review_indices = np.repeat(np.arange(len(texts)), [len(text_tokens) for text_tokens in tokenized])
+        positions = np.searchsorted(self.terms, tokens).clip(max=len(self.terms) - 1)
+        hits = np.where(self.terms[positions] == tokens, self.weights[positions], 0.0)
+        totals = np.bincount(review_indices, weights=hits, minlength=len(texts))
+        # Saturate the summed weights into [0, 1): a weight of 1 scores 0.63, two such terms 0.86
+        return 1 - np.exp(-totals)
+
+
+@lru_cache
+def get_scorer() -> ModerationScorer:
+    """Instantiate the scorer class named by the MODERATION_SCORER dotted path."""
+    module_name, class_name = Config.MODERATION_SCORER.rsplit(".", 1)
+    return getattr(import_module(module_name), class_name)()
+
+
+async def moderate_pending_reviews(session: AsyncSession) -> int:
+    """Score one batch of pending reviews, oldest first, and publish their status; returns the batch size.
+
+    Concurrent workers skip the rows locked by each other on Postgres. A review edited while its batch
+    was scored keeps its pending status, as its version no longer matches, and is scored again later.
+    The version is left alone so moderation never fails an edit made with the version read before it;
+    `updated_at` moves, as the status is part of the review.
+    """
+    statement = (
+        select(Review.uid, Review.version, Review.review_text)
+        .where(Review.moderation_status == ModerationStatus.PENDING)
+        .order_by(Review.created_at, Review.uid)
+        .limit(Config.MODERATION_BATCH_SIZE)
+        .with_for_update(skip_locked=True)
+    )
+    rows = (await session.execute(statement)).all()
+    if not rows:
+        return 0
+    # Scoring is CPU bound, so it runs off the event loop
+    scores = await asyncio.to_thread(get_scorer().score, [row.review_text for row in rows])
+
+    reviews = Review.__table__
+    statement = (
+        update(reviews)
+        .where(reviews.c.uid == bindparam("review_uid"), reviews.c.version == bindparam("review_version"))
+        .values(moderation_status=bindparam("status"), updated_at=func.now())
+    )
+    rejected = scores >= Config.MODERATION_REJECT_THRESHOLD
+    params = [
+        {
+            "review_uid": row.uid,
+            "review_version": row.version,
+            "status": ModerationStatus.REJECTED if is_rejected else ModerationStatus.APPROVED,
+        }
+        for row, is_rejected in zip(rows, rejected)
+    ]
+    await (await session.connection()).execute(statement, params)
+    await session.commit()
+    return len(rows)
+
+
+async def moderate_reviews(session: AsyncSession) -> int:
+    """Score batches until the queue is empty; returns the number of reviews scored."""
+    total = 0
+    while count := await moderate_pending_reviews(session):
+        total += count
+        if count < Config.MODERATION_BATCH_SIZE:
+            break
+    if total:
+        logger.info(f"Moderated {total} reviews")
+    return total
+
+
+class ModerationWorker:
+    """In-process consumer of the moderation queue, used when Celery is off.
+
+    Review writes wake it up with `notify`; it also drains the queue every MODERATION_POLL_SECONDS to
+    pick up reviews written by other processes, unless polling is disabled with `0`.
+    """
+
+    def __init__(self) -> None:
+        self._wakeup = asyncio.Event()
+
+    def notify(self) -> None:
+        self._wakeup.set()
+
+    async def run(self, bind: AsyncEngine) -> None:
+        """Drain the queue whenever notified, until cancelled."""
+        while True:
+            self._wakeup.clear()
+            try:
+                async with AsyncSession(bind) as session:
+                    await moderate_reviews(session)
+            except Exception:
+                logger.exception("Failed to moderate reviews")
+            poll_seconds = Config.MODERATION_POLL_SECONDS if Config.MODERATION_POLL_SECONDS > 0 else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), poll_seconds)
+            except TimeoutError:
+                pass
+
+
+moderation_worker = ModerationWorker()
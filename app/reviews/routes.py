@@ -1,20 +1,65 @@
+from typing import Annotated
 from uuid import UUID
 
-from fastapi import APIRouter, status
+from fastapi import APIRouter, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
 
-from app.auth.dependencies import CurrentUserDep
+from app.auth.dependencies import AdminRoleCheckerDep, CurrentUserDep
+from app.books.importer import iter_import_records, iter_lines
+from app.celery_tasks import ModerationTaskService
 from app.db.main import SessionDep
+from app.fieldsets import parse_fields
+from app.pagination import DEFAULT_PAGE_SIZE, CountQuery, CursorQuery, LimitQuery, Page
 
-from .schemas import ReviewCreate, ReviewPublic, ReviewUpdate
+from .schemas import (
+    ReviewCreate,
+    ReviewImportResult,
+    ReviewListParams,
+    ReviewPublic,
+    ReviewPublicFields,
+    ReviewUpdate,
+)
 from .service import ReviewService
 
 review_router = APIRouter()
 review_service = ReviewService()
+moderation_task_service = ModerationTaskService()
 
 
-@review_router.get("/", response_model=list[ReviewPublic])
-async def get_all_reviews(session: SessionDep):
-    return await review_service.get_all_reviews(session)
+@review_router.get("/", response_model=Page[ReviewPublicFields], response_model_exclude_unset=True)
+async def get_all_reviews(params: Annotated[ReviewListParams, Query()], response: Response, session: SessionDep):
+    page = await review_service.get_all_reviews(params, parse_fields(params.fields, ReviewPublic), session)
+    if params.count is not None:
+        response.headers["X-Total-Count"] = str(await review_service.count_reviews(params, params.count, session))
+    return page
+
+
+@review_router.get("/export", response_class=StreamingResponse)
+async def export_reviews(session: SessionDep):
+    """Export all reviews as NDJSON, one `ReviewPublic` object per line."""
+    return StreamingResponse(review_service.export_reviews(session.bind), media_type="application/x-ndjson")
+
+
+@review_router.post(
+    "/bulk",
+    response_model=ReviewImportResult,
+    dependencies=[AdminRoleCheckerDep],
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "text/csv": {"schema": {"type": "string"}},
+                "application/x-ndjson": {"schema": {"type": "string"}},
+            },
+        }
+    },
+)
+async def import_reviews(request: Request, session: SessionDep):
+    """Stream a CSV (with a header row) or NDJSON file of legacy reviews into the database."""
+    records = iter_import_records(request.headers.get("content-type", ""), iter_lines(request.stream()))
+    result = await review_service.import_reviews(records, session)
+    await moderation_task_service.queue_reviews()
+    return result
 
 
 @review_router.get("/{review_uid}", response_model=ReviewPublic)
@@ -22,18 +67,38 @@ async def get_review(review_uid: UUID, session: SessionDep):
     return await review_service.get_review(review_uid, session)
 
 
+@review_router.get("/book/{book_uid}", response_model=Page[ReviewPublic])
+async def get_book_reviews(
+    book_uid: UUID,
+    response: Response,
+    session: SessionDep,
+    cursor: CursorQuery = None,
+    limit: LimitQuery = DEFAULT_PAGE_SIZE,
+    count: CountQuery = None,
+):
+    page = await review_service.get_book_reviews(book_uid, cursor, limit, session)
+    if count is not None:
+        response.headers["X-Total-Count"] = str(await review_service.count_book_reviews(book_uid, count, session))
+    return page
+
+
 @review_router.post("/book/{book_uid}", response_model=ReviewPublic, status_code=status.HTTP_201_CREATED)
 async def add_review_to_book(
     book_uid: UUID, review_data: ReviewCreate, current_user: CurrentUserDep, session: SessionDep
 ):
-    return await review_service.add_review_to_book(book_uid, review_data, current_user, session)
+    review = await review_service.add_review_to_book(book_uid, review_data, current_user, session)
+    await moderation_task_service.queue_reviews()
+    return review
 
 
 @review_router.put("/{review_uid}", response_model=ReviewPublic)
 async def update_review(
     review_uid: UUID, review_update_data: ReviewUpdate, current_user: CurrentUserDep, session: SessionDep
 ):
-    return await review_service.update_review(review_uid, review_update_data, current_user, session)
+    review = await review_service.update_review(review_uid, review_update_data, current_user, session)
+    if review_update_data.review_text is not None:
+        await moderation_task_service.queue_reviews()
+    return review
 
 
 @review_router.delete("/{review_uid}", status_code=status.HTTP_204_NO_CONTENT)
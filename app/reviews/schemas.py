@@ -1,8 +1,12 @@
-from datetime import datetime
-from typing import Annotated, Optional
+from datetime import datetime, timezone
+from typing import Annotated, Any, Optional
 from uuid import UUID
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
+
+from app.db.models import ModerationStatus
+from app.fieldsets import FieldsParams, partial_model
+from app.pagination import CountParams, PageParams
 
 
 class ReviewPublic(BaseModel):
@@ -13,6 +17,11 @@ class ReviewPublic(BaseModel):
     book_uid: Optional[UUID]
     created_at: datetime
     updated_at: datetime
+    version: int = 1
+    moderation_status: ModerationStatus = ModerationStatus.PENDING
+
+
+ReviewPublicFields = partial_model(ReviewPublic)
 
 
 class ReviewCreate(BaseModel):
@@ -20,6 +29,54 @@ class ReviewCreate(BaseModel):
     review_text: str
 
 
+class ReviewImport(BaseModel):
+    """A review migrated from another system, keeping its references and original date."""
+
+    rating: Annotated[int, Field(ge=0, le=5)]
+    review_text: Annotated[str, Field(min_length=1)]
+    book_uid: UUID
+    user_uid: UUID
+    created_at: Optional[datetime] = None
+
+    @field_validator("created_at", mode="before")
+    @classmethod
+    def empty_created_at(cls, v: Any) -> Any:
+        """An empty CSV cell means no date."""
+        return v or None
+
+    @field_validator("created_at")
+    @classmethod
+    def naive_utc_created_at(cls, v: Optional[datetime]) -> Optional[datetime]:
+        """Timestamps are stored as naive UTC."""
+        if v is not None and v.tzinfo is not None:
+            return v.astimezone(timezone.utc).replace(tzinfo=None)
+        return v
+
+
+class ReviewImportLineError(BaseModel):
+    line: int
+    errors: list[dict[str, Any]]
+
+
+class ReviewImportResult(BaseModel):
+    processed: int
+    created: int
+    failed: int
+    errors: list[ReviewImportLineError]
+
+
 class ReviewUpdate(BaseModel):
     rating: Optional[Annotated[int, Field(ge=0, le=5)]] = None
     review_text: Optional[str] = None
+    version: Optional[int] = None
+
+
+class ReviewFilterParams(BaseModel):
+    book_uid: Optional[UUID] = None
+    user_uid: Optional[UUID] = None
+    min_rating: Optional[Annotated[int, Field(ge=0, le=5)]] = None
+    max_rating: Optional[Annotated[int, Field(ge=0, le=5)]] = None
+
+
+class ReviewListParams(ReviewFilterParams, PageParams, CountParams, FieldsParams):
+    pass
@@ -1,41 +1,331 @@
-from collections.abc import Sequence
-from uuid import UUID
+from collections import Counter
+from collections.abc import AsyncIterator
+from typing import Any, Optional
+from uuid import UUID, uuid4
 
-from sqlalchemy import desc, select
-from sqlalchemy.ext.asyncio import AsyncSession
+from loguru import logger
+from pydantic import ValidationError
+from sqlalchemy import ColumnElement, Row, Select, bindparam, delete, false, func, insert, literal, select, true, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 
-from app.books.service import BookService
-from app.db.models import Review, Role, User
-from app.errors import InsufficientPermission, ReviewNotFound
+from app.books.leaderboard import leaderboard
+from app.books.service import EXPORT_BATCH_SIZE, BookService
+from app.cache import invalidate
+from app.config import Config
+from app.db.main import dialect_insert, snapshot_session
+from app.db.models import Book, BookRatingCount, ModerationStatus, Review, User
+from app.errors import BookNotFound, ReviewNotFound
+from app.fieldsets import select_fields
+from app.ownership import OwnedRowsMixin
+from app.pagination import CountMode, count_rows, paginate
+from app.users.feed import activity_feed
 from app.users.service import UserService
 
-from .schemas import ReviewCreate, ReviewUpdate
+from .schemas import (
+    ReviewCreate,
+    ReviewFilterParams,
+    ReviewImport,
+    ReviewListParams,
+    ReviewPublic,
+    ReviewUpdate,
+)
 
 user_service = UserService()
 book_service = BookService()
 
+UNKNOWN_BOOK_ERROR = {"type": "unknown_book", "msg": "Book not found"}
+UNKNOWN_USER_ERROR = {"type": "unknown_user", "msg": "User not found"}
+DUPLICATE_REVIEW_ERROR = {"type": "duplicate_review", "msg": "The user has already reviewed this book"}
 
-class ReviewService:
-    async def _check_permission(self, review: Review, current_user: User) -> None:
-        """Raise if the user is not the owner and not admin."""
-        if review.user_uid != current_user.uid and current_user.role != Role.ADMIN:
-            raise InsufficientPermission()
+
+class ReviewService(OwnedRowsMixin):
+    model = Review
+    not_found = ReviewNotFound
+
+    async def _update_book_rating(
+        self,
+        book_uid: Optional[UUID | ColumnElement],
+        count_delta: int,
+        rating_delta: int | ColumnElement,
+        session: AsyncSession,
+    ) -> Optional[Row[tuple[UUID, int, int]]]:
+        """Atomically shift the denormalized review aggregates of a book, leaving its updated_at untouched.
+
+        Both the book and the rating delta may be SQL expressions, so callers can derive them from the
+        review row inside the same statement instead of reading it first.
+        """
+        if book_uid is None:
+            return None
+        statement = (
+            update(Book)
+            .where(Book.uid == book_uid)
+            .values(
+                review_count=Book.review_count + count_delta,
+                rating_sum=Book.rating_sum + rating_delta,
+                updated_at=Book.updated_at,
+            )
+            .returning(Book.uid, Book.review_count, Book.rating_sum)
+        )
+        result = await session.execute(statement)
+        return result.one_or_none()
+
+    async def _shift_rating_counts(self, rows: Select | list[dict], session: AsyncSession) -> None:
+        """Add to the `(book_uid, rating)` counters of the rating histograms with a single upsert.
+
+        `rows` is a list of `{"book_uid", "rating", "count"}` dicts or a SELECT of those three columns.
+        The addition is done by the database on conflict, so concurrent writes never lose an update.
+        """
+        statement = dialect_insert(session)(BookRatingCount)
+        if isinstance(rows, Select):
+            statement = statement.from_select(["book_uid", "rating", "count"], rows)
+        elif rows:
+            statement = statement.values(rows)
+        else:
+            return
+        statement = statement.on_conflict_do_update(
+            index_elements=[BookRatingCount.book_uid, BookRatingCount.rating],
+            set_={"count": BookRatingCount.count + statement.excluded.count},
+        )
+        await session.execute(statement)
+
+    async def _update_leaderboard(self, aggregates: Optional[Row[tuple[UUID, int, int]]]) -> None:
+        """Re-score a book on the top rated leaderboard after its aggregates were committed."""
+        if aggregates is not None:
+            await leaderboard.update_rating(*aggregates)
+
+    async def rebuild_book_ratings(self, session: AsyncSession) -> None:
+        """Recompute the review aggregates of every book from the reviews table."""
+        review_count = select(func.count(Review.uid)).where(Review.book_uid == Book.uid).scalar_subquery()
+        rating_sum = (
+            select(func.coalesce(func.sum(Review.rating), 0)).where(Review.book_uid == Book.uid).scalar_subquery()
+        )
+        statement = update(Book).values(review_count=review_count, rating_sum=rating_sum, updated_at=Book.updated_at)
+        await session.execute(statement)
+        await session.execute(delete(BookRatingCount))
+        histograms = (
+            select(Review.book_uid, Review.rating, func.count())
+            .where(Review.book_uid.is_not(None))
+            .group_by(Review.book_uid, Review.rating)
+        )
+        await session.execute(insert(BookRatingCount).from_select(["book_uid", "rating", "count"], histograms))
+        await session.commit()
+        await leaderboard.rebuild(session)
 
     async def add_review_to_book(
         self, book_uid: UUID, review_data: ReviewCreate, current_user: User, session: AsyncSession
-    ):
-        book = await book_service.get_book(book_uid=book_uid, session=session)
-        review_data_dict = review_data.model_dump()
-        new_review = Review(**review_data_dict, book=book, user=current_user)
-        session.add(new_review)
+    ) -> Review:
+        """Create the review of the user for a book, or replace it, with one INSERT ... ON CONFLICT DO UPDATE.
+
+        The previous rating is read and locked first, so the aggregates are shifted by the difference. A
+        missing book is reported by the foreign key violation of the insert rather than by a lookup.
+        """
+        scope = (Review.user_uid == current_user.uid, Review.book_uid == book_uid)
+        review = None
+        while review is None:
+            old_rating = await session.scalar(select(Review.rating).where(*scope).with_for_update())
+            statement = dialect_insert(session)(Review).values(
+                uid=uuid4(), **review_data.model_dump(), user_uid=current_user.uid, book_uid=book_uid
+            )
+            statement = statement.on_conflict_do_update(
+                index_elements=[Review.user_uid, Review.book_uid],
+                set_={
+                    "rating": statement.excluded.rating,
+                    "review_text": statement.excluded.review_text,
+                    "updated_at": func.now(),
+                    "version": Review.version + 1,
+                    "moderation_status": ModerationStatus.PENDING,
+                },
+                # A review created concurrently since the read is left alone, and read again by the next pass
+                where=true() if old_rating is not None else false(),
+            )
+            statement = statement.returning(Review).execution_options(populate_existing=True)
+            try:
+                async with session.begin_nested():
+                    review = (await session.execute(statement)).scalar_one_or_none()
+            except IntegrityError:
+                raise BookNotFound()
+
+        rating_counts = Counter({review.rating: 1})
+        if old_rating is None:
+            aggregates = await self._update_book_rating(book_uid, 1, review.rating, session)
+        else:
+            aggregates = await self._update_book_rating(book_uid, 0, review.rating - old_rating, session)
+            rating_counts[old_rating] -= 1
+        await self._shift_rating_counts(
+            [{"book_uid": book_uid, "rating": rating, "count": count} for rating, count in rating_counts.items()],
+            session,
+        )
+        followers = await self._get_feed_followers(review, aggregates, session) if old_rating is None else set()
         await session.commit()
-        return new_review
+        await invalidate("reviews")
+        await self._update_leaderboard(aggregates)
+        if old_rating is None:
+            await leaderboard.record_review(book_uid)
+            await activity_feed.push(followers, (review.created_at, review.uid))
+        return review
 
-    async def get_all_reviews(self, session: AsyncSession) -> Sequence[Review]:
-        """Get all reviews ordered by creation date."""
-        statement = select(Review).order_by(desc(Review.created_at))
-        result = await session.execute(statement)
-        return result.scalars().all()
+    async def _get_feed_followers(
+        self, review: Review, aggregates: Optional[Row[tuple[UUID, int, int]]], session: AsyncSession
+    ) -> set[UUID]:
+        """Users whose feed a new review is pushed to: the owner and the other reviewers of its book.
+
+        Books with FEED_PULL_THRESHOLD reviews or more have no followers here, as feed reads pull their
+        reviews instead; a single write never fans out to more users than that.
+        """
+        if aggregates is None or aggregates.review_count >= Config.FEED_PULL_THRESHOLD:
+            return set()
+        owner = select(Book.user_uid).where(Book.uid == review.book_uid)
+        reviewers = select(Review.user_uid).where(Review.book_uid == review.book_uid)
+        followers = set((await session.scalars(owner.union(reviewers))).all())
+        return followers - {review.user_uid, None}
+
+    async def _shift_book_ratings(self, deltas: dict[UUID, tuple[int, int]], session: AsyncSession) -> list[Row]:
+        """Add `(count, rating sum)` deltas to the aggregates of many books with one executemany UPDATE."""
+        books = Book.__table__
+        statement = (
+            update(books)
+            .where(books.c.uid == bindparam("book_uid"))
+            .values(
+                review_count=books.c.review_count + bindparam("count_delta"),
+                rating_sum=books.c.rating_sum + bindparam("rating_delta"),
+                updated_at=books.c.updated_at,
+            )
+        )
+        params = [
+            {"book_uid": book_uid, "count_delta": count, "rating_delta": rating_sum}
+            for book_uid, (count, rating_sum) in deltas.items()
+        ]
+        await (await session.connection()).execute(statement, params)
+        result = await session.execute(select(Book.uid, Book.review_count, Book.rating_sum).where(Book.uid.in_(deltas)))
+        return list(result)
+
+    async def import_reviews(self, records: AsyncIterator[tuple[int, Any]], session: AsyncSession) -> dict:
+        """Validate and insert a stream of `(line number, record)` pairs of legacy reviews in fixed-size chunks.
+
+        Per chunk, the book and user references are checked with one query per table, the reviews are
+        inserted with one multi-row INSERT and the aggregates of the books they belong to are shifted once,
+        all in a single transaction.
+        """
+        processed = created = failed = 0
+        errors: list[dict] = []
+        chunk: list[tuple[int, ReviewImport]] = []
+
+        def report(line: int, line_errors: list[dict]) -> None:
+            nonlocal failed
+            failed += 1
+            if len(errors) < Config.REVIEW_IMPORT_MAX_ERRORS:
+                errors.append({"line": line, "errors": line_errors})
+
+        async def flush() -> None:
+            nonlocal created
+            book_uids = {review.book_uid for _, review in chunk}
+            user_uids = {review.user_uid for _, review in chunk}
+            known_books = set((await session.scalars(select(Book.uid).where(Book.uid.in_(book_uids)))).all())
+            known_users = set((await session.scalars(select(User.uid).where(User.uid.in_(user_uids)))).all())
+            rows, lines = [], {}
+            for line, review in chunk:
+                if review.book_uid not in known_books:
+                    report(line, [UNKNOWN_BOOK_ERROR])
+                elif review.user_uid not in known_users:
+                    report(line, [UNKNOWN_USER_ERROR])
+                else:
+                    created_at = review.created_at or func.now()
+                    uid = uuid4()
+                    lines[uid] = line
+                    rows.append({**review.model_dump(), "uid": uid, "created_at": created_at, "updated_at": created_at})
+            chunk.clear()
+            if not rows:
+                return
+            # Reviews of a user already reviewing the book, in the database or earlier in the chunk, are skipped
+            statement = dialect_insert(session)(Review).values(rows).on_conflict_do_nothing().returning(Review.uid)
+            inserted = set((await session.scalars(statement)).all())
+            deltas, rating_counts = {}, Counter()
+            for row in rows:
+                if row["uid"] not in inserted:
+                    report(lines[row["uid"]], [DUPLICATE_REVIEW_ERROR])
+                    continue
+                count, rating_sum = deltas.get(row["book_uid"], (0, 0))
+                deltas[row["book_uid"]] = (count + 1, rating_sum + row["rating"])
+                rating_counts[row["book_uid"], row["rating"]] += 1
+            if not inserted:
+                return
+            aggregates = await self._shift_book_ratings(deltas, session)
+            await self._shift_rating_counts(
+                [{"book_uid": uid, "rating": rating, "count": count} for (uid, rating), count in rating_counts.items()],
+                session,
+            )
+            await session.commit()
+            await invalidate("reviews")
+            await leaderboard.update_ratings(aggregates)
+            created += len(inserted)
+            logger.info(f"Review import progress: {processed} records processed, {created} reviews created")
+
+        async for line, record in records:
+            processed += 1
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                review = ReviewImport.model_validate(record)
+            except ValidationError as e:
+                report(line, e.errors(include_url=False, include_context=False))
+                continue
+            except ValueError as e:
+                report(line, [{"type": "parse_error", "msg": str(e)}])
+                continue
+            chunk.append((line, review))
+            if len(chunk) >= Config.REVIEW_IMPORT_CHUNK_SIZE:
+                await flush()
+        if chunk:
+            await flush()
+        # Reference errors are only found when their chunk is flushed, after later parse errors
+        errors.sort(key=lambda error: error["line"])
+        return {"processed": processed, "created": created, "failed": failed, "errors": errors}
+
+    @staticmethod
+    def _apply_filters(statement: Select, filters: ReviewFilterParams) -> Select:
+        """Restrict a reviews query to the given filters."""
+        if filters.book_uid is not None:
+            statement = statement.where(Review.book_uid == filters.book_uid)
+        if filters.user_uid is not None:
+            statement = statement.where(Review.user_uid == filters.user_uid)
+        if filters.min_rating is not None:
+            statement = statement.where(Review.rating >= filters.min_rating)
+        if filters.max_rating is not None:
+            statement = statement.where(Review.rating <= filters.max_rating)
+        return statement
+
+    async def get_all_reviews(
+        self, params: ReviewListParams, fields: Optional[list[str]], session: AsyncSession
+    ) -> dict:
+        """Get a page of the reviews matching the filters, newest first."""
+        statement = self._apply_filters(select_fields(Review, fields), params)
+        return await paginate(session, statement, Review, params.cursor, params.limit, fields=fields)
+
+    async def count_reviews(self, filters: ReviewFilterParams, mode: CountMode, session: AsyncSession) -> int:
+        """Count the reviews matching the filters."""
+        return await count_rows(session, self._apply_filters(select(Review.uid), filters), mode, "reviews")
+
+    async def get_book_reviews(self, book_uid: UUID, cursor: Optional[str], limit: int, session: AsyncSession) -> dict:
+        """Get a page of the reviews of a book, newest first."""
+        await book_service.get_book(book_uid, session)
+        statement = select(Review).where(Review.book_uid == book_uid)
+        return await paginate(session, statement, Review, cursor, limit)
+
+    async def count_book_reviews(self, book_uid: UUID, mode: CountMode, session: AsyncSession) -> int:
+        """Count the reviews of a book."""
+        return await count_rows(session, select(Review.uid).where(Review.book_uid == book_uid), mode, "reviews")
+
+    async def export_reviews(self, bind: AsyncEngine) -> AsyncIterator[str]:
+        """Stream every review as NDJSON from a single consistent snapshot."""
+        async with snapshot_session(bind) as session:
+            statement = select(Review).order_by(Review.uid).execution_options(yield_per=EXPORT_BATCH_SIZE)
+            result = await session.stream_scalars(statement)
+            async for reviews in result.partitions():
+                yield "".join(
+                    ReviewPublic.model_validate(review, from_attributes=True).model_dump_json() + "\n"
+                    for review in reviews
+                )
 
     async def get_review(self, review_uid: UUID, session: AsyncSession) -> Review:
         """Get a specific review by its UID."""
@@ -47,20 +337,60 @@ class ReviewService:
     async def update_review(
         self, review_uid: UUID, update_data: ReviewUpdate, current_user: User, session: AsyncSession
     ) -> Review:
-        """Update a review."""
-        review = await self.get_review(review_uid, session)
-        await self._check_permission(review, current_user)
+        """Update a review with a single UPDATE ... RETURNING, checking the version when one is given.
 
+        A rating change first shifts the book aggregates by the difference to the stored rating, read
+        in the same statement, so the review is never loaded beforehand.
+        """
         update_data_dict = update_data.model_dump(exclude_none=True)
-        for key, value in update_data_dict.items():
-            setattr(review, key, value)
+        version = update_data_dict.pop("version", None)
+        scope = [Review.uid == review_uid, self._owned_by(current_user)]
+        if version is not None:
+            scope.append(Review.version == version)
+
+        aggregates = None
+        if "rating" in update_data_dict:
+            # Taking the old rating out of the histogram locks the review, so it stays the same below
+            old_count = select(Review.book_uid, Review.rating, literal(-1)).where(*scope, Review.book_uid.is_not(None))
+            await self._shift_rating_counts(old_count.with_for_update(), session)
+            book_uid = select(Review.book_uid).where(*scope).scalar_subquery()
+            old_rating = select(Review.rating).where(Review.uid == review_uid).scalar_subquery()
+            rating_delta = update_data_dict["rating"] - old_rating
+            aggregates = await self._update_book_rating(book_uid, 0, rating_delta, session)
+
+        if "review_text" in update_data_dict:
+            # A new text goes back through moderation
+            update_data_dict["moderation_status"] = ModerationStatus.PENDING
+        statement = (
+            update(Review).where(*scope).values(**update_data_dict, version=Review.version + 1).returning(Review)
+        )
+        review = (await session.execute(statement)).scalar_one_or_none()
+        if review is None:
+            await self._raise_write_error(review_uid, current_user, session)
+        if "rating" in update_data_dict and review.book_uid is not None:
+            new_count = {"book_uid": review.book_uid, "rating": review.rating, "count": 1}
+            await self._shift_rating_counts([new_count], session)
         await session.commit()
-        await session.refresh(review)
+        await invalidate("reviews")
+        await self._update_leaderboard(aggregates)
         return review
 
     async def delete_review(self, review_uid: UUID, current_user: User, session: AsyncSession) -> None:
-        """Delete a review from a book"""
-        review = await self.get_review(review_uid, session)
-        await self._check_permission(review, current_user)
-        await session.delete(review)
+        """Delete a review from a book with a single DELETE ... RETURNING."""
+        statement = (
+            delete(Review)
+            .where(Review.uid == review_uid, self._owned_by(current_user))
+            .returning(Review.book_uid, Review.rating, Review.created_at)
+        )
+        review = (await session.execute(statement)).one_or_none()
+        if review is None:
+            await self._raise_write_error(review_uid, current_user, session)
+        aggregates = await self._update_book_rating(review.book_uid, -1, -review.rating, session)
+        if review.book_uid is not None:
+            old_count = {"book_uid": review.book_uid, "rating": review.rating, "count": -1}
+            await self._shift_rating_counts([old_count], session)
         await session.commit()
+        await invalidate("reviews")
+        await self._update_leaderboard(aggregates)
+        if review.book_uid is not None:
+            await leaderboard.discard_review(review.book_uid, review.created_at)
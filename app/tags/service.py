@@ -1,9 +1,10 @@
 from uuid import UUID
 
-from sqlalchemy import select
+from sqlalchemy import func, select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.books.service import BookService
+from app.cache import invalidate
 from app.db.models import Book, Role, Tag, User
 from app.errors import InsufficientPermission, TagNotFound
 
@@ -44,8 +45,11 @@ class TagService:
                 db_book.tags.append(tag)
             elif tag not in db_book.tags:
                 db_book.tags.append(tag)
+        db_book.updated_at = func.now()
+        db_book.version = Book.version + 1
         session.add(db_book)
         await session.commit()
+        await invalidate("books")
         return db_book.tags
 
     async def update_tag_of_book(
@@ -67,7 +71,10 @@ class TagService:
             tag = Tag(**tag_update_data.model_dump())
         db_book.tags.remove(db_tag)
         db_book.tags.append(tag)
+        db_book.updated_at = func.now()
+        db_book.version = Book.version + 1
         await session.commit()
+        await invalidate("books")
         return db_book.tags
 
     async def delete_tag_from_book(self, book_uid: UUID, tag_uid: UUID, current_user: User, session: AsyncSession):
@@ -78,4 +85,7 @@ class TagService:
         if db_tag not in db_book.tags:
             raise TagNotFound
         db_book.tags.remove(db_tag)
+        db_book.updated_at = func.now()
+        db_book.version = Book.version + 1
         await session.commit()
+        await invalidate("books")
@@ -0,0 +1,98 @@
+from bisect import bisect_left, insort
+from collections.abc import Iterable
+from datetime import datetime, timezone
+from typing import Optional
+from uuid import UUID
+
+from loguru import logger
+from redis import ConnectionError
+
+from app.config import Config
+from app.db.redis_client import get_redis_client
+
+FEED_KEY = "feed:sorted:{user_uid}"
+
+FeedEntry = tuple[datetime, UUID]  # (created_at, review uid)
+
+
+def _encode(entry: FeedEntry) -> str:
+    # Fixed width, so Redis orders the members of equal score, the entries of the same moment, by uid
+    return f"{entry[0].isoformat(timespec='microseconds')}|{entry[1]}"
+
+
+def _score(moment: datetime) -> float:
+    """Sorted set score of a moment; naive datetimes from the database are UTC."""
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def _decode(raw: bytes | str) -> FeedEntry:
+    created_at, review_uid = (raw.decode() if isinstance(raw, bytes) else raw).split("|")
+    return datetime.fromisoformat(created_at), UUID(review_uid)
+
+
+class ActivityFeed:
+    """Per user capped feeds of the newest reviews on the books they follow, pushed on every review write.
+
+    Kept in Redis sorted sets when Redis is available, and in sorted lists in process memory otherwise.
+    Both are ordered by `(created_at, uid)` rather than by push order, which differs from it when commits
+    finish out of order, so a cursor never skips an entry pushed late. Only the `(created_at, uid)` of a
+    review is stored, so a page of the feed is loaded by primary key.
+    """
+
+    def __init__(self) -> None:
+        self.feeds: dict[UUID, list[FeedEntry]] = {}
+
+    def reset(self) -> None:
+        self.feeds = {}
+
+    async def push(self, user_uids: Iterable[UUID], entry: FeedEntry) -> None:
+        """Add a review to the feeds of the users, dropping the oldest entries beyond FEED_MAX_LENGTH."""
+        user_uids = list(user_uids)
+        redis_client = get_redis_client()
+        if redis_client:
+            try:
+                async with redis_client.pipeline() as pipe:
+                    for user_uid in user_uids:
+                        key = FEED_KEY.format(user_uid=user_uid)
+                        pipe.zadd(key, {_encode(entry): _score(entry[0])})
+                        pipe.zremrangebyrank(key, 0, -Config.FEED_MAX_LENGTH - 1)
+                    await pipe.execute()
+                return
+            except ConnectionError:
+                logger.error("Redis error while pushing to activity feeds")
+        for user_uid in user_uids:
+            feed = self.feeds.setdefault(user_uid, [])
+            insort(feed, entry)
+            if len(feed) > Config.FEED_MAX_LENGTH:
+                del feed[0]
+
+    async def read(self, user_uid: UUID, before: Optional[FeedEntry], limit: int) -> list[FeedEntry]:
+        """Get up to `limit` entries of a feed below `before`, newest first."""
+        redis_client = get_redis_client()
+        if redis_client:
+            try:
+                key = FEED_KEY.format(user_uid=user_uid)
+                if before is None:
+                    chunk = await redis_client.zrevrange(key, 0, limit - 1)
+                    return list(map(_decode, chunk))
+                # The score range also holds the entries of the same moment at or above the cursor, which
+                # come first and are skipped
+                entries: list[FeedEntry] = []
+                start = 0
+                while len(entries) < limit:
+                    chunk = await redis_client.zrevrangebyscore(key, _score(before[0]), "-inf", start, limit)
+                    if not chunk:
+                        break
+                    entries.extend(entry for entry in map(_decode, chunk) if entry < before)
+                    start += len(chunk)
+                return entries[:limit]
+            except ConnectionError:
+                logger.error("Redis error while reading an activity feed")
+        feed = self.feeds.get(user_uid, [])
+        end = len(feed) if before is None else bisect_left(feed, before)
+        return feed[max(end - limit, 0) : end][::-1]
+
+
+activity_feed = ActivityFeed()
@@ -4,8 +4,11 @@ from fastapi import APIRouter, status
 
 from app.auth.dependencies import AdminRoleCheckerDep, CurrentUserDep
 from app.db.main import SessionDep
+from app.fieldsets import FieldsQuery, parse_fields
+from app.pagination import DEFAULT_PAGE_SIZE, CursorQuery, LimitQuery, Page
+from app.reviews.schemas import ReviewPublic
 
-from .schemas import UserBooks, UserPublic, UserUpdate
+from .schemas import UserBooks, UserPublic, UserPublicFields, UserUpdate
 from .service import UserService
 
 user_router = APIRouter()
@@ -17,9 +20,19 @@ async def get_current_user(user: CurrentUserDep):
     return user
 
 
-@user_router.get("/", response_model=list[UserPublic], dependencies=[AdminRoleCheckerDep])
-async def get_all_users(session: SessionDep):
-    return await user_service.get_all_users(session)
+@user_router.get("/me/feed", response_model=Page[ReviewPublic])
+async def get_feed(
+    user: CurrentUserDep, session: SessionDep, cursor: CursorQuery = None, limit: LimitQuery = DEFAULT_PAGE_SIZE
+):
+    """Newest reviews by other users on the books you submitted or reviewed."""
+    return await user_service.get_feed(user, cursor, limit, session)
+
+
+@user_router.get(
+    "/", response_model=list[UserPublicFields], response_model_exclude_unset=True, dependencies=[AdminRoleCheckerDep]
+)
+async def get_all_users(session: SessionDep, fields: FieldsQuery = None):
+    return await user_service.get_all_users(parse_fields(fields, UserPublic), session)
 
 
 @user_router.get("/user-profile/{username}", response_model=UserBooks)
@@ -5,6 +5,7 @@ from uuid import UUID
 from pydantic import BaseModel, ConfigDict, EmailStr, Field
 
 from app.books.schemas import BookPublic
+from app.fieldsets import partial_model
 from app.reviews.schemas import ReviewPublic
 
 
@@ -18,10 +19,14 @@ class UserPublic(BaseModel):
     is_verified: bool
     created_at: datetime
     updated_at: datetime
+    version: int = 1
 
     model_config = ConfigDict(from_attributes=True)
 
 
+UserPublicFields = partial_model(UserPublic)
+
+
 class UserBooks(UserPublic):
     books: list[BookPublic]
     reviews: list[ReviewPublic]
@@ -52,3 +57,4 @@ class UserUpdate(BaseModel):
     email: Optional[EmailStr] = None
     first_name: Optional[Annotated[str, Field(min_length=3, max_length=25)]] = None
     last_name: Optional[Annotated[str, Field(min_length=3, max_length=25)]] = None
+    version: Optional[int] = None
@@ -1,22 +1,31 @@
 from collections.abc import Sequence
+from datetime import datetime
+from typing import Any, NoReturn, Optional
 from uuid import UUID
 
 from pydantic import EmailStr
-from sqlalchemy import select
+from sqlalchemy import or_, select, tuple_, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import joinedload
 
 from app.auth.utils import hash_password
-from app.db.models import Role, User
+from app.cache import invalidate
+from app.config import Config
+from app.db.models import Book, ModerationStatus, Review, Role, User
 from app.errors import (
     AccountNotActive,
     AccountNotVerified,
     EmailAlreadyExists,
     InsufficientPermission,
+    InvalidCursor,
     UsernameAlreadyExists,
     UserNotFound,
+    VersionConflict,
 )
+from app.fieldsets import select_fields
+from app.pagination import decode_cursor, encode_cursor
 
+from .feed import FeedEntry, activity_feed
 from .schemas import UserCreate, UserUpdate
 
 
@@ -49,10 +58,12 @@ class UserService:
         await session.commit()
         return new_user
 
-    async def get_all_users(self, session: AsyncSession) -> Sequence[User]:
-        statement = select(User).where(User.role != Role.ADMIN)
+    async def get_all_users(self, fields: Optional[list[str]], session: AsyncSession) -> Sequence[Any]:
+        statement = select_fields(User, fields).where(User.role != Role.ADMIN)
         result = await session.execute(statement)
-        return result.scalars().all()
+        if fields is None:
+            return result.scalars().all()
+        return result.mappings().all()
 
     async def get_user_profile(self, username: str, session: AsyncSession) -> User:
         statement = (
@@ -71,26 +82,31 @@ class UserService:
         self, user_uid: UUID, update_data: UserUpdate, current_user: User, session: AsyncSession
     ) -> User:
         await self._check_permission(user_uid, current_user)
-        target_user = current_user
-        if current_user.role == Role.ADMIN and current_user.uid != user_uid:
-            target_user = await session.get(User, user_uid)
-            if target_user is None:
-                raise UserNotFound()
-
         update_data_dict = update_data.model_dump(exclude_none=True)
+        version = update_data_dict.pop("version", None)
 
         email = update_data_dict.get("email")
-        if email and email != target_user.email and await self.get_user_by_email(email, session):
+        if email and (existing := await self.get_user_by_email(email, session)) and existing.uid != user_uid:
             raise EmailAlreadyExists()
 
         username = update_data_dict.get("username")
-        if username and username != target_user.username and await self.get_user_by_username(username, session):
+        if username and (existing := await self.get_user_by_username(username, session)) and existing.uid != user_uid:
             raise UsernameAlreadyExists()
 
-        for key, value in update_data_dict.items():
-            setattr(target_user, key, value)
+        statement = (
+            update(User)
+            .where(User.uid == user_uid)
+            .values(**update_data_dict, version=User.version + 1)
+            .returning(User)
+        )
+        if version is not None:
+            statement = statement.where(User.version == version)
+        target_user = (await session.execute(statement)).scalar_one_or_none()
+        if target_user is None:
+            if await session.get(User, user_uid) is None:
+                raise UserNotFound()
+            raise VersionConflict()
         await session.commit()
-        await session.refresh(target_user)
         return target_user
 
     async def delete_user_profile(self, user_uid: UUID, current_user: User, session: AsyncSession) -> None:
@@ -102,23 +118,79 @@ class UserService:
                 raise UserNotFound()
         await session.delete(target_user)
         await session.commit()
-
-    async def verify_user_account(self, user_email: EmailStr, session: AsyncSession) -> None:
+        await invalidate("books", "reviews")
+
+    async def get_feed(self, user: User, cursor: Optional[str], limit: int, session: AsyncSession) -> dict:
+        """Get a page of the newest reviews by others on the books the user submitted or reviewed.
+
+        Most entries come from the feed list that review writes push to. Reviews of the few books above
+        FEED_PULL_THRESHOLD reviews are pulled with a query per book reading at most `limit + 1` rows of its
+        index instead, and all are merged on `(created_at, uid)` before a single primary key lookup of the page.
+        """
+        before: Optional[FeedEntry] = None
+        if cursor is not None:
+            created_at, review_uid = decode_cursor(cursor, 2)
+            try:
+                before = (datetime.fromisoformat(created_at), UUID(review_uid))
+            except ValueError:
+                raise InvalidCursor()
+        pushed = await activity_feed.read(user.uid, before, limit + 1)
+
+        reviewed = select(Review.book_uid).where(Review.user_uid == user.uid)
+        popular_books = await session.scalars(
+            select(Book.uid).where(
+                Book.review_count >= Config.FEED_PULL_THRESHOLD,
+                or_(Book.user_uid == user.uid, Book.uid.in_(reviewed)),
+            )
+        )
+        pulled: list[FeedEntry] = []
+        for book_uid in popular_books.all():
+            # One range of the (book_uid, created_at, uid) index per book, read newest first and stopped
+            # after `limit + 1` rows, instead of sorting every review of the popular books
+            statement = select(Review.created_at, Review.uid).where(
+                Review.book_uid == book_uid, Review.user_uid != user.uid
+            )
+            if before is not None:
+                statement = statement.where(tuple_(Review.created_at, Review.uid) < before)
+            statement = statement.order_by(Review.created_at.desc(), Review.uid.desc()).limit(limit + 1)
+            pulled.extend((created_at, review_uid) for created_at, review_uid in await session.execute(statement))
+
+        entries = sorted(set(pushed) | set(pulled), reverse=True)[: limit + 1]
+        page = [review_uid for _, review_uid in entries[:limit]]
+        statement = select(Review).where(Review.uid.in_(page), Review.moderation_status != ModerationStatus.REJECTED)
+        reviews = {review.uid: review for review in await session.scalars(statement)}
+        # Deleted and rejected reviews are dropped from the page rather than replaced
+        items = [reviews[review_uid] for review_uid in page if review_uid in reviews]
+        next_cursor = encode_cursor(*entries[limit - 1]) if len(entries) > limit else None
+        return {"items": items, "next_cursor": next_cursor}
+
+    async def _raise_account_error(self, user_email: EmailStr, session: AsyncSession) -> NoReturn:
+        """Explain why an account update by email matched no row; only runs on the failure path."""
         user = await self.get_user_by_email(user_email, session)
         if user is None:
             raise UserNotFound()
         if not user.is_active:
             raise AccountNotActive()
-        user.is_verified = True
+        raise AccountNotVerified()
+
+    async def verify_user_account(self, user_email: EmailStr, session: AsyncSession) -> None:
+        statement = (
+            update(User)
+            .where(User.email == user_email, User.is_active)
+            .values(is_verified=True, version=User.version + 1)
+            .returning(User.uid)
+        )
+        if (await session.execute(statement)).scalar_one_or_none() is None:
+            await self._raise_account_error(user_email, session)
         await session.commit()
 
     async def reset_user_password(self, user_email: EmailStr, new_password: str, session: AsyncSession) -> None:
-        user = await self.get_user_by_email(user_email, session)
-        if user is None:
-            raise UserNotFound()
-        if not user.is_active:
-            raise AccountNotActive()
-        if not user.is_verified:
-            raise AccountNotVerified()
-        user.password_hash = hash_password(new_password)
+        statement = (
+            update(User)
+            .where(User.email == user_email, User.is_active, User.is_verified)
+            .values(password_hash=hash_password(new_password), version=User.version + 1)
+            .returning(User.uid)
+        )
+        if (await session.execute(statement)).scalar_one_or_none() is None:
+            await self._raise_account_error(user_email, session)
         await session.commit()
@@ -1,16 +1,28 @@
-from collections.abc import AsyncGenerator
+from collections.abc import AsyncGenerator, Generator
 from datetime import date
 
 import pytest
 import pytest_asyncio
 from httpx import ASGITransport, AsyncClient
 from sqlalchemy import StaticPool
-from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
 
 from app import app
 from app.auth.utils import create_jwt_token, create_url_safe_token, hash_password
+from app.books.autocomplete import autocomplete_index
+from app.books.covers import LocalCoverStorage, get_cover_storage, shutdown_thumbnail_executor
+from app.books.duplicates import duplicate_index
+from app.books.leaderboard import leaderboard
+from app.books.similarity import tag_statistics
+from app.cache import reset_cache_mock
 from app.db.main import get_session
 from app.db.models import Base, Book, Review, Role, Tag, User
+from app.users.feed import activity_feed
 
 TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
 
@@ -48,10 +60,25 @@ async def override_get_session(test_session: AsyncSession) -> AsyncGenerator[Non
 
 @pytest_asyncio.fixture
 async def async_client(override_get_session) -> AsyncGenerator[AsyncClient, None]:
+    leaderboard.reset()
+    autocomplete_index.reset()
+    duplicate_index.reset()
+    activity_feed.reset()
+    tag_statistics.reset()
+    reset_cache_mock()
     async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
         yield client
 
 
+@pytest.fixture
+def cover_storage(tmp_path) -> Generator[LocalCoverStorage, None, None]:
+    """Store covers in a temporary directory."""
+    storage = LocalCoverStorage(tmp_path / "covers")
+    app.dependency_overrides[get_cover_storage] = lambda: storage
+    yield storage
+    shutdown_thumbnail_executor()
+
+
 @pytest.fixture
 def mock_email_service(monkeypatch: pytest.MonkeyPatch):
     """Mock the email service functions."""
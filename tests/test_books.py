@@ -1,8 +1,22 @@
+import io
+import json
+import time
+from datetime import date, datetime, timezone
+from uuid import uuid4
+
 import pytest
 from fastapi import status
 from httpx import AsyncClient
+from PIL import Image
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.db.models import Book, User
+from app.books.autocomplete import AutocompleteIndex, autocomplete_index
+from app.books.duplicates import duplicate_index
+from app.books.leaderboard import BUCKET_SECONDS, leaderboard
+from app.books.similarity import rebuild_similarities, refresh_book_similarities
+from app.cache import cache_get, cache_set, invalidate
+from app.config import Config
+from app.db.models import Book, Review, User
 
 BOOKS_PREFIX = "/api/v1/books"
 
@@ -66,9 +80,51 @@ async def test_get_all_books(async_client: AsyncClient, test_book: Book):
     response = await async_client.get(f"{BOOKS_PREFIX}/")
 
     assert response.status_code == status.HTTP_200_OK
-    assert isinstance(response.json(), list)
-    assert len(response.json()) == 1
-    assert response.json()[0]["title"] == test_book.title
+    assert isinstance(response.json()["items"], list)
+    assert len(response.json()["items"]) == 1
+    assert response.json()["items"][0]["title"] == test_book.title
+    assert response.json()["next_cursor"] is None
+
+
+@pytest.mark.asyncio
+async def test_get_all_books_cursor_pagination(async_client: AsyncClient, test_session: AsyncSession, test_user: User):
+    books = [
+        Book(
+            title=f"Book {i}",
+            author="Author",
+            publisher="Publisher",
+            page_count=100,
+            language="en",
+            published_date=date(2020, 1, 1),
+            user_uid=test_user.uid,
+        )
+        for i in range(5)
+    ]
+    test_session.add_all(books)
+    await test_session.commit()
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 2} if cursor is None else {"limit": 2, "cursor": cursor}
+        response = await async_client.get(f"{BOOKS_PREFIX}/", params=params)
+        assert response.status_code == status.HTTP_200_OK
+        assert len(response.json()["items"]) <= 2
+        seen.extend(item["uid"] for item in response.json()["items"])
+        cursor = response.json()["next_cursor"]
+        if cursor is None:
+            break
+
+    assert len(seen) == 5
+    assert set(seen) == {str(book.uid) for book in books}
+
+
+@pytest.mark.asyncio
+async def test_get_all_books_invalid_cursor(async_client: AsyncClient):
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params={"cursor": "not-a-cursor"})
+
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.json()["error_code"] == "invalid_cursor"
 
 
 @pytest.mark.asyncio
@@ -185,9 +241,9 @@ async def test_get_user_books_success(async_client: AsyncClient, test_book: Book
     response = await async_client.get(f"{BOOKS_PREFIX}/user/{test_user.uid}/")
 
     assert response.status_code == status.HTTP_200_OK
-    assert isinstance(response.json(), list)
-    assert len(response.json()) == 1
-    assert response.json()[0]["title"] == test_book.title
+    assert isinstance(response.json()["items"], list)
+    assert len(response.json()["items"]) == 1
+    assert response.json()["items"][0]["title"] == test_book.title
 
 
 @pytest.mark.asyncio
@@ -195,5 +251,954 @@ async def test_get_user_books_empty(async_client: AsyncClient, other_user: User)
     response = await async_client.get(f"{BOOKS_PREFIX}/user/{other_user.uid}/")
 
     assert response.status_code == status.HTTP_200_OK
-    assert isinstance(response.json(), list)
-    assert len(response.json()) == 0
+    assert isinstance(response.json()["items"], list)
+    assert len(response.json()["items"]) == 0
+
+
+@pytest.mark.asyncio
+async def test_search_books(async_client: AsyncClient, test_session: AsyncSession, test_user: User):
+    test_session.add_all(
+        [
+            Book(
+                title="The Mystery of Python",
+                author="John Doe",
+                publisher="Code Press",
+                page_count=350,
+                language="en",
+                published_date=date(2022, 3, 5),
+                user_uid=test_user.uid,
+            ),
+            Book(
+                title="Poetry for Everyone",
+                author="Jane Smith",
+                publisher="Python Poetry House",
+                page_count=150,
+                language="en",
+                published_date=date(2021, 2, 14),
+                user_uid=test_user.uid,
+            ),
+            Book(
+                title="Creative Writing Handbook",
+                author="Jane Smith",
+                publisher="Writer's World",
+                page_count=280,
+                language="en",
+                published_date=date(2020, 6, 18),
+                user_uid=test_user.uid,
+            ),
+        ]
+    )
+    await test_session.commit()
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/search", params={"q": "python"})
+
+    assert response.status_code == status.HTTP_200_OK
+    titles = [item["title"] for item in response.json()["items"]]
+    # A title match outranks a publisher match
+    assert titles == ["The Mystery of Python", "Poetry for Everyone"]
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/search", params={"q": "jane hand"})
+
+    assert [item["title"] for item in response.json()["items"]] == ["Creative Writing Handbook"]
+
+
+@pytest.mark.asyncio
+async def test_search_books_follows_updates_and_deletes(
+    async_client: AsyncClient, test_book: Book, test_user: User, test_user_access_token: str
+):
+    test_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}"}
+    await async_client.put(f"{BOOKS_PREFIX}/{test_book.uid}", json={"title": "Renamed Volume"}, headers=headers)
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/search", params={"q": "renamed"})
+    assert [item["uid"] for item in response.json()["items"]] == [str(test_book.uid)]
+
+    await async_client.delete(f"{BOOKS_PREFIX}/{test_book.uid}", headers=headers)
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/search", params={"q": "renamed"})
+    assert response.json()["items"] == []
+
+
+@pytest.mark.asyncio
+async def test_get_all_books_filters(async_client: AsyncClient, test_session: AsyncSession, test_user: User):
+    test_session.add_all(
+        [
+            Book(
+                title=f"Book {i}",
+                author="Author A" if i % 2 else "Author B",
+                publisher="Publisher",
+                page_count=100 * (i + 1),
+                language="fr" if i == 0 else "en",
+                published_date=date(2015 + i, 1, 1),
+                user_uid=test_user.uid,
+            )
+            for i in range(5)
+        ]
+    )
+    await test_session.commit()
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params={"language": "fr"})
+    assert [item["title"] for item in response.json()["items"]] == ["Book 0"]
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params={"author": "Author A", "sort": "title"})
+    assert [item["title"] for item in response.json()["items"]] == ["Book 1", "Book 3"]
+
+    params = {"published_from": "2016-01-01", "published_to": "2018-12-31", "min_pages": 300, "sort": "-page_count"}
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params=params)
+    assert [item["title"] for item in response.json()["items"]] == ["Book 3", "Book 2"]
+
+
+@pytest.mark.asyncio
+async def test_get_all_books_sorted_pagination(async_client: AsyncClient, test_session: AsyncSession, test_user: User):
+    test_session.add_all(
+        [
+            Book(
+                title=title,
+                author="Author",
+                publisher="Publisher",
+                page_count=100,
+                language="en",
+                published_date=date(2020, 1, 1),
+                user_uid=test_user.uid,
+            )
+            for title in ["Delta", "Alpha", "Echo", "Charlie", "Bravo"]
+        ]
+    )
+    await test_session.commit()
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params={"sort": "title", "limit": 3})
+    assert [item["title"] for item in response.json()["items"]] == ["Alpha", "Bravo", "Charlie"]
+
+    cursor = response.json()["next_cursor"]
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params={"sort": "title", "limit": 3, "cursor": cursor})
+    assert [item["title"] for item in response.json()["items"]] == ["Delta", "Echo"]
+    assert response.json()["next_cursor"] is None
+
+    # A cursor is only valid for the sort order it was issued for
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params={"sort": "-title", "cursor": cursor})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.asyncio
+async def test_get_all_books_invalid_sort(async_client: AsyncClient):
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params={"sort": "user_uid"})
+
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+@pytest.mark.asyncio
+async def test_get_all_books_sparse_fields(async_client: AsyncClient, test_session: AsyncSession, test_user: User):
+    test_session.add_all(
+        [
+            Book(
+                title=title,
+                author="Author",
+                publisher="Publisher",
+                page_count=100,
+                language="en",
+                published_date=date(2020, 1, 1),
+                user_uid=test_user.uid,
+            )
+            for title in ["Alpha", "Bravo", "Charlie"]
+        ]
+    )
+    await test_session.commit()
+
+    params = {"fields": "title,author", "sort": "title", "limit": 2}
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params=params)
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["items"] == [{"title": "Alpha", "author": "Author"}, {"title": "Bravo", "author": "Author"}]
+
+    params["cursor"] = response.json()["next_cursor"]
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params=params)
+
+    assert response.json()["items"] == [{"title": "Charlie", "author": "Author"}]
+
+
+@pytest.mark.asyncio
+async def test_get_all_books_invalid_fields(async_client: AsyncClient):
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params={"fields": "title,password_hash"})
+
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.json()["error_code"] == "invalid_fields"
+
+
+@pytest.mark.asyncio
+async def test_create_books_bulk(async_client: AsyncClient, test_user: User, test_user_access_token: str):
+    test_user.is_verified = True
+    books = [
+        {
+            "title": f"Bulk Book {i}",
+            "author": "Bulk Author",
+            "publisher": "Bulk Publisher",
+            "page_count": 100 + i,
+            "language": "en",
+            "published_date": "2023-01-01",
+        }
+        for i in range(3)
+    ]
+    books.insert(1, {**books[0], "page_count": 0})
+    headers = {"Authorization": f"Bearer {test_user_access_token}"}
+    response = await async_client.post(f"{BOOKS_PREFIX}/bulk", json=books, headers=headers)
+
+    assert response.status_code == status.HTTP_201_CREATED
+    assert [book["title"] for book in response.json()["created"]] == ["Bulk Book 0", "Bulk Book 1", "Bulk Book 2"]
+    assert all(book["user_uid"] == str(test_user.uid) for book in response.json()["created"])
+    assert len(response.json()["errors"]) == 1
+    assert response.json()["errors"][0]["index"] == 1
+    assert response.json()["errors"][0]["errors"][0]["loc"] == ["page_count"]
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/")
+    assert len(response.json()["items"]) == 3
+
+
+@pytest.mark.asyncio
+async def test_create_books_bulk_unauthorized(async_client: AsyncClient):
+    response = await async_client.post(f"{BOOKS_PREFIX}/bulk", json=[{"title": "Book"}])
+
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+@pytest.mark.asyncio
+async def test_import_books_csv(
+    async_client: AsyncClient, test_user: User, test_user_access_token: str, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(Config, "BOOK_IMPORT_CHUNK_SIZE", 2)
+    test_user.is_verified = True
+    content = (
+        "title,author,publisher,page_count,language,published_date\n"
+        "Plain Title,Author,Publisher,100,en,2020-01-01\n"
+        '"Title, With Comma",Author,Publisher,120,en,2020-01-01\n'
+        "Bad Pages,Author,Publisher,zero,en,2020-01-01\n"
+        '"Multi\nLine",Author,Publisher,130,en,2020-01-01\n'
+        "Too,Few,Columns\n"
+    )
+    headers = {"Authorization": f"Bearer {test_user_access_token}", "Content-Type": "text/csv"}
+    response = await async_client.post(f"{BOOKS_PREFIX}/import", content=content.encode(), headers=headers)
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["processed"] == 5
+    assert response.json()["created"] == 3
+    assert response.json()["failed"] == 2
+    assert [error["line"] for error in response.json()["errors"]] == [4, 7]
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params={"sort": "title"})
+    assert [book["title"] for book in response.json()["items"]] == ["Multi\nLine", "Plain Title", "Title, With Comma"]
+
+
+@pytest.mark.asyncio
+async def test_import_books_ndjson(async_client: AsyncClient, test_user: User, test_user_access_token: str):
+    test_user.is_verified = True
+    book = {
+        "title": "NDJSON Book",
+        "author": "Author",
+        "publisher": "Publisher",
+        "page_count": 100,
+        "language": "en",
+        "published_date": "2020-01-01",
+    }
+    content = f"{json.dumps(book)}\n\n{{not json}}\n{json.dumps({**book, 'title': 'Second'})}"
+    headers = {"Authorization": f"Bearer {test_user_access_token}", "Content-Type": "application/x-ndjson"}
+    response = await async_client.post(f"{BOOKS_PREFIX}/import", content=content.encode(), headers=headers)
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["created"] == 2
+    assert response.json()["errors"][0]["line"] == 3
+
+
+@pytest.mark.asyncio
+async def test_import_books_unsupported_format(async_client: AsyncClient, test_user: User, test_user_access_token: str):
+    test_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}", "Content-Type": "application/xml"}
+    response = await async_client.post(f"{BOOKS_PREFIX}/import", content=b"<books/>", headers=headers)
+
+    assert response.status_code == status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+    assert response.json()["error_code"] == "unsupported_import_format"
+
+
+@pytest.mark.asyncio
+async def test_export_books(async_client: AsyncClient, test_session: AsyncSession, test_user: User):
+    test_session.add_all(
+        [
+            Book(
+                title=f"Book {i}",
+                author="Author",
+                publisher="Publisher",
+                page_count=100,
+                language="en",
+                published_date=date(2020, 1, 1),
+                user_uid=test_user.uid,
+            )
+            for i in range(3)
+        ]
+    )
+    await test_session.commit()
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/export")
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"] == "application/x-ndjson"
+    books = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(book["title"] for book in books) == ["Book 0", "Book 1", "Book 2"]
+
+
+@pytest.mark.asyncio
+async def test_get_book_detail_etag(
+    async_client: AsyncClient, test_book: Book, test_user: User, test_user_access_token: str
+):
+    response = await async_client.get(f"{BOOKS_PREFIX}/{test_book.uid}")
+    etag = response.headers["ETag"]
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/{test_book.uid}", headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response.content == b""
+    assert response.headers["ETag"] == etag
+
+    test_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}"}
+    review_data = {"rating": 5, "review_text": "Excellent book!"}
+    response = await async_client.post(f"/api/v1/reviews/book/{test_book.uid}", json=review_data, headers=headers)
+    review_uid = response.json()["uid"]
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/{test_book.uid}", headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["ETag"] != etag
+    assert len(response.json()["reviews"]) == 1
+
+    # An edit within the same second as the review leaves every timestamp as it was
+    etag = response.headers["ETag"]
+    await async_client.put(f"/api/v1/reviews/{review_uid}", json={"rating": 3}, headers=headers)
+    response = await async_client.get(f"{BOOKS_PREFIX}/{test_book.uid}", headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["ETag"] != etag
+    assert response.json()["reviews"][0]["rating"] == 3
+
+
+@pytest.mark.asyncio
+async def test_get_all_books_etag(
+    async_client: AsyncClient, test_book: Book, test_user: User, test_session: AsyncSession
+):
+    response = await async_client.get(f"{BOOKS_PREFIX}/")
+    etag = response.headers["ETag"]
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/", headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params={"fields": "title"}, headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_200_OK
+
+    await test_session.delete(test_book)
+    await test_session.commit()
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/", headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["items"] == []
+
+    # A book past the page changes neither its rows nor its cursor, only the total
+    params = {"limit": 1, "count": "exact"}
+    for title, year in [("Old Book", 2000), ("Older Book", 1999), ("Oldest Book", 1998)]:
+        response = await async_client.get(f"{BOOKS_PREFIX}/", params=params)
+        etag, total = response.headers["ETag"], int(response.headers["X-Total-Count"])
+        book = Book(
+            title=title,
+            author="Author",
+            publisher="Press",
+            page_count=100,
+            language="en",
+            published_date=date(year, 1, 1),
+            user_uid=test_user.uid,
+            created_at=datetime(year, 1, 1),
+        )
+        test_session.add(book)
+        await test_session.commit()
+        await invalidate("books")  # as the book service does after its writes
+        response = await async_client.get(f"{BOOKS_PREFIX}/", params=params, headers={"If-None-Match": etag})
+        assert response.status_code == status.HTTP_200_OK
+        assert int(response.headers["X-Total-Count"]) == total + 1
+        assert [item["title"] for item in response.json()["items"]] == ["Old Book"]
+
+
+@pytest.mark.asyncio
+async def test_top_and_trending_books(
+    async_client: AsyncClient,
+    test_session: AsyncSession,
+    test_book: Book,
+    test_user: User,
+    test_user_access_token: str,
+    other_user: User,
+    other_user_access_token: str,
+):
+    test_user.is_verified = True
+    other_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}"}
+    other_headers = {"Authorization": f"Bearer {other_user_access_token}"}
+    other_book = Book(
+        title="Another Book",
+        author="Jane Smith",
+        publisher="Code Press",
+        page_count=120,
+        language="en",
+        published_date=date(2021, 2, 14),
+        user_uid=test_user.uid,
+    )
+    test_session.add(other_book)
+    await test_session.commit()
+
+    reviews = []
+    for book_uid, reviewer in [(test_book.uid, headers), (test_book.uid, other_headers), (other_book.uid, headers)]:
+        response = await async_client.post(
+            f"/api/v1/reviews/book/{book_uid}", json={"rating": 5, "review_text": "Nice"}, headers=reviewer
+        )
+        reviews.append(response.json()["uid"])
+
+    top = (await async_client.get(f"{BOOKS_PREFIX}/top")).json()
+    assert [entry["book"]["uid"] for entry in top] == [str(test_book.uid), str(other_book.uid)]
+    assert top[0]["score"] == pytest.approx((3.0 * 5 + 10) / 7)
+
+    trending = (await async_client.get(f"{BOOKS_PREFIX}/trending", params={"limit": 1})).json()
+    assert [(entry["book"]["uid"], entry["score"]) for entry in trending] == [(str(test_book.uid), 2)]
+
+    await async_client.delete(f"/api/v1/reviews/{reviews[0]}", headers=headers)
+    await async_client.delete(f"{BOOKS_PREFIX}/{other_book.uid}", headers=headers)
+    trending = (await async_client.get(f"{BOOKS_PREFIX}/trending")).json()
+    assert [(entry["book"]["uid"], entry["score"]) for entry in trending] == [(str(test_book.uid), 1)]
+
+    leaderboard.reset()
+    await leaderboard.rebuild(test_session)
+    top = (await async_client.get(f"{BOOKS_PREFIX}/top")).json()
+    assert [entry["book"]["uid"] for entry in top] == [str(test_book.uid)]
+
+
+@pytest.mark.asyncio
+async def test_trending_totals_follow_the_window(monkeypatch: pytest.MonkeyPatch):
+    leaderboard.reset()
+    book_uids = [uuid4(), uuid4()]
+    now = time.time()
+    await leaderboard.record_review(book_uids[0])
+    monkeypatch.setattr(time, "time", lambda: now + BUCKET_SECONDS)
+    for book_uid in [book_uids[1], book_uids[1], book_uids[1], book_uids[0]]:
+        await leaderboard.record_review(book_uid)
+    assert await leaderboard.get_trending(5) == [(book_uids[1], 3), (book_uids[0], 2)]
+
+    # The first bucket leaves the window, and its count the running total
+    monkeypatch.setattr(time, "time", lambda: now + Config.TRENDING_WINDOW_HOURS * BUCKET_SECONDS)
+    assert await leaderboard.get_trending(5) == [(book_uids[1], 3), (book_uids[0], 1)]
+    await leaderboard.discard_review(book_uids[1], datetime.fromtimestamp(now + BUCKET_SECONDS, timezone.utc))
+    assert await leaderboard.get_trending(1) == [(book_uids[1], 2)]
+
+
+@pytest.mark.asyncio
+async def test_get_books_batch(async_client: AsyncClient, test_session: AsyncSession, test_book: Book, test_user: User):
+    other_book = Book(
+        title="Another Book",
+        author="Jane Smith",
+        publisher="Code Press",
+        page_count=120,
+        language="en",
+        published_date=date(2021, 2, 14),
+        user_uid=test_user.uid,
+    )
+    test_session.add(other_book)
+    await test_session.commit()
+    missing = str(uuid4())
+
+    payload = {"ids": [str(other_book.uid), missing, str(test_book.uid), str(other_book.uid)]}
+    response = await async_client.post(f"{BOOKS_PREFIX}/batch-get", json=payload)
+    assert response.status_code == status.HTTP_200_OK
+    assert [book["uid"] for book in response.json()["items"]] == [str(other_book.uid), str(test_book.uid)]
+    assert response.json()["missing"] == [missing]
+    assert "avg_rating" not in response.json()["items"][0]
+
+    payload["include_ratings"] = True
+    response = await async_client.post(f"{BOOKS_PREFIX}/batch-get", json=payload)
+    assert response.json()["items"][0]["review_count"] == 0
+    assert response.json()["items"][0]["avg_rating"] is None
+
+    response = await async_client.post(f"{BOOKS_PREFIX}/batch-get", json={"ids": []})
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+@pytest.mark.asyncio
+async def test_get_all_books_by_ids(
+    async_client: AsyncClient, test_session: AsyncSession, test_book: Book, test_user: User
+):
+    other_book = Book(
+        title="Another Book",
+        author="Jane Smith",
+        publisher="Code Press",
+        page_count=120,
+        language="en",
+        published_date=date(2021, 2, 14),
+        user_uid=test_user.uid,
+    )
+    test_session.add(other_book)
+    await test_session.commit()
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params={"ids": f"{test_book.uid},{uuid4()}"})
+    assert [book["uid"] for book in response.json()["items"]] == [str(test_book.uid)]
+
+    response = await async_client.get(
+        f"{BOOKS_PREFIX}/", params=[("ids", str(test_book.uid)), ("ids", str(other_book.uid))]
+    )
+    assert len(response.json()["items"]) == 2
+
+
+@pytest.mark.asyncio
+async def test_update_book_version_conflict(
+    async_client: AsyncClient, test_book: Book, test_user: User, test_user_access_token: str
+):
+    test_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}"}
+
+    response = await async_client.put(
+        f"{BOOKS_PREFIX}/{test_book.uid}", json={"title": "First", "version": 1}, headers=headers
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["version"] == 2
+
+    response = await async_client.put(
+        f"{BOOKS_PREFIX}/{test_book.uid}", json={"title": "Stale", "version": 1}, headers=headers
+    )
+    assert response.status_code == status.HTTP_409_CONFLICT
+    assert response.json()["error_code"] == "version_conflict"
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/{test_book.uid}")
+    assert response.json()["title"] == "First"
+
+
+@pytest.mark.asyncio
+async def test_delete_book_keeps_reviews(
+    async_client: AsyncClient,
+    test_session: AsyncSession,
+    test_review: Review,
+    test_user: User,
+    test_user_access_token: str,
+):
+    test_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}"}
+    response = await async_client.delete(f"{BOOKS_PREFIX}/{test_review.book_uid}", headers=headers)
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+
+    await test_session.refresh(test_review)
+    assert test_review.book_uid is None
+
+
+@pytest.mark.asyncio
+async def test_get_all_books_total_count(
+    async_client: AsyncClient, test_book: Book, test_user: User, test_user_access_token: str
+):
+    test_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}"}
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/")
+    assert "X-Total-Count" not in response.headers
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params={"count": "exact", "limit": 1})
+    assert response.headers["X-Total-Count"] == "1"
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params={"count": "estimated"})
+    assert response.headers["X-Total-Count"] == "1"
+
+    book_data = {
+        "title": "Counted Book",
+        "author": "Jane Smith",
+        "publisher": "Code Press",
+        "page_count": 120,
+        "language": "fr",
+        "published_date": "2021-02-14",
+    }
+    await async_client.post(f"{BOOKS_PREFIX}/", json=book_data, headers=headers)
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params={"count": "exact"})
+    assert response.headers["X-Total-Count"] == "2"
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params={"count": "estimated"})
+    assert response.headers["X-Total-Count"] == "2"
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params={"count": "estimated", "language": "fr"})
+    assert response.headers["X-Total-Count"] == "1"
+    response = await async_client.get(f"{BOOKS_PREFIX}/user/{test_user.uid}/", params={"count": "exact"})
+    assert response.headers["X-Total-Count"] == "2"
+
+    await async_client.delete(f"{BOOKS_PREFIX}/{test_book.uid}", headers=headers)
+    response = await async_client.get(f"{BOOKS_PREFIX}/", params={"count": "estimated"})
+    assert response.headers["X-Total-Count"] == "1"
+    response = await async_client.get(f"{BOOKS_PREFIX}/user/{test_user.uid}/", params={"count": "exact"})
+    assert response.headers["X-Total-Count"] == "1"
+
+
+@pytest.mark.asyncio
+async def test_get_book_facets(
+    async_client: AsyncClient,
+    test_session: AsyncSession,
+    test_book: Book,
+    test_user: User,
+    test_user_access_token: str,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    test_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}"}
+    test_session.add_all(
+        [
+            Book(
+                title="Poetry for Everyone",
+                author="Jane Smith",
+                publisher="Python Poetry House",
+                page_count=150,
+                language="fr",
+                published_date=date(1994, 2, 14),
+                user_uid=test_user.uid,
+            ),
+            Book(
+                title="Creative Writing Handbook",
+                author="Jane Smith",
+                publisher="Python Poetry House",
+                page_count=280,
+                language="fr",
+                published_date=date(1999, 7, 1),
+                user_uid=test_user.uid,
+            ),
+        ]
+    )
+    await test_session.commit()
+    await async_client.post(f"/api/v1/tags/book/{test_book.uid}", json={"tags": [{"name": "python"}]}, headers=headers)
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/facets")
+    assert response.status_code == status.HTTP_200_OK
+    facets = response.json()
+    assert facets["language"] == [{"value": "fr", "count": 2}, {"value": test_book.language, "count": 1}]
+    assert facets["publisher"][0] == {"value": "Python Poetry House", "count": 2}
+    assert facets["decade"][0] == {"value": "1990s", "count": 2}
+    assert facets["tag"] == [{"value": "python", "count": 1}]
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/facets", params={"language": "fr"})
+    assert response.json()["language"] == [{"value": "fr", "count": 2}]
+    assert response.json()["tag"] == []
+
+    tag_uid = (await async_client.get(f"/api/v1/tags/book/{test_book.uid}")).json()[0]["uid"]
+    await async_client.delete(f"/api/v1/tags/book/{test_book.uid}/tag/{tag_uid}", headers=headers)
+    response = await async_client.get(f"{BOOKS_PREFIX}/facets")
+    assert response.json()["tag"] == []
+
+    # Only the most common values of each facet are fetched
+    monkeypatch.setattr(Config, "FACETS_MAX_VALUES", 1)
+    await invalidate("books")
+    facets = (await async_client.get(f"{BOOKS_PREFIX}/facets")).json()
+    assert facets["language"] == [{"value": "fr", "count": 2}]
+    assert facets["publisher"] == [{"value": "Python Poetry House", "count": 2}]
+    assert facets["decade"] == [{"value": "1990s", "count": 2}]
+
+
+@pytest.mark.asyncio
+async def test_cache_fallback_expires_and_evicts(async_client: AsyncClient, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(Config, "CACHE_MOCK_MAX_ENTRIES", 2)
+    await cache_set("books", "a", 1)
+    await cache_set("books", "b", 2)
+    assert await cache_get("books", "a") == 1
+    await cache_set("books", "c", 3)
+    assert [await cache_get("books", key) for key in "abc"] == [1, None, 3]
+
+    await invalidate("books")
+    assert await cache_get("books", "a") is None
+
+    monkeypatch.setattr(Config, "CACHE_TTL_SECONDS", 0)
+    await cache_set("books", "d", 4)
+    assert await cache_get("books", "d") is None
+
+
+def test_autocomplete_lists_each_term_once():
+    index = AutocompleteIndex()
+    index.add_book(uuid4(), "Harry Hobbit", "Hugh Hill")
+    index.add_book(uuid4(), "Hidden House", "Zoe Zane")
+    # Both words of "Harry Hobbit" and of "Hugh Hill" start with "h"
+    assert index.suggest("h", limit=3) == [
+        {"text": "Hugh Hill", "kind": "author"},
+        {"text": "Harry Hobbit", "kind": "title"},
+        {"text": "Hidden House", "kind": "title"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_autocomplete_books(
+    async_client: AsyncClient,
+    test_session: AsyncSession,
+    test_book: Book,
+    test_user: User,
+    test_user_access_token: str,
+    admin_user: User,
+    admin_user_access_token: str,
+):
+    test_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}"}
+    await autocomplete_index.load(test_session)
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/autocomplete", params={"prefix": "tes"})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == [{"text": "Test Author", "kind": "author"}, {"text": "Test Book", "kind": "title"}]
+
+    book_data = {
+        "title": "Émile et les Livres",
+        "author": "Test Author",
+        "publisher": "Code Press",
+        "page_count": 120,
+        "language": "fr",
+        "published_date": "2021-02-14",
+    }
+    new_book = (await async_client.post(f"{BOOKS_PREFIX}/", json=book_data, headers=headers)).json()
+    response = await async_client.get(f"{BOOKS_PREFIX}/autocomplete", params={"prefix": "emile"})
+    assert response.json() == [{"text": "Émile et les Livres", "kind": "title"}]
+    response = await async_client.get(f"{BOOKS_PREFIX}/autocomplete", params={"prefix": "liv"})
+    assert response.json() == [{"text": "Émile et les Livres", "kind": "title"}]
+
+    await async_client.put(f"{BOOKS_PREFIX}/{new_book['uid']}", json={"title": "Nana"}, headers=headers)
+    response = await async_client.get(f"{BOOKS_PREFIX}/autocomplete", params={"prefix": "emile"})
+    assert response.json() == []
+
+    await async_client.delete(f"{BOOKS_PREFIX}/{test_book.uid}", headers=headers)
+    response = await async_client.get(f"{BOOKS_PREFIX}/autocomplete", params={"prefix": "test"})
+    assert response.json() == [{"text": "Test Author", "kind": "author"}]
+
+    admin_user.is_verified = True
+    admin_headers = {"Authorization": f"Bearer {admin_user_access_token}"}
+    response = await async_client.get(f"{BOOKS_PREFIX}/autocomplete/stats", headers=admin_headers)
+    assert response.json()["books"] == 1
+    assert response.json()["memory_bytes"] > 0
+    response = await async_client.get(f"{BOOKS_PREFIX}/autocomplete/stats", headers=headers)
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+
+
+@pytest.mark.asyncio
+async def test_get_similar_books(
+    async_client: AsyncClient,
+    test_session: AsyncSession,
+    test_book: Book,
+    test_user: User,
+    test_user_access_token: str,
+):
+    test_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}"}
+    books = [test_book]
+    for title in ["Close Match", "Loose Match", "Unrelated"]:
+        book = Book(
+            title=title,
+            author="Author",
+            publisher="Press",
+            page_count=100,
+            language="en",
+            published_date=date(2020, 1, 1),
+            user_uid=test_user.uid,
+        )
+        test_session.add(book)
+        books.append(book)
+    await test_session.commit()
+    tag_sets = [["fantasy", "dragons", "quest"], ["fantasy", "dragons", "quest"], ["fantasy"], ["cooking"]]
+    for book, tags in zip(books, tag_sets):
+        tag_data = {"tags": [{"name": name} for name in tags]}
+        await async_client.post(f"/api/v1/tags/book/{book.uid}", json=tag_data, headers=headers)
+
+    # The tag routes refresh the neighbor lists in the background
+    response = await async_client.get(f"{BOOKS_PREFIX}/{test_book.uid}/similar")
+    assert response.status_code == status.HTTP_200_OK
+    assert [entry["book"]["title"] for entry in response.json()] == ["Close Match", "Loose Match"]
+    assert response.json()[0]["score"] == pytest.approx(1.0)
+    assert 0 < response.json()[1]["score"] < 1
+
+    for tag in (await async_client.get(f"/api/v1/tags/book/{books[1].uid}")).json():
+        await async_client.delete(f"/api/v1/tags/book/{books[1].uid}/tag/{tag['uid']}", headers=headers)
+    response = await async_client.get(f"{BOOKS_PREFIX}/{test_book.uid}/similar")
+    assert [entry["book"]["title"] for entry in response.json()] == ["Loose Match"]
+
+    await rebuild_similarities(test_session)
+    response = await async_client.get(f"{BOOKS_PREFIX}/{books[2].uid}/similar", params={"limit": 1})
+    assert [entry["book"]["title"] for entry in response.json()] == ["Test Book"]
+
+    # A refresh overlapping another one writes the same rows again, which are upserted
+    for _ in range(2):
+        await refresh_book_similarities(test_book.uid, test_session)
+    response = await async_client.get(f"{BOOKS_PREFIX}/{test_book.uid}/similar")
+    assert [entry["book"]["title"] for entry in response.json()] == ["Loose Match"]
+    response = await async_client.get(f"{BOOKS_PREFIX}/{uuid4()}/similar")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.asyncio
+async def test_duplicate_books_flagged(
+    async_client: AsyncClient,
+    test_session: AsyncSession,
+    test_book: Book,
+    test_user: User,
+    test_user_access_token: str,
+    admin_user: User,
+    admin_user_access_token: str,
+    monkeypatch: pytest.MonkeyPatch,
+    tmp_path,
+):
+    monkeypatch.setattr(Config, "DUPLICATE_INDEX_PATH", str(tmp_path / "duplicate_index.npz"))
+    await duplicate_index.load(test_session)
+    assert (tmp_path / "duplicate_index.npz").exists()
+    test_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}"}
+    book_data = {
+        "title": "Test  Book.",
+        "author": "test author",
+        "publisher": "Another Publisher",
+        "page_count": 210,
+        "language": "en",
+        "published_date": "2024-01-01",
+    }
+
+    response = await async_client.post(f"{BOOKS_PREFIX}/", json=book_data, headers=headers)
+    assert response.status_code == status.HTTP_201_CREATED
+    assert response.json()["duplicate_of"] == str(test_book.uid)
+    response = await async_client.post(
+        f"{BOOKS_PREFIX}/", json={**book_data, "title": "Something Else Entirely"}, headers=headers
+    )
+    assert response.json()["duplicate_of"] is None
+
+    admin_user.is_verified = True
+    admin_headers = {"Authorization": f"Bearer {admin_user_access_token}"}
+    response = await async_client.get(f"{BOOKS_PREFIX}/{test_book.uid}/duplicates", headers=admin_headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert [entry["book"]["title"] for entry in response.json()] == ["Test  Book."]
+    assert response.json()[0]["score"] >= Config.DUPLICATE_THRESHOLD
+    response = await async_client.get(f"{BOOKS_PREFIX}/{test_book.uid}/duplicates", headers=headers)
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+
+    # The saved index is stale now, so the next load rebuilds it from the database
+    await duplicate_index.load(test_session)
+    assert len(duplicate_index.signatures) == 3
+
+    # So does a truncated one, such as a dump cut short by a crash
+    path = tmp_path / "duplicate_index.npz"
+    path.write_bytes(path.read_bytes()[:100])
+    await duplicate_index.load(test_session)
+    assert len(duplicate_index.signatures) == 3
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+@pytest.mark.asyncio
+async def test_duplicate_books_rejected(
+    async_client: AsyncClient, test_user: User, test_user_access_token: str, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(Config, "DUPLICATE_POLICY", "reject")
+    test_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}"}
+    book_data = {
+        "title": "The Hobbit",
+        "author": "J.R.R. Tolkien",
+        "publisher": "Allen & Unwin",
+        "page_count": 310,
+        "language": "en",
+        "published_date": "1937-09-21",
+    }
+
+    response = await async_client.post(f"{BOOKS_PREFIX}/", json=book_data, headers=headers)
+    assert response.status_code == status.HTTP_201_CREATED
+    response = await async_client.post(f"{BOOKS_PREFIX}/", json={**book_data, "title": "Hobbit, The"}, headers=headers)
+    assert response.status_code == status.HTTP_409_CONFLICT
+    assert response.json()["error_code"] == "duplicate_book"
+
+    items = [
+        {**book_data, "title": "The Silmarillion"},
+        {**book_data, "author": "J. R. R. Tolkien"},
+        {**book_data, "title": "The Silmarillion."},
+        {**book_data, "title": "Unfinished Tales"},
+    ]
+    response = await async_client.post(f"{BOOKS_PREFIX}/bulk", json=items, headers=headers)
+    assert [book["title"] for book in response.json()["created"]] == ["The Silmarillion", "Unfinished Tales"]
+    assert [error["index"] for error in response.json()["errors"]] == [1, 2]
+    assert response.json()["errors"][0]["errors"][0]["type"] == "duplicate"
+
+
+@pytest.mark.asyncio
+async def test_book_cover(
+    async_client: AsyncClient,
+    cover_storage,
+    test_book: Book,
+    test_user: User,
+    test_user_access_token: str,
+    other_user: User,
+    other_user_access_token: str,
+):
+    test_user.is_verified = True
+    other_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}", "Content-Type": "image/png"}
+    buffer = io.BytesIO()
+    Image.new("RGB", (600, 900), "navy").save(buffer, "PNG")
+    image = buffer.getvalue()
+
+    response = await async_client.put(f"{BOOKS_PREFIX}/{test_book.uid}/cover", content=image, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["cover_content_type"] == "image/png"
+
+    response = await async_client.get(f"{BOOKS_PREFIX}/{test_book.uid}/cover")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"] == "image/png"
+    assert response.content == image
+    etag = response.headers["etag"]
+    response = await async_client.get(f"{BOOKS_PREFIX}/{test_book.uid}/cover", headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    response = await async_client.get(f"{BOOKS_PREFIX}/{test_book.uid}/cover", headers={"Range": "bytes=0-9"})
+    assert response.status_code == status.HTTP_206_PARTIAL_CONTENT
+    assert response.headers["content-range"] == f"bytes 0-9/{len(image)}"
+    assert response.content == image[:10]
+
+    # Thumbnails are generated in the process pool after the upload response
+    response = await async_client.get(f"{BOOKS_PREFIX}/{test_book.uid}/cover", params={"size": 256})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"] == "image/jpeg"
+    assert Image.open(io.BytesIO(response.content)).size == (171, 256)
+    response = await async_client.get(f"{BOOKS_PREFIX}/{test_book.uid}/cover", params={"size": 100})
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    response = await async_client.put(f"{BOOKS_PREFIX}/{test_book.uid}/cover", content=b"not an image", headers=headers)
+    assert response.status_code == status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+    webp_headers = {**headers, "Content-Type": "image/webp"}
+    wav = b"RIFF\x24\x00\x00\x00WAVEfmt " + bytes(28)
+    response = await async_client.put(f"{BOOKS_PREFIX}/{test_book.uid}/cover", content=wav, headers=webp_headers)
+    assert response.status_code == status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+
+    # The signature is checked once enough bytes arrived, however the body is split
+    buffer = io.BytesIO()
+    Image.new("RGB", (60, 90), "navy").save(buffer, "WEBP")
+    webp = buffer.getvalue()
+
+    async def byte_by_byte():
+        for index in range(len(webp)):
+            yield webp[index : index + 1]
+
+    response = await async_client.put(
+        f"{BOOKS_PREFIX}/{test_book.uid}/cover", content=byte_by_byte(), headers=webp_headers
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["cover_content_type"] == "image/webp"
+    response = await async_client.put(
+        f"{BOOKS_PREFIX}/{test_book.uid}/cover", content=image, headers={**headers, "Content-Type": "image/gif"}
+    )
+    assert response.status_code == status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+    other_headers = {"Authorization": f"Bearer {other_user_access_token}", "Content-Type": "image/png"}
+    response = await async_client.put(f"{BOOKS_PREFIX}/{test_book.uid}/cover", content=image, headers=other_headers)
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+
+    await async_client.delete(f"{BOOKS_PREFIX}/{test_book.uid}", headers=headers)
+    assert not (cover_storage.root / str(test_book.uid)).exists()
+
+
+@pytest.mark.asyncio
+async def test_book_cover_too_large(
+    async_client: AsyncClient,
+    cover_storage,
+    test_book: Book,
+    test_user: User,
+    test_user_access_token: str,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    monkeypatch.setattr(Config, "COVER_MAX_BYTES", 1024)
+    test_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}", "Content-Type": "image/jpeg"}
+    content = b"\xff\xd8\xff" + bytes(2048)
+
+    response = await async_client.put(f"{BOOKS_PREFIX}/{test_book.uid}/cover", content=content, headers=headers)
+    assert response.status_code == status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    assert response.json()["error_code"] == "cover_too_large"
+    assert not list(cover_storage.root.rglob("*.*"))
+    response = await async_client.get(f"{BOOKS_PREFIX}/{test_book.uid}/cover")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
@@ -1,9 +1,18 @@
+import asyncio
+import json
+from datetime import date
+from uuid import uuid4
+
 import pytest
 from fastapi import status
 from httpx import AsyncClient
-from sqlalchemy.ext.asyncio import AsyncSession  # noqa: F401
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.config import Config
 from app.db.models import Book, Review, User
+from app.reviews import moderation
+from app.reviews.moderation import TermScorer, moderate_pending_reviews, moderate_reviews
+from app.reviews.service import ReviewService
 
 REVIEWS_PREFIX = "/api/v1/reviews"
 
@@ -13,10 +22,74 @@ async def test_get_all_reviews(async_client: AsyncClient, test_review: Review):
     response = await async_client.get(f"{REVIEWS_PREFIX}/")
 
     assert response.status_code == status.HTTP_200_OK
-    assert isinstance(response.json(), list)
-    assert len(response.json()) == 1
-    assert response.json()[0]["rating"] == test_review.rating
-    assert response.json()[0]["review_text"] == test_review.review_text
+    assert len(response.json()["items"]) == 1
+    assert response.json()["items"][0]["rating"] == test_review.rating
+    assert response.json()["items"][0]["review_text"] == test_review.review_text
+    assert response.json()["next_cursor"] is None
+
+
+@pytest.mark.asyncio
+async def test_get_all_reviews_sparse_fields(async_client: AsyncClient, test_review: Review):
+    response = await async_client.get(f"{REVIEWS_PREFIX}/", params={"fields": "rating"})
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["items"] == [{"rating": test_review.rating}]
+
+
+@pytest.mark.asyncio
+async def test_get_all_reviews_filtered(
+    async_client: AsyncClient, test_session: AsyncSession, test_book: Book, test_user: User, other_user: User
+):
+    books = [test_book] + [
+        Book(
+            title=f"Book {i}",
+            author="Author",
+            publisher="Publisher",
+            page_count=100,
+            language="en",
+            published_date=date(2020, 1, 1),
+            user_uid=test_user.uid,
+        )
+        for i in range(2)
+    ]
+    test_session.add_all(books)
+    await test_session.flush()
+    for rating, book, user in [
+        (1, books[0], test_user),
+        (3, books[1], test_user),
+        (5, books[2], test_user),
+        (4, books[0], other_user),
+        (5, books[1], other_user),
+    ]:
+        test_session.add(Review(rating=rating, review_text="Text", book_uid=book.uid, user_uid=user.uid))
+    await test_session.commit()
+
+    params = {"user_uid": str(test_user.uid), "min_rating": 3, "limit": 1, "count": "exact"}
+    response = await async_client.get(f"{REVIEWS_PREFIX}/", params=params)
+    assert response.headers["X-Total-Count"] == "2"
+    ratings = [item["rating"] for item in response.json()["items"]]
+    response = await async_client.get(f"{REVIEWS_PREFIX}/", params={**params, "cursor": response.json()["next_cursor"]})
+    ratings += [item["rating"] for item in response.json()["items"]]
+    assert sorted(ratings) == [3, 5]
+    assert response.json()["next_cursor"] is None
+
+    params = {"book_uid": str(test_book.uid), "max_rating": 4, "fields": "rating,user_uid"}
+    response = await async_client.get(f"{REVIEWS_PREFIX}/", params=params)
+    assert sorted(item["rating"] for item in response.json()["items"]) == [1, 4]
+    response = await async_client.get(f"{REVIEWS_PREFIX}/", params={"book_uid": str(uuid4())})
+    assert response.json()["items"] == []
+    response = await async_client.get(f"{REVIEWS_PREFIX}/", params={"min_rating": 6})
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+@pytest.mark.asyncio
+async def test_export_reviews(async_client: AsyncClient, test_review: Review):
+    response = await async_client.get(f"{REVIEWS_PREFIX}/export")
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"] == "application/x-ndjson"
+    reviews = [json.loads(line) for line in response.text.splitlines()]
+    assert [review["uid"] for review in reviews] == [str(test_review.uid)]
 
 
 @pytest.mark.asyncio
@@ -82,6 +155,38 @@ async def test_add_review_to_book_invalid_data(
     assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
 
 
+@pytest.mark.asyncio
+async def test_add_review_to_book_replaces_review(
+    async_client: AsyncClient, test_book: Book, test_user: User, test_user_access_token: str
+):
+    test_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}"}
+
+    first = await async_client.post(
+        f"{REVIEWS_PREFIX}/book/{test_book.uid}", json={"rating": 5, "review_text": "Great"}, headers=headers
+    )
+    second = await async_client.post(
+        f"{REVIEWS_PREFIX}/book/{test_book.uid}", json={"rating": 2, "review_text": "Changed my mind"}, headers=headers
+    )
+    assert second.status_code == status.HTTP_201_CREATED
+    assert second.json()["uid"] == first.json()["uid"]
+    assert second.json()["review_text"] == "Changed my mind"
+    assert second.json()["version"] == 2
+
+    ratings = (await async_client.get(f"/api/v1/books/{test_book.uid}/ratings")).json()
+    assert ratings["review_count"] == 1
+    assert ratings["avg_rating"] == 2.0
+    assert [entry["count"] for entry in ratings["histogram"]] == [0, 0, 1, 0, 0, 0]
+
+    response = await async_client.post(
+        f"{REVIEWS_PREFIX}/book/{uuid4()}", json={"rating": 2, "review_text": "Lost"}, headers=headers
+    )
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert response.json()["error_code"] == "book_not_found"
+    response = await async_client.get(f"{REVIEWS_PREFIX}/{first.json()['uid']}")
+    assert response.json()["rating"] == 2
+
+
 @pytest.mark.asyncio
 async def test_update_review_success(
     async_client: AsyncClient, test_review: Review, test_user: User, test_user_access_token: str
@@ -170,3 +275,256 @@ async def test_delete_review_insufficient_permission(
     assert response.status_code == status.HTTP_403_FORBIDDEN
     assert response.json()["detail"] == "You do not have enough permissions to perform this action"
     assert response.json()["error_code"] == "insufficient_permissions"
+
+
+@pytest.mark.asyncio
+async def test_book_rating_follows_reviews(
+    async_client: AsyncClient,
+    test_book: Book,
+    test_user: User,
+    test_user_access_token: str,
+    other_user: User,
+    other_user_access_token: str,
+):
+    test_user.is_verified = True
+    other_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}"}
+
+    first = await async_client.post(
+        f"{REVIEWS_PREFIX}/book/{test_book.uid}", json={"rating": 5, "review_text": "Great"}, headers=headers
+    )
+    await async_client.post(
+        f"{REVIEWS_PREFIX}/book/{test_book.uid}",
+        json={"rating": 2, "review_text": "Meh"},
+        headers={"Authorization": f"Bearer {other_user_access_token}"},
+    )
+    book = (await async_client.get(f"/api/v1/books/{test_book.uid}")).json()
+    assert book["review_count"] == 2
+    assert book["avg_rating"] == 3.5
+    assert book["updated_at"] == test_book.updated_at.isoformat()
+    ratings = (await async_client.get(f"/api/v1/books/{test_book.uid}/ratings")).json()
+    assert [entry["count"] for entry in ratings["histogram"]] == [0, 0, 1, 0, 0, 1]
+
+    await async_client.put(f"{REVIEWS_PREFIX}/{first.json()['uid']}", json={"rating": 3}, headers=headers)
+    book = (await async_client.get(f"/api/v1/books/{test_book.uid}")).json()
+    assert book["review_count"] == 2
+    assert book["avg_rating"] == 2.5
+    ratings = (await async_client.get(f"/api/v1/books/{test_book.uid}/ratings")).json()
+    assert [entry["count"] for entry in ratings["histogram"]] == [0, 0, 1, 1, 0, 0]
+
+    await async_client.delete(f"{REVIEWS_PREFIX}/{first.json()['uid']}", headers=headers)
+    response = await async_client.get("/api/v1/books/", params={"fields": "uid,review_count,avg_rating"})
+    assert response.json()["items"] == [{"uid": str(test_book.uid), "review_count": 1, "avg_rating": 2.0}]
+    ratings = (await async_client.get(f"/api/v1/books/{test_book.uid}/ratings")).json()
+    assert ratings == {
+        "review_count": 1,
+        "avg_rating": 2.0,
+        "histogram": [{"rating": rating, "count": int(rating == 2)} for rating in range(6)],
+    }
+    response = await async_client.get(f"/api/v1/books/{uuid4()}/ratings")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.asyncio
+async def test_rebuild_book_ratings(async_client: AsyncClient, test_session: AsyncSession, test_review: Review):
+    book = (await async_client.get(f"/api/v1/books/{test_review.book_uid}")).json()
+    assert book["review_count"] == 0
+    assert book["avg_rating"] is None
+
+    await ReviewService().rebuild_book_ratings(test_session)
+
+    book = (await async_client.get(f"/api/v1/books/{test_review.book_uid}")).json()
+    assert book["review_count"] == 1
+    assert book["avg_rating"] == 4.0
+    ratings = (await async_client.get(f"/api/v1/books/{test_review.book_uid}/ratings")).json()
+    assert [entry["count"] for entry in ratings["histogram"]] == [0, 0, 0, 0, 1, 0]
+
+
+@pytest.mark.asyncio
+async def test_book_detail_pages_reviews(
+    async_client: AsyncClient, test_session: AsyncSession, test_book: Book, test_user: User
+):
+    users = [
+        User(email=f"reader{i}@example.com", username=f"reader{i}", password_hash="-", first_name="R", last_name="R")
+        for i in range(25)
+    ]
+    test_session.add_all(users)
+    await test_session.flush()
+    test_session.add_all(
+        Review(rating=i % 6, review_text=f"Review {i}", book_uid=test_book.uid, user_uid=user.uid)
+        for i, user in enumerate(users)
+    )
+    await test_session.commit()
+
+    detail = (await async_client.get(f"/api/v1/books/{test_book.uid}")).json()
+    assert len(detail["reviews"]) == 20
+    assert detail["reviews_next_cursor"] is not None
+
+    response = await async_client.get(
+        f"{REVIEWS_PREFIX}/book/{test_book.uid}", params={"cursor": detail["reviews_next_cursor"]}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["next_cursor"] is None
+    seen = {review["uid"] for review in detail["reviews"] + response.json()["items"]}
+    assert len(seen) == 25
+
+
+@pytest.mark.asyncio
+async def test_get_book_reviews_book_not_found(async_client: AsyncClient):
+    response = await async_client.get(f"{REVIEWS_PREFIX}/book/{uuid4()}")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert response.json()["error_code"] == "book_not_found"
+
+
+@pytest.mark.asyncio
+async def test_update_review_version_conflict(
+    async_client: AsyncClient, test_review: Review, test_user: User, test_user_access_token: str
+):
+    test_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}"}
+
+    response = await async_client.put(
+        f"{REVIEWS_PREFIX}/{test_review.uid}", json={"rating": 2, "version": 1}, headers=headers
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["version"] == 2
+
+    response = await async_client.put(
+        f"{REVIEWS_PREFIX}/{test_review.uid}", json={"rating": 5, "version": 1}, headers=headers
+    )
+    assert response.status_code == status.HTTP_409_CONFLICT
+    assert response.json()["error_code"] == "version_conflict"
+
+    book = (await async_client.get(f"/api/v1/books/{test_review.book_uid}")).json()
+    assert book["reviews"][0]["rating"] == 2
+    assert book["review_count"] == 0
+    assert book["avg_rating"] is None
+
+
+@pytest.mark.asyncio
+async def test_import_reviews(
+    async_client: AsyncClient,
+    test_session: AsyncSession,
+    test_book: Book,
+    test_user: User,
+    test_user_access_token: str,
+    admin_user: User,
+    admin_user_access_token: str,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    monkeypatch.setattr(Config, "REVIEW_IMPORT_CHUNK_SIZE", 2)
+    admin_user.is_verified = True
+    test_user.is_verified = True
+    review = {"rating": 4, "review_text": "Legacy", "book_uid": str(test_book.uid), "user_uid": str(test_user.uid)}
+    lines = [
+        {**review, "created_at": "2015-06-01T12:00:00+02:00"},
+        {**review, "book_uid": str(uuid4())},
+        {**review, "rating": 2, "user_uid": str(admin_user.uid)},
+        {**review, "rating": 9},
+        {**review, "user_uid": str(uuid4())},
+        {**review, "rating": 1},
+    ]
+    content = "\n".join(map(json.dumps, lines)) + "\n{not json}\n"
+    headers = {"Authorization": f"Bearer {admin_user_access_token}", "Content-Type": "application/x-ndjson"}
+    response = await async_client.post(f"{REVIEWS_PREFIX}/bulk", content=content.encode(), headers=headers)
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["processed"] == 7
+    assert response.json()["created"] == 2
+    assert [error["line"] for error in response.json()["errors"]] == [2, 4, 5, 6, 7]
+    assert response.json()["errors"][0]["errors"][0]["type"] == "unknown_book"
+    assert response.json()["errors"][2]["errors"][0]["type"] == "unknown_user"
+    assert response.json()["errors"][3]["errors"][0]["type"] == "duplicate_review"
+
+    await test_session.refresh(test_book)
+    assert (test_book.review_count, test_book.rating_sum) == (2, 6)
+    ratings = (await async_client.get(f"/api/v1/books/{test_book.uid}/ratings")).json()
+    assert [entry["count"] for entry in ratings["histogram"]] == [0, 0, 1, 0, 1, 0]
+    response = await async_client.get(f"{REVIEWS_PREFIX}/", params={"book_uid": str(test_book.uid)})
+    assert response.json()["items"][-1]["created_at"] == "2015-06-01T10:00:00"
+    response = await async_client.get("/api/v1/books/top")
+    assert response.json()[0]["book"]["uid"] == str(test_book.uid)
+
+    headers = {"Authorization": f"Bearer {test_user_access_token}", "Content-Type": "application/x-ndjson"}
+    response = await async_client.post(f"{REVIEWS_PREFIX}/bulk", content=content.encode(), headers=headers)
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+
+
+@pytest.mark.asyncio
+async def test_moderate_reviews(
+    async_client: AsyncClient,
+    test_session: AsyncSession,
+    test_book: Book,
+    test_user: User,
+    test_user_access_token: str,
+    other_user: User,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    monkeypatch.setattr(Config, "MODERATION_BATCH_SIZE", 1)
+    scorer = TermScorer({"casino": 1.0, "<url>": 0.5})
+    scores = scorer.score(["A fine read", "Best CASINO bonus at https://spam.example", "", "casinos"])
+    assert list(scores.round(2)) == [0.0, 0.78, 0.0, 0.0]
+
+    test_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}"}
+    response = await async_client.post(
+        f"{REVIEWS_PREFIX}/book/{test_book.uid}", json={"rating": 4, "review_text": "A fine read"}, headers=headers
+    )
+    assert response.json()["moderation_status"] == "pending"
+    spam = Review(rating=5, review_text="Viagra at www.spam.example", book_uid=test_book.uid, user_uid=other_user.uid)
+    test_session.add(spam)
+    await test_session.commit()
+
+    assert await moderate_reviews(test_session) == 2
+    assert await moderate_pending_reviews(test_session) == 0
+    response = await async_client.get(f"{REVIEWS_PREFIX}/", params={"fields": "user_uid,moderation_status"})
+    statuses = {item["user_uid"]: item["moderation_status"] for item in response.json()["items"]}
+    assert statuses == {str(test_user.uid): "approved", str(other_user.uid): "rejected"}
+
+    response = await async_client.post(
+        f"{REVIEWS_PREFIX}/book/{test_book.uid}", json={"rating": 1, "review_text": "Casino"}, headers=headers
+    )
+    assert response.json()["moderation_status"] == "pending"
+    assert await moderate_reviews(test_session) == 1
+    response = await async_client.put(
+        f"{REVIEWS_PREFIX}/{response.json()['uid']}", json={"review_text": "Viagra"}, headers=headers
+    )
+    assert response.json()["moderation_status"] == "pending"
+    assert await moderate_reviews(test_session) == 1
+    response = await async_client.get(f"{REVIEWS_PREFIX}/{response.json()['uid']}")
+    assert response.json()["moderation_status"] == "rejected"
+
+
+@pytest.mark.asyncio
+async def test_moderation_changes_book_etag(async_client: AsyncClient, test_session: AsyncSession, test_review: Review):
+    response = await async_client.get(f"/api/v1/books/{test_review.book_uid}")
+    etag = response.headers["ETag"]
+    assert response.json()["reviews"][0]["moderation_status"] == "pending"
+
+    assert await moderate_reviews(test_session) == 1
+    await test_session.refresh(test_review)
+
+    response = await async_client.get(f"/api/v1/books/{test_review.book_uid}", headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["ETag"] != etag
+    assert response.json()["reviews"][0]["moderation_status"] == "approved"
+
+
+@pytest.mark.asyncio
+async def test_moderation_worker_without_polling(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(Config, "MODERATION_POLL_SECONDS", 0)
+    drains = []
+
+    async def drain(session: AsyncSession) -> int:
+        drains.append(session)
+        return 0
+
+    monkeypatch.setattr(moderation, "moderate_reviews", drain)
+    worker = moderation.ModerationWorker()
+    task = asyncio.create_task(worker.run(None))
+    await asyncio.sleep(0.05)
+    assert len(drains) == 1
+    worker.notify()
+    await asyncio.sleep(0.05)
+    assert len(drains) == 2
+    task.cancel()
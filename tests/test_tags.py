@@ -56,6 +56,9 @@ async def test_add_tags_to_book_success(
     assert len(response.json()) == 2
     assert response.json()[0]["name"] in ["New Tag 1", "New Tag 2"]
     assert response.json()[1]["name"] in ["New Tag 1", "New Tag 2"]
+    # Tags are part of the book, so optimistic concurrency sees them as an edit
+    response = await async_client.get(f"/api/v1/books/{test_book.uid}")
+    assert response.json()["version"] == 2
 
 
 @pytest.mark.asyncio
@@ -1,8 +1,14 @@
+import random
+from datetime import datetime
+
 import pytest
 from fastapi import status
 from httpx import AsyncClient
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.db.models import User
+from app.config import Config
+from app.db.models import Book, ModerationStatus, Review, User
+from app.users.feed import activity_feed
 
 USERS_PREFIX = "/api/v1/users"
 
@@ -39,6 +45,18 @@ async def test_get_all_users_success(
     assert len(response.json()) == 2  # Not include admin user
 
 
+@pytest.mark.asyncio
+async def test_get_all_users_sparse_fields(
+    async_client: AsyncClient, test_user: User, other_user: User, admin_user_access_token: str
+):
+    headers = {"Authorization": f"Bearer {admin_user_access_token}"}
+    response = await async_client.get(f"{USERS_PREFIX}/", params={"fields": "uid,username"}, headers=headers)
+
+    assert response.status_code == status.HTTP_200_OK
+    assert all(set(user) == {"uid", "username"} for user in response.json())
+    assert {user["username"] for user in response.json()} == {test_user.username, other_user.username}
+
+
 @pytest.mark.asyncio
 async def test_get_all_users_unauthorized(async_client: AsyncClient):
     response = await async_client.get(f"{USERS_PREFIX}/")
@@ -206,3 +224,115 @@ async def test_delete_user_profile_admin_permission(
     assert get_response.status_code == status.HTTP_404_NOT_FOUND
     assert get_response.json()["detail"] == "User not found"
     assert get_response.json()["error_code"] == "user_not_found"
+
+
+@pytest.mark.asyncio
+async def test_update_user_profile_version_conflict(
+    async_client: AsyncClient, test_user: User, test_user_access_token: str
+):
+    test_user.is_verified = True
+    headers = {"Authorization": f"Bearer {test_user_access_token}"}
+    url = f"{USERS_PREFIX}/user-profile/{test_user.uid}"
+
+    response = await async_client.put(url, json={"first_name": "First", "version": test_user.version}, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["version"] == 2
+
+    response = await async_client.put(url, json={"first_name": "Stale", "version": 1}, headers=headers)
+    assert response.status_code == status.HTTP_409_CONFLICT
+    assert response.json()["error_code"] == "version_conflict"
+
+
+@pytest.mark.asyncio
+async def test_get_feed(
+    async_client: AsyncClient,
+    test_book: Book,
+    test_user: User,
+    test_user_access_token: str,
+    other_user: User,
+    other_user_access_token: str,
+    admin_user: User,
+    admin_user_access_token: str,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    tokens = {
+        test_user: test_user_access_token,
+        other_user: other_user_access_token,
+        admin_user: admin_user_access_token,
+    }
+    for user in tokens:
+        user.is_verified = True
+    reviews = {}
+
+    async def review(user: User) -> None:
+        response = await async_client.post(
+            f"/api/v1/reviews/book/{test_book.uid}",
+            json={"rating": 4, "review_text": "Nice"},
+            headers={"Authorization": f"Bearer {tokens[user]}"},
+        )
+        reviews[user] = response.json()["uid"]
+
+    async def feed(user: User) -> list[str]:
+        headers = {"Authorization": f"Bearer {tokens[user]}"}
+        items, params = [], {"limit": 1}
+        while True:
+            response = await async_client.get(f"{USERS_PREFIX}/me/feed", params=params, headers=headers)
+            assert response.status_code == status.HTTP_200_OK
+            items += [item["uid"] for item in response.json()["items"]]
+            if response.json()["next_cursor"] is None:
+                return items
+            params["cursor"] = response.json()["next_cursor"]
+
+    await review(other_user)
+    await review(admin_user)
+    assert sorted(await feed(test_user)) == sorted([reviews[other_user], reviews[admin_user]])
+    assert await feed(other_user) == [reviews[admin_user]]
+    assert await feed(admin_user) == []
+
+    # The book is now popular: the review of its owner is pulled by the feed reads instead of pushed
+    monkeypatch.setattr(Config, "FEED_PULL_THRESHOLD", 2)
+    await review(test_user)
+    assert sorted(await feed(other_user)) == sorted([reviews[admin_user], reviews[test_user]])
+    # Pulling also lists the reviews written before the user followed the book
+    assert sorted(await feed(admin_user)) == sorted([reviews[other_user], reviews[test_user]])
+    assert len(await feed(test_user)) == 2
+
+    response = await async_client.get(f"{USERS_PREFIX}/me/feed")
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+@pytest.mark.asyncio
+async def test_get_feed_pages_same_second_reviews(
+    async_client: AsyncClient,
+    test_session: AsyncSession,
+    test_user: User,
+    test_user_access_token: str,
+    other_user: User,
+):
+    test_user.is_verified = True
+    created_at = datetime(2025, 1, 1, 12, 0, 0)
+    reviews = [
+        Review(
+            rating=4,
+            review_text=f"Review {index}",
+            user_uid=other_user.uid,
+            created_at=created_at,
+            moderation_status=ModerationStatus.APPROVED,
+        )
+        for index in range(5)
+    ]
+    test_session.add_all(reviews)
+    await test_session.commit()
+    # Commits finishing out of order push the reviews of the same second in any order
+    for review in random.sample(reviews, len(reviews)):
+        await activity_feed.push([test_user.uid], (review.created_at, review.uid))
+
+    headers = {"Authorization": f"Bearer {test_user_access_token}"}
+    items, params = [], {"limit": 2}
+    while True:
+        response = await async_client.get(f"{USERS_PREFIX}/me/feed", params=params, headers=headers)
+        items += [item["uid"] for item in response.json()["items"]]
+        if response.json()["next_cursor"] is None:
+            break
+        params["cursor"] = response.json()["next_cursor"]
+    assert items == [str(review.uid) for review in sorted(reviews, key=lambda review: review.uid, reverse=True)]